@@ -0,0 +1,314 @@
+# common/async_llm.py
+import asyncio
+import contextlib
+import functools
+import random
+import time
+from openai import AsyncOpenAI, RateLimitError
+from common.client_pool import ClientPool, Endpoint
+
+
+def backoff_delay(attempt, base=1.0, max_delay=60.0):
+    """
+    Exponential backoff with full jitter: a random delay in [0, min(max_delay, base * 2 ** attempt)].
+
+    :param attempt: The number of failed attempts so far (starting at 0).
+    :param base: The delay scale in seconds.
+    :param max_delay: The upper bound of the delay in seconds.
+    :return: The delay in seconds.
+    """
+    return random.uniform(0, min(max_delay, base * 2 ** attempt))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Token-bucket rate limiter for asyncio tasks. It can be shared by successive event loops (e.g. one
+        asyncio.run per batch), keeping its tokens across them.
+
+        :param rate: Number of tokens added per second, i.e. the sustained request rate.
+        :param capacity: Maximum number of tokens, i.e. the largest allowed burst. Defaults to max(1, rate).
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = None
+        self._loop = None
+
+    def _get_lock(self):
+        # asyncio primitives belong to one event loop, so the lock is created again in every new loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._lock = asyncio.Lock()
+            self._loop = loop
+        return self._lock
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_lock"] = None
+        state["_loop"] = None
+        return state
+
+    async def acquire(self, tokens: float = 1.0):
+        """
+        Wait until `tokens` tokens are available and take them.
+        """
+        async with self._get_lock():
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class AdaptiveConcurrencyLimiter:
+    def __init__(self, max_concurrency: int):
+        """
+        Limits the number of requests in flight, adapting the limit to rate limiting (AIMD): the limit is
+        halved when the API answers 429, and grows back by one after a full limit's worth of successes.
+        It can be shared by successive event loops, keeping its limit across them.
+
+        :param max_concurrency: The initial and maximum number of requests in flight.
+        """
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self._condition = None
+        self._loop = None
+
+    def _get_condition(self):
+        # asyncio primitives belong to one event loop, so the condition is created again in every new loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+        return self._condition
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_condition"] = None
+        state["_loop"] = None
+        return state
+
+    async def __aenter__(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+    def on_success(self):
+        self.successes += 1
+        if self.limit < self.max_concurrency and self.successes >= self.limit:
+            self.limit += 1
+            self.successes = 0
+
+    def on_rate_limited(self):
+        self.limit = max(1, self.limit // 2)
+        self.successes = 0
+
+
+def retry_after(error):
+    """
+    Returns the delay in seconds requested by the Retry-After header of a rate limit error, or None.
+    """
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class AsyncLLMEngine:
+    def __init__(self, model: str, api_key: str, base_url: str, max_concurrency: int = 8,
+                 requests_per_second: float = None, max_retries: int = 20, backoff_base: float = 1.0,
+                 backoff_max: float = 60.0, cache=None, pool=None, usage_log=None):
+        """
+        Sends chat completion requests to an OpenAI-compatible API concurrently.
+
+        :param model: The model name.
+        :param api_key: The API key.
+        :param base_url: The base URL of the OpenAI-compatible API.
+        :param max_concurrency: Maximum number of requests in flight.
+        :param requests_per_second: Sustained request rate enforced by a token bucket, None for no limit.
+        :param max_retries: Number of attempts per request before giving up.
+        :param backoff_base: Scale of the exponential backoff between attempts, in seconds.
+        :param backoff_max: Maximum backoff between attempts, in seconds.
+        :param cache: Optional LLMCache, cached requests are not sent again.
+        :param pool: Optional ClientPool spreading the requests over several endpoints and keys. Defaults to a
+                     pool of the single endpoint given by base_url and api_key.
+        :param usage_log: Optional function called as usage_log(sample_id, usage) with the token counts of every
+                          response, usage being a dictionary with prompt_tokens, cached_prompt_tokens (prompt
+                          tokens served from the server's prefix cache, if reported) and completion_tokens.
+
+        Requests are counted in self.stats (requests sent, cached, rate limited, failed and the prompt and
+        completion tokens used), see throughput.
+        """
+        self.model = model
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.cache = cache
+        self.pool = pool if pool is not None else ClientPool([Endpoint(base_url, api_key)])
+        self.usage_log = usage_log
+        # Shared by all sessions, so the rate limit and the adapted concurrency carry over from one session (e.g.
+        # one batch of a filter) to the next instead of starting again at full capacity
+        self.limiter = AdaptiveConcurrencyLimiter(max_concurrency)
+        self.rate_limiter = TokenBucket(requests_per_second) if requests_per_second else None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"requests": 0, "cached": 0, "rate_limited": 0, "errors": 0,
+                      "prompt_tokens": 0, "cached_prompt_tokens": 0, "completion_tokens": 0}
+        self.start_time = time.monotonic()
+
+    def throughput(self):
+        """
+        Returns the requests, tokens and completion tokens per second sent since the stats were reset.
+        """
+        elapsed = max(time.monotonic() - self.start_time, 1e-9)
+        tokens = self.stats["prompt_tokens"] + self.stats["completion_tokens"]
+        return {
+            "requests_per_second": self.stats["requests"] / elapsed,
+            "tokens_per_second": tokens / elapsed,
+            "completion_tokens_per_second": self.stats["completion_tokens"] / elapsed,
+        }
+
+    @staticmethod
+    def usage(usage):
+        """
+        Returns the prompt, cached prompt and completion token counts of a response's usage.
+        """
+        details = getattr(usage, "prompt_tokens_details", None)
+        return {
+            "prompt_tokens": usage.prompt_tokens or 0,
+            "cached_prompt_tokens": getattr(details, "cached_tokens", None) or 0,
+            "completion_tokens": usage.completion_tokens or 0,
+        }
+
+    async def complete(self, clients, semaphore, rate_limiter, messages, sample_id=None, **kwargs):
+        """
+        Send one chat completion request, retrying with exponential backoff and jitter.
+        Every attempt is sent to the endpoint the pool picks, with clients mapping the endpoints to their clients.
+        If semaphore is an AdaptiveConcurrencyLimiter, its limit is lowered when the API answers 429.
+
+        :param sample_id: Identifies the sample in the cache key, for sampled (temperature > 0) requests.
+        :return: The content of the first choice of the response.
+        """
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(self.model, messages, kwargs.get("temperature"), kwargs.get("max_tokens"), sample_id)
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.stats["cached"] += 1
+                return cached
+        adaptive = isinstance(semaphore, AdaptiveConcurrencyLimiter)
+        last_error = None
+        for attempt in range(self.max_retries):
+            if rate_limiter is not None:
+                await rate_limiter.acquire()
+            delay = backoff_delay(attempt, self.backoff_base, self.backoff_max)
+            async with semaphore:
+                endpoint = self.pool.acquire()
+                start_time = time.monotonic()
+                succeeded = False
+                requested_delay = None
+                try:
+                    response = await clients[endpoint].chat.completions.create(
+                        model=endpoint.model or self.model, messages=messages, **kwargs
+                    )
+                    if getattr(response, "error", None):
+                        raise ValueError(f"Hit error during generation: {response.error}")
+                    completion = response.choices[0].message.content if response is not None and response.choices else None
+                    # A response without content is a failed attempt, so the endpoint is not released as healthy
+                    if completion is not None:
+                        self.stats["requests"] += 1
+                        if getattr(response, "usage", None) is not None:
+                            usage = self.usage(response.usage)
+                            for name, tokens in usage.items():
+                                self.stats[name] += tokens
+                            if self.usage_log is not None:
+                                self.usage_log(sample_id, usage)
+                        if adaptive:
+                            semaphore.on_success()
+                        succeeded = True
+                        if self.cache is not None:
+                            self.cache.set(key, completion)
+                        return completion
+                    last_error = f"empty response, missing choices or content from {endpoint.name}"
+                    print(f"[WARN] Empty response, missing choices or content from {endpoint.name}. Retrying ({attempt+1}/{self.max_retries})...")
+                except RateLimitError as e:
+                    self.stats["rate_limited"] += 1
+                    if adaptive:
+                        semaphore.on_rate_limited()
+                    # Honor the server's Retry-After, if any, on top of the jittered backoff
+                    requested_delay = retry_after(e)
+                    last_error = f"rate limited by {endpoint.name}"
+                    delay = max(delay, requested_delay or 0.0)
+                    print(f"[WARN] Rate limited by {endpoint.name} (attempt {attempt+1}/{self.max_retries}), "
+                          f"concurrency limit {semaphore.limit if adaptive else self.max_concurrency}, retrying in {delay:.1f} s")
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    last_error = f"{e.__class__.__name__}: {e}"
+                    print(f"[ERROR] Exception during API call to {endpoint.name} (attempt {attempt+1}/{self.max_retries}): {e.__class__.__name__}: {e}")
+                finally:
+                    self.pool.release(endpoint, time.monotonic() - start_time, error=not succeeded, retry_after=requested_delay)
+            # No backoff after the last attempt
+            if attempt < self.max_retries - 1:
+                await asyncio.sleep(delay)
+        raise ValueError(f"Too many API fails, last: {last_error}")
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        """
+        Opens a client per endpoint of the pool, shared by all requests of the session, with the adaptive
+        concurrency limit and rate limit of the engine. Yields a coroutine function
+        complete(messages, sample_id=None, **kwargs).
+        """
+        async with contextlib.AsyncExitStack() as stack:
+            # Retries are handled here, so 429 responses reach the concurrency limiter and the pool
+            clients = {
+                endpoint: await stack.enter_async_context(
+                    AsyncOpenAI(api_key=endpoint.api_key, base_url=endpoint.base_url, max_retries=0)
+                )
+                for endpoint in self.pool.endpoints
+            }
+            yield functools.partial(self.complete, clients, self.limiter, self.rate_limiter)
+
+    async def complete_all(self, messages_list, sample_ids=None, kwargs_list=None, **kwargs):
+        """
+        Send all requests concurrently and return the completions in the order of `messages_list`.
+
+        :param kwargs_list: Optional request arguments per request (e.g. max_tokens), overriding kwargs.
+        """
+        if sample_ids is None:
+            sample_ids = [None] * len(messages_list)
+        if kwargs_list is None:
+            kwargs_list = [{}] * len(messages_list)
+        async with self.session() as complete:
+            return await asyncio.gather(*[
+                complete(messages, sample_id, **{**kwargs, **request_kwargs})
+                for messages, sample_id, request_kwargs in zip(messages_list, sample_ids, kwargs_list)
+            ])
+
+    def run_all(self, messages_list, sample_ids=None, kwargs_list=None, **kwargs):
+        """
+        Synchronous wrapper around complete_all.
+        """
+        if len(messages_list) == 0:
+            return []
+        return asyncio.run(self.complete_all(messages_list, sample_ids, kwargs_list, **kwargs))
@@ -0,0 +1,221 @@
+# common/client_pool.py
+import json
+import os
+import threading
+import time
+from collections import deque
+import numpy as np
+from openai import OpenAI
+
+
+class Endpoint:
+    def __init__(self, base_url: str, api_key: str, name: str = None, weight: float = 1.0, model: str = None):
+        """
+        One OpenAI-compatible endpoint (base URL and API key) of a ClientPool.
+
+        :param base_url: The base URL of the API.
+        :param api_key: The API key.
+        :param name: Name used in logs and stats, unique within a pool. Defaults to the base URL, numbered by
+                     the pool if several endpoints (e.g. several keys) share it.
+        :param weight: Share of the requests routed to this endpoint, relative to the other endpoints.
+        :param model: Model name sent to this endpoint, if it serves the model under another name
+                      (e.g. a local vLLM server). Defaults to the model of the request.
+        """
+        self.base_url = base_url
+        self.api_key = api_key
+        self.name = name or base_url
+        self.weight = weight
+        self.model = model
+        self.outstanding = 0
+        self.current_weight = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.disabled_until = 0.0
+        self.latencies = deque(maxlen=1000)
+        self._client = None
+
+    def client(self):
+        """
+        Returns the synchronous client of the endpoint, created on first use. Retries are left to the caller.
+        """
+        if self._client is None:
+            self._client = OpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+        return self._client
+
+    def stats(self):
+        """
+        Returns the request and error counts and the latency statistics of the last 1000 successful requests.
+        """
+        latencies = np.array(self.latencies)
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "outstanding": self.outstanding,
+            "mean_latency": float(latencies.mean()) if len(latencies) else None,
+            "p50_latency": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p95_latency": float(np.percentile(latencies, 95)) if len(latencies) else None,
+        }
+
+    def __getstate__(self):
+        # Clients can not be pickled, they are created again on first use
+        state = self.__dict__.copy()
+        state["_client"] = None
+        return state
+
+    def __str__(self):
+        return f"Endpoint(name={self.name}, weight={self.weight})"
+
+
+class ClientPool:
+    def __init__(self, endpoints, routing: str = "least_outstanding", error_threshold: int = 3,
+                 cooldown: float = 30.0, max_cooldown: float = 600.0):
+        """
+        Spreads requests over several OpenAI-compatible endpoints (base URLs and API keys).
+
+        Every request acquires an endpoint and releases it with its outcome. An endpoint that fails
+        error_threshold times in a row is taken out of rotation for cooldown seconds, doubled for every further
+        consecutive error up to max_cooldown; a 429 answer also takes it out for its Retry-After delay. If all
+        endpoints are out of rotation, the one that comes back first is used.
+
+        :param endpoints: The endpoints.
+        :param routing: "least_outstanding" sends each request to the endpoint with the fewest requests in flight
+                        relative to its weight, "weighted_round_robin" cycles through the endpoints in proportion
+                        to their weights (smooth weighted round-robin).
+        :param error_threshold: Number of consecutive errors that take an endpoint out of rotation.
+        :param cooldown: Initial time an endpoint stays out of rotation, in seconds.
+        :param max_cooldown: Maximum time an endpoint stays out of rotation, in seconds.
+        """
+        if len(endpoints) == 0:
+            raise ValueError("A ClientPool needs at least one endpoint")
+        if routing not in ("least_outstanding", "weighted_round_robin"):
+            raise ValueError(f"Unknown routing {routing}, use least_outstanding or weighted_round_robin")
+        self.endpoints = list(endpoints)
+        # Endpoints with the default name (their base URL) are numbered when several share a base URL, e.g.
+        # one per API key, so their stats and logs stay apart
+        names = [endpoint.name for endpoint in self.endpoints]
+        for idx, endpoint in enumerate(self.endpoints):
+            if names.count(endpoint.name) > 1 and endpoint.name == endpoint.base_url:
+                endpoint.name = f"{endpoint.base_url}#{idx}"
+        names = [endpoint.name for endpoint in self.endpoints]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"Endpoint names must be unique, found duplicates: {', '.join(duplicates)}")
+        self.routing = routing
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, path: str):
+        """
+        Loads a pool from a JSON configuration file:
+
+            {
+                "routing": "least_outstanding",
+                "error_threshold": 3,
+                "cooldown": 30,
+                "endpoints": [
+                    {"name": "sambanova-1", "base_url": "https://api.sambanova.ai/v1", "api_key_env": "SN_API_KEY_1", "weight": 1},
+                    {"name": "vllm", "base_url": "http://vllm-host:8000/v1", "api_key": "EMPTY", "weight": 2,
+                     "model": "meta-llama/Llama-3.3-70B-Instruct"}
+                ]
+            }
+
+        Every endpoint takes its API key from "api_key" or from the environment variable named by "api_key_env".
+        """
+        with open(path) as f:
+            config = json.load(f)
+        endpoints = []
+        for endpoint in config["endpoints"]:
+            endpoint = dict(endpoint)
+            api_key_env = endpoint.pop("api_key_env", None)
+            if api_key_env is not None:
+                if os.environ.get(api_key_env) is None:
+                    raise ValueError(f"Environment variable {api_key_env} with the API key of endpoint {endpoint.get('name', endpoint['base_url'])} is not set")
+                endpoint["api_key"] = os.environ[api_key_env]
+            endpoints.append(Endpoint(**endpoint))
+        options = {name: config[name] for name in ("routing", "error_threshold", "cooldown", "max_cooldown") if name in config}
+        return cls(endpoints, **options)
+
+    def acquire(self):
+        """
+        Picks the endpoint for a request and counts the request as in flight. Every acquire must be followed by
+        a release.
+        """
+        with self.lock:
+            now = time.monotonic()
+            available = [endpoint for endpoint in self.endpoints if endpoint.disabled_until <= now]
+            if len(available) == 0:
+                available = [min(self.endpoints, key=lambda endpoint: endpoint.disabled_until)]
+            if self.routing == "least_outstanding":
+                endpoint = min(available, key=lambda endpoint: (endpoint.outstanding + 1) / endpoint.weight)
+            else:
+                total_weight = sum(endpoint.weight for endpoint in available)
+                for candidate in available:
+                    candidate.current_weight += candidate.weight
+                endpoint = max(available, key=lambda endpoint: endpoint.current_weight)
+                endpoint.current_weight -= total_weight
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint, latency: float = None, error: bool = False, retry_after: float = None):
+        """
+        Records the outcome of a request sent to an endpoint.
+
+        :param latency: The time the request took in seconds, recorded for successful requests.
+        :param error: Whether the request failed.
+        :param retry_after: Delay requested by the endpoint (429 Retry-After), during which it is not used.
+        """
+        with self.lock:
+            now = time.monotonic()
+            endpoint.outstanding -= 1
+            endpoint.requests += 1
+            if not error:
+                endpoint.consecutive_errors = 0
+                if latency is not None:
+                    endpoint.latencies.append(latency)
+                return
+            endpoint.errors += 1
+            endpoint.consecutive_errors += 1
+            if retry_after is not None:
+                endpoint.disabled_until = max(endpoint.disabled_until, now + retry_after)
+            if endpoint.consecutive_errors >= self.error_threshold and len(self.endpoints) > 1:
+                cooldown = min(self.max_cooldown, self.cooldown * 2 ** (endpoint.consecutive_errors - self.error_threshold))
+                endpoint.disabled_until = max(endpoint.disabled_until, now + cooldown)
+                print(f"[WARN] Endpoint {endpoint.name} out of rotation for {cooldown:.0f} s after "
+                      f"{endpoint.consecutive_errors} consecutive errors")
+
+    def stats(self):
+        """
+        Returns the stats of every endpoint (see Endpoint.stats), by endpoint name.
+        """
+        with self.lock:
+            return {endpoint.name: endpoint.stats() for endpoint in self.endpoints}
+
+    def report(self):
+        """
+        Returns a line per endpoint with its request and error counts and latencies.
+        """
+        lines = []
+        for name, stats in self.stats().items():
+            if stats["mean_latency"] is None:
+                latency = "no successful requests"
+            else:
+                latency = (f"latency mean {stats['mean_latency']:.2f} s, p50 {stats['p50_latency']:.2f} s, "
+                           f"p95 {stats['p95_latency']:.2f} s")
+            lines.append(f"{name}: {stats['requests']} requests, {stats['errors']} errors, {latency}")
+        return "\n".join(lines)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return f"ClientPool(routing={self.routing}, endpoints=[{', '.join(endpoint.name for endpoint in self.endpoints)}])"
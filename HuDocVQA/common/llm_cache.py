@@ -0,0 +1,121 @@
+# common/llm_cache.py
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class CacheMissError(KeyError):
+    """Raised by a read-only (replay) cache when a request is not in the cache."""
+
+
+class LLMCache:
+    def __init__(self, path: str, max_size_bytes: int = None, read_only: bool = False):
+        """
+        Persistent, content-addressed cache of LLM responses stored in a SQLite file.
+
+        :param path: Path of the SQLite file, created if it does not exist.
+        :param max_size_bytes: Maximum total size of the cached responses. The least recently used
+                               responses are evicted when it is exceeded. None for no limit.
+        :param read_only: Replay mode: never write to the cache and raise CacheMissError on a miss.
+        """
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.total_size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, messages, temperature=None, max_tokens=None, sample_id=None):
+        """
+        Returns the cache key of a request.
+
+        :param sample_id: Distinguishes several sampled completions of the same request (temperature > 0).
+        """
+        request = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "sample_id": sample_id,
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached response for `key`, or None if it is not cached.
+        Raises CacheMissError instead of returning None in read-only mode.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.read_only:
+                    raise CacheMissError(f"Request {key} is not in the read-only LLM cache {self.path}")
+                return None
+            self.hits += 1
+            if not self.read_only:
+                with self.conn:
+                    self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def set(self, key, response):
+        """
+        Stores `response` under `key`, evicting the least recently used responses if the cache is full.
+        """
+        if self.read_only:
+            return
+        size = len(response.encode("utf-8"))
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.total_size -= row[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self.total_size += size
+            if self.max_size_bytes is not None:
+                self._evict()
+
+    def _evict(self):
+        while self.total_size > self.max_size_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 100"
+            ).fetchall()
+            if len(rows) == 0:
+                break
+            for key, size in rows:
+                if self.total_size <= self.max_size_bytes:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_size -= size
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def __str__(self):
+        return f"LLMCache(path={self.path}, read_only={self.read_only})"
+
+    def __getstate__(self):
+        # SQLite connections can not be pickled, reconnect in the unpickled copy
+        state = self.__dict__.copy()
+        del state["conn"]
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
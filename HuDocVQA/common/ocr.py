@@ -0,0 +1,105 @@
+# common/ocr.py
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+from PIL import Image
+
+
+def available_cores():
+    """
+    Returns the number of cores this process may run on.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def image_bytes(image):
+    """
+    Returns the encoded bytes of an image given as a PIL image or as the {"bytes", "path"} dictionary of a
+    datasets Image feature with decode=False.
+    """
+    if isinstance(image, dict):
+        if image.get("bytes") is not None:
+            return image["bytes"]
+        with open(image["path"], "rb") as f:
+            return f.read()
+    buffer = io.BytesIO()
+    image.save(buffer, format=image.format or "PNG")
+    return buffer.getvalue()
+
+
+def ocr_key(data: bytes, lang: str):
+    """
+    Returns the cache key of the OCR of an encoded image: the hash of its content and of the OCR language.
+    """
+    return hashlib.sha256(lang.encode("utf-8") + b"\0" + data).hexdigest()
+
+
+def init_ocr_worker():
+    # Tesseract's own threads would oversubscribe the cores the process pool already uses
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def ocr_image(data: bytes, lang: str = "hun"):
+    """
+    Runs Tesseract on an encoded image. Top-level so it can be sent to worker processes.
+    """
+    # Imported here so the other helpers can be used without pytesseract (e.g. by data_cleaning)
+    import pytesseract
+    with Image.open(io.BytesIO(data)) as image:
+        return pytesseract.image_to_string(image, lang=lang)
+
+
+class OCRCache:
+    def __init__(self, path: str):
+        """
+        Persistent cache of OCR results stored in a SQLite file, keyed by image content hash and language
+        (see ocr_key), so the same page is never run through Tesseract twice.
+
+        :param path: Path of the SQLite file, created if it does not exist.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS ocr (key TEXT PRIMARY KEY, text TEXT NOT NULL)")
+
+    def get(self, key):
+        """
+        Returns the cached OCR text for `key`, or None if it is not cached.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT text FROM ocr WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def set(self, key, text):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO ocr (key, text) VALUES (?, ?)", (key, text))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM ocr").fetchone()[0]
+
+    def __str__(self):
+        return f"OCRCache(path={self.path})"
+
+    def __getstate__(self):
+        # SQLite connections can not be pickled, reconnect in the unpickled copy
+        state = self.__dict__.copy()
+        del state["conn"]
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
@@ -0,0 +1,80 @@
+# common/sharded_writer.py
+import os
+from datasets import Features
+from datasets.arrow_writer import ArrowWriter
+
+
+class ShardedArrowWriter:
+    def __init__(self, output_dir: str, features: Features, shard_size: int = 10000, prefix: str = "shard",
+                 start_shard: int = 0):
+        """
+        Writes rows to a directory of Arrow shard files as they are produced, so only the rows of the current
+        batch are held in memory. A new shard is started every shard_size rows.
+
+        The shards can be loaded with `datasets.load_dataset("arrow", data_files=f"{output_dir}/*.arrow")`.
+
+        :param output_dir: The directory the shards are written to. Created on the first write.
+        :param features: The features of the rows, used to encode them (e.g. image bytes).
+        :param shard_size: Maximum number of rows per shard.
+        :param prefix: File name prefix of the shards.
+        :param start_shard: Number of the first shard, to append shards to an existing directory.
+        """
+        self.output_dir = output_dir
+        self.features = features
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.start_shard = start_shard
+        self.num_shards = 0
+        self.num_rows = 0
+        self.writer = None
+        self.current_path = None
+        self.rows_in_shard = 0
+
+    def _open_shard(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.current_path = self.shard_path(self.start_shard + self.num_shards)
+        self.writer = ArrowWriter(features=self.features, path=self.current_path)
+        self.num_shards += 1
+        self.rows_in_shard = 0
+
+    def shard_path(self, shard: int):
+        return os.path.join(self.output_dir, f"{self.prefix}-{shard:05d}.arrow")
+
+    def write_batch(self, batch: dict):
+        """
+        Writes a batch of rows, given as a dictionary mapping column names to lists of values.
+        """
+        num_rows = len(next(iter(batch.values()))) if batch else 0
+        start = 0
+        while start < num_rows:
+            if self.writer is None or self.rows_in_shard >= self.shard_size:
+                self.close_shard()
+                self._open_shard()
+            end = min(num_rows, start + self.shard_size - self.rows_in_shard)
+            rows = {column: values[start:end] for column, values in batch.items()}
+            self.writer.write_batch(self.features.encode_batch(rows))
+            self.rows_in_shard += end - start
+            self.num_rows += end - start
+            start = end
+
+    def close_shard(self):
+        """
+        Finalizes the current shard, if any.
+
+        :return: The path of the finalized shard, or None.
+        """
+        if self.writer is None:
+            return None
+        self.writer.finalize()
+        self.writer.close()
+        self.writer = None
+        return self.current_path
+
+    def close(self):
+        self.close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,19 +1,44 @@
 # filters/base_filter.py
 from abc import ABC, abstractmethod
-from datasets import Dataset
+from datasets import Dataset, DatasetDict, concatenate_datasets, load_from_disk
+from datasets.table import InMemoryTable, concat_tables
 import os
+import shutil
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import matplotlib.pyplot as plt
+from .histogram import StreamingHistogram
 
 class Filter(ABC):
+    # Columns read by filter_example and columns it may update. Only these columns are
+    # passed to the filter, all other columns (e.g. 'image') are never decoded and are
+    # joined back untouched. None means the filter sees and may update the full row.
+    input_columns = None
+    output_columns = None
+    # Whether the filter can be run in several worker processes (num_proc > 1).
+    supports_multiprocessing = True
+    # Whether the filter decides on every batch independently, so it can run on a stream of
+    # batches with apply_batch. Filters that need a pass over the whole dataset first cannot.
+    supports_streaming = True
+    # Whether the filter may be reordered with the filters around it when its columns allow it (see
+    # conflicts_with). Filters that must keep their position in the chain set this to False.
+    commutative = True
+    # Whether the filter only updates the questions by keeping or dropping every question on its own,
+    # from the question and its document. Such filters commute although they update the same columns.
+    per_question_selection = False
+
     def __init__(self):
         """
         Initialize the ResolutionFilter with the minimum resolution requirements.
     :param min_width: The minimum width for the image.
         :param min_height: The minimum height for the image.
         """
-        self.hist_list = []
+        # Distribution of numeric filter values, in bounded memory (see StreamingHistogram)
+        self.histogram = StreamingHistogram()
         self.hist_counts = {}
+        # Per split counts of the last apply call, see split_stats
+        self.stats = {}
 
     @abstractmethod
     def add_to_histogram(self, vals):
@@ -21,9 +46,9 @@ class Filter(ABC):
 
     def plot_histogram(self, output_figure_path):
         """
-        Plot a histogram based on self.hist_list or self.hist_counts.
+        Plot a histogram based on self.histogram or self.hist_counts.
 
-        If self.hist_list is defined, plots a histogram of the distribution of the values
+        If self.histogram has values, plots a histogram of the distribution of the values
         (y-axis as likelihood and x-axis as value). Outliers are excluded for better visualization.
         If self.hist_counts is defined, plots a bar chart with keys as x-axis and counts as y-axis.
 
@@ -31,21 +56,18 @@ class Filter(ABC):
 
         :param output_figure_path: Path to save the figure.
         """
-        if len(self.hist_list) > 0:
-            # Plot histogram of self.hist_list
-            values = np.array(self.hist_list)
-
-            # Exclude outliers (e.g., values beyond 1.5 * IQR)
-            q1 = np.percentile(values, 25)
-            q3 = np.percentile(values, 75)
+        if len(self.histogram) > 0:
+            # Exclude outliers (e.g., values beyond 1.5 * IQR), with the quantiles of the streaming histogram
+            q1 = self.histogram.quantile(0.25)
+            q3 = self.histogram.quantile(0.75)
             iqr = q3 - q1
             lower_bound = q1 - 1.5 * iqr
             upper_bound = q3 + 1.5 * iqr
-            filtered_values = values[(values >= lower_bound) & (values <= upper_bound)]
+            counts, edges = self.histogram.histogram(bins=30, value_range=(lower_bound, upper_bound))
 
             # Plot normalized histogram
             plt.figure(figsize=(8, 6))
-            plt.hist(filtered_values, bins=30, density=True, alpha=0.7, color='skyblue', edgecolor='black')
+            plt.hist(edges[:-1], bins=edges, weights=counts, density=True, alpha=0.7, color='skyblue', edgecolor='black')
             plt.xlabel('Value')
             plt.ylabel('Likelihood')
             plt.title('Histogram of Values')
@@ -86,33 +108,304 @@ class Filter(ABC):
         pass
 
 
-    def apply(self, dataset: Dataset) -> (Dataset, Dataset):
+    def filter_batch(self, examples):
+        """
+        Return the updated version of a batch of examples, their filter values, and which ones should be filtered out.
+        Filters can override this to process a whole batch at once, by default filter_example is called on every example.
+
+        :param examples: A dictionary mapping column names to lists of values.
+        :return: The updated batch, the list of filter values and the list of removal flags.
+        """
+        return self.map_examples(examples, self.filter_example)
+
+    def map_examples(self, examples, function, *args):
+        """
+        Calls function(example, *extra_args) on every example of a batch and collects the results.
+
+        :param examples: A dictionary mapping column names to lists of values.
+        :param function: A function returning the updated example, its filter value and its removal flag.
+        :param args: Lists holding one extra argument per example.
+        :return: The updated batch, the list of filter values and the list of removal flags.
+        """
+        columns = list(examples.keys())
+        num_examples = len(examples[columns[0]]) if columns else 0
+        updated_examples = {column: [] for column in columns}
+        values = []
+        removed = []
+        for idx in range(num_examples):
+            example = {column: examples[column][idx] for column in columns}
+            updated_example, value, remove = function(example, *[arg[idx] for arg in args])
+            for column in columns:
+                updated_examples[column].append(updated_example[column])
+            values.append(value)
+            removed.append(remove)
+        return updated_examples, values, removed
+
+    def apply(self, dataset: Dataset, num_proc: int = None, batch_size: int = 1000,
+              checkpoint_dir: str = None, checkpoint_shard_size: int = None) -> (Dataset, Dataset):
         """
         Applies the filter to the dataset and returns the filtered and remaining datasets.
+
+        The keep/remove decision for every row is computed in a single map pass over the
+        columns declared in input_columns. The updated output_columns are joined back to
+        the other, untouched columns by row index, and the 'remaining' and 'removed'
+        groups are built by selecting row indices, so no image bytes are rewritten.
+
+        :param dataset: The Dataset or DatasetDict to filter.
+        :param num_proc: Number of worker processes, ignored if the filter does not support multiprocessing.
+        :param batch_size: Number of examples passed to filter_batch at once.
+        :param checkpoint_dir: Optional directory where the filter output (only the updated columns) is saved in
+                               shards. Shards that already exist there are loaded instead of being recomputed.
+        :param checkpoint_shard_size: Number of rows per checkpoint shard. Defaults to one shard per split.
         """
         print(f"Filtering with {str(self)}")
-        
+        self.stats = {}
+        if isinstance(dataset, DatasetDict):
+            remaining_group, removed_group = DatasetDict(), DatasetDict()
+            for split in dataset:
+                split_checkpoint_dir = os.path.join(checkpoint_dir, split) if checkpoint_dir is not None else None
+                remaining_group[split], removed_group[split] = self._apply_split(
+                    dataset[split], num_proc, batch_size, split_checkpoint_dir, checkpoint_shard_size, split
+                )
+            return remaining_group, removed_group
+        return self._apply_split(dataset, num_proc, batch_size, checkpoint_dir, checkpoint_shard_size)
+
+    def _apply_split(self, dataset: Dataset, num_proc: int = None, batch_size: int = 1000,
+                     checkpoint_dir: str = None, checkpoint_shard_size: int = None,
+                     split_name: str = "dataset") -> (Dataset, Dataset):
+        """
+        Applies the filter to a single dataset split, recording its counts in self.stats[split_name].
+        """
+        if len(dataset) == 0:
+            self.stats[split_name] = self.split_stats(dataset, dataset, [])
+            return dataset, dataset
+
+        dataset_split, output_columns = self._map_split(dataset, num_proc, batch_size, checkpoint_dir, checkpoint_shard_size)
+
+        # Update the histogram here rather than inside the map function, which may run in worker processes.
+        # The filter values are read in batches so they are never all held in memory.
+        for batch in dataset_split.select_columns(['filter_value']).iter(batch_size=batch_size):
+            for hist_values in batch['filter_value']:
+                self.add_to_histogram(hist_values)
+        self.stats[split_name] = self.split_stats(dataset, dataset_split, output_columns)
+
+        dataset_split = self.join_columns(dataset, dataset_split)
+
+        # Partition the 'remaining' and 'removed' groups by index selection
+        return self.partition(dataset_split)
+
+    def extra_columns(self):
+        """
+        Names of additional columns returned by filter_batch that are kept in the filter output.
+        """
+        return []
+
+    def _map_split(self, dataset: Dataset, num_proc: int = None, batch_size: int = 1000,
+                   checkpoint_dir: str = None, checkpoint_shard_size: int = None):
+        """
+        Runs filter_batch over the projected input columns of a split in a single map pass.
+
+        :return: The filter output, with the updated output columns, the extra columns, 'filter_value'
+                 and 'split', and the names of the updated output columns.
+        """
+        if self.input_columns is None:
+            input_columns = dataset.column_names
+            output_columns = dataset.column_names
+        else:
+            input_columns = [column for column in self.input_columns if column in dataset.column_names]
+            output_columns = [column for column in self.output_columns if column in input_columns]
+        extra_columns = self.extra_columns()
+
         # Create a map function to add a 'split' key
-        def split_function(example):
-            # iterate through the questions if the filter requires it
-            updated_example, hist_values, removed = self.filter_example(example)
-            self.add_to_histogram(hist_values)
-            updated_example['filter_value'] = hist_values
-            if removed:  # Example should be removed
-                updated_example['split'] = 'removed'
-            else:  # Example should be kept
-                updated_example['split'] = 'remaining'
-
-            return updated_example
-           
-        # Apply the map function
-        dataset_split = dataset.map(split_function, load_from_cache_file=False)
-        
-        # Filter out the 'removed' and 'remaining' groups
-        removed_group = dataset_split.filter(lambda x: x['split'] == 'removed')
-        remaining_group = dataset_split.filter(lambda x: x['split'] == 'remaining')
+        def split_function(examples):
+            updated_examples, hist_values, removed = self.filter_batch(examples)
+            updated_examples = {column: updated_examples[column] for column in output_columns + extra_columns}
+            updated_examples['filter_value'] = hist_values
+            updated_examples['split'] = ['removed' if remove else 'remaining' for remove in removed]
+            return updated_examples
+
+        # Apply the map function to the projected columns only
+        projected = dataset.select_columns(input_columns)
+        map_kwargs = dict(
+            batched=True,
+            batch_size=batch_size,
+            num_proc=num_proc if self.supports_multiprocessing else None,
+            remove_columns=input_columns,
+            load_from_cache_file=False,
+        )
+        if checkpoint_dir is None:
+            dataset_split = projected.map(split_function, **map_kwargs)
+        else:
+            dataset_split = self._map_with_checkpoints(projected, split_function, map_kwargs, checkpoint_dir, checkpoint_shard_size)
+        return dataset_split, output_columns
+
+    def conflicts_with(self, other) -> bool:
+        """
+        Returns whether running this filter before or after `other` can change the result, because one of
+        them updates columns the other reads, or one of them is not commutative.
+        """
+        if not (self.commutative and other.commutative and self.supports_streaming and other.supports_streaming):
+            return True
+        if self.input_columns is None or other.input_columns is None:
+            return True
+        shared = (set(self.output_columns) & set(other.input_columns)) | (set(other.output_columns) & set(self.input_columns))
+        if self.per_question_selection and other.per_question_selection:
+            shared -= {"questions", "answers"}
+        return len(shared) > 0
+
+    def stages(self, remaining_dataset, removed_dataset, filter_time):
+        """
+        Returns (filter, remaining dataset, removed dataset, filter time) for every filter stage of the last
+        apply call, for reporting. A filter that evaluates several filters reports each of them.
+        """
+        return [(self, remaining_dataset, removed_dataset, filter_time)]
 
-        return remaining_group, removed_group
+    def _map_with_checkpoints(self, projected, function, map_kwargs, checkpoint_dir, shard_size=None):
+        """
+        Maps the projected dataset shard by shard, saving every mapped shard to checkpoint_dir.
+        Shards saved by a previous (interrupted) run are loaded instead of being mapped again.
+        """
+        shard_size = shard_size or len(projected)
+        num_shards = (len(projected) + shard_size - 1) // shard_size
+        shards = []
+        for shard_idx in range(num_shards):
+            shard_path = os.path.join(checkpoint_dir, f"shard_{shard_idx:05d}_of_{num_shards:05d}")
+            if os.path.exists(shard_path):
+                shards.append(load_from_disk(shard_path))
+                continue
+            start = shard_idx * shard_size
+            shard = projected.select(range(start, min(start + shard_size, len(projected)))).map(function, **map_kwargs)
+            # Save to a temporary path first, so an interrupted save is never mistaken for a finished shard
+            tmp_path = shard_path + ".tmp"
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+            shard.save_to_disk(tmp_path)
+            os.replace(tmp_path, shard_path)
+            shards.append(load_from_disk(shard_path))
+            print(f"Saved checkpoint shard {shard_idx + 1}/{num_shards} to {shard_path}")
+        return concatenate_datasets(shards)
+
+    def apply_batch(self, examples: dict, split_name: str = "dataset") -> (dict, dict):
+        """
+        Applies the filter to a batch of rows held in memory, e.g. in streaming mode, and adds the
+        batch to the histogram and to the counts in self.stats[split_name].
+
+        :param examples: A dictionary mapping every column name to a list of values.
+        :return: The kept rows and the removed rows, as dictionaries mapping column names to lists.
+        """
+        if self.input_columns is None:
+            input_columns = list(examples.keys())
+            output_columns = input_columns
+        else:
+            input_columns = [column for column in self.input_columns if column in examples]
+            output_columns = [column for column in self.output_columns if column in input_columns]
+
+        questions_in = sum(len(questions or []) for questions in examples.get("questions", []))
+        updated_examples, hist_values, removed = self.filter_batch({column: examples[column] for column in input_columns})
+        for value in hist_values:
+            self.add_to_histogram(value)
+        examples = {**examples, **{column: updated_examples[column] for column in output_columns}}
+
+        removed = np.asarray(removed, dtype=bool)
+        kept_indices = np.flatnonzero(~removed)
+        removed_indices = np.flatnonzero(removed)
+        kept_examples = {column: [values[idx] for idx in kept_indices] for column, values in examples.items()}
+        removed_examples = {column: [values[idx] for idx in removed_indices] for column, values in examples.items()}
+
+        stats = self.stats.setdefault(split_name, {"rows_in": 0, "rows_kept": 0, "questions_in": 0,
+                                                   "questions_kept": 0, "length_mismatches": 0})
+        stats["rows_in"] += len(removed)
+        stats["rows_kept"] += len(kept_indices)
+        stats["questions_in"] += questions_in
+        if "questions" in examples:
+            kept_questions = [len(questions or []) for questions in kept_examples["questions"]]
+            stats["questions_kept"] += sum(kept_questions)
+            if "answers" in examples:
+                kept_answers = [len(answers or []) for answers in kept_examples["answers"]]
+                stats["length_mismatches"] += sum(q != a for q, a in zip(kept_questions, kept_answers))
+        return kept_examples, removed_examples
+
+    @staticmethod
+    def list_lengths(dataset: Dataset, column: str):
+        """
+        Returns the lengths of the lists in a list column as a NumPy array (0 for nulls),
+        computed on the Arrow data without materializing any rows.
+        """
+        values = dataset.with_format("arrow")[column] if len(dataset) > 0 else pa.array([], type=pa.list_(pa.string()))
+        return pc.fill_null(pc.list_value_length(values), 0).to_numpy(zero_copy_only=False).astype(np.int64)
+
+    def split_stats(self, dataset: Dataset, mapped: Dataset, output_columns) -> dict:
+        """
+        Counts the rows and questions of a split before and after filtering, from the filter output of the split.
+
+        :param dataset: The split the filter was applied to.
+        :param mapped: The filter output, with the updated output_columns and the 'split' column.
+        :param output_columns: The columns the filter updated. Other columns are counted on the input.
+        :return: A dictionary with the number of rows and questions in the input and kept, and the number
+                 of kept rows whose numbers of questions and answers differ.
+        """
+        if len(dataset) == 0 or "questions" not in dataset.column_names:
+            return {"rows_in": len(dataset), "rows_kept": len(dataset), "questions_in": 0,
+                    "questions_kept": 0, "length_mismatches": 0}
+        kept = ~pc.equal(mapped.with_format("arrow")["split"], "removed").to_numpy(zero_copy_only=False)
+        questions_in = self.list_lengths(dataset, "questions")
+        questions_out = self.list_lengths(mapped, "questions") if "questions" in output_columns else questions_in
+        stats = {
+            "rows_in": len(dataset),
+            "rows_kept": int(kept.sum()),
+            "questions_in": int(questions_in.sum()),
+            "questions_kept": int(questions_out[kept].sum()),
+            "length_mismatches": 0,
+        }
+        if "answers" in dataset.column_names:
+            answers_out = self.list_lengths(mapped if "answers" in output_columns else dataset, "answers")
+            stats["length_mismatches"] = int(((questions_out != answers_out) & kept).sum())
+        return stats
+
+    @staticmethod
+    def join_columns(dataset: Dataset, columns: Dataset) -> Dataset:
+        """
+        Adds the columns of `columns` to `dataset`, replacing columns with the same name.
+
+        `columns` must have one row per row of `dataset`, in the same order. If `dataset` is
+        an index selection of a larger table, the new columns are scattered onto the rows of
+        that table instead of flattening it, so the untouched columns are never rewritten.
+
+        :param dataset: The dataset to add the columns to.
+        :param columns: A dataset with the new columns, aligned with the rows of `dataset`.
+        :return: The joined dataset.
+        """
+        base = dataset.remove_columns([column for column in columns.column_names if column in dataset.column_names])
+        new_table = columns.with_format("arrow")[:]
+        table = base.data
+        if base._indices is not None:
+            # Map every row of the underlying table to its position in `columns` (null if not selected)
+            indices = base._indices.column(0).to_numpy()
+            positions = np.full(len(table), -1, dtype=np.int64)
+            positions[indices] = np.arange(len(indices))
+            new_table = new_table.take(pa.array(positions, mask=positions < 0))
+        # Concatenated horizontally like Dataset.add_column, which works for in-memory, memory-mapped and
+        # concatenated (e.g. by concatenate_datasets) tables alike and keeps the memory-mapped blocks
+        table = concat_tables([table, InMemoryTable(new_table)], axis=1)
+
+        info = base.info.copy()
+        info.features = base.features.copy()
+        info.features.update(columns.features)
+        return Dataset(table, info=info, split=base.split, indices_table=base._indices)
+
+    @staticmethod
+    def partition(dataset: Dataset) -> (Dataset, Dataset):
+        """
+        Splits a dataset tagged with a 'split' column into its remaining and removed rows.
+
+        :param dataset: A dataset with a 'split' column holding 'remaining' or 'removed'.
+        :return: The remaining and removed datasets, as index selections of the input.
+        """
+        split_column = dataset.with_format("arrow")["split"]
+        removed_mask = pc.equal(split_column, "removed").to_numpy(zero_copy_only=False)
+        remaining_indices = np.flatnonzero(~removed_mask)
+        removed_indices = np.flatnonzero(removed_mask)
+        return dataset.select(remaining_indices), dataset.select(removed_indices)
 
     def filter_answers(self, orig_questions, orig_answers, new_questions):
         """
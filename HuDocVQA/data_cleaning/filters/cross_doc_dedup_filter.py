@@ -0,0 +1,161 @@
+# filters/cross_doc_dedup_filter.py
+from .base_filter import Filter
+from .minhash import MinHasher, connected_components, exact_hash, ngram_hashes, normalize_question
+from datasets import Dataset, DatasetDict
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+class CrossDocDedupFilter(Filter):
+    input_columns = ["questions", "answers", "question_keep", "question_cluster_size"]
+    output_columns = ["questions", "answers"]
+    # The question index is built over all splits before any row is filtered
+    supports_streaming = False
+
+    def __init__(self, max_copies: int = 1, n_gram: int = 3, num_perm: int = 64, bands: int = 16,
+                 chunk_size: int = 1000, seed: int = 0):
+        """
+        Deduplicates questions across all documents of all splits. Questions are grouped into clusters of exact
+        duplicates and MinHash LSH near-duplicates, and only the first max_copies questions of every cluster
+        (in split, row and question order) are kept.
+
+        The index is held in memory and grows linearly with the number of questions N of the corpus: the exact
+        hash and band keys of every question and, while clustering, the sort order and group starts of every
+        key array, about 24 * (bands + 1) bytes per question at peak (some 400 bytes with the default 16 bands,
+        so about 4 GB for 10 million questions). Only the hashing is bounded by chunk_size. The questions
+        themselves are read from the (memory-mapped) dataset and not copied, unless a split is an index
+        selection, in which case its questions column is materialized.
+
+        :param max_copies: Maximum number of occurrences kept per cluster of (near-)duplicate questions.
+        :param n_gram: Size of the character n-grams the MinHash signatures are computed from.
+        :param num_perm: Length of the MinHash signatures.
+        :param bands: Number of LSH bands. More bands find pairs with lower similarity.
+        :param chunk_size: Number of questions hashed at once, which bounds the memory used for hashing (not
+                           for the index, see above).
+        :param seed: Seed of the MinHash permutations.
+        """
+        super().__init__()
+        self.max_copies = max_copies
+        self.n_gram = n_gram
+        self.chunk_size = chunk_size
+        self.minhasher = MinHasher(num_perm=num_perm, bands=bands, seed=seed)
+
+    def add_to_histogram(self, cluster_sizes):
+        # Bucket cluster sizes by powers of two, counted once per question
+        for size in cluster_sizes:
+            lower = 1 << (int(size).bit_length() - 1)
+            key = str(lower) if lower == 1 else f"{lower}-{2 * lower - 1}"
+            self.hist_counts[key] = self.hist_counts.get(key, 0) + 1
+
+    def _split_questions(self, dataset: Dataset):
+        """
+        Returns the flattened questions of a split and the offsets of every row into them. The chunks of the
+        questions column are flattened as they are, without combining them into one in-memory array.
+        """
+        questions = dataset.with_format("arrow")["questions"]
+        lengths = pc.fill_null(pc.list_value_length(questions), 0).to_numpy(zero_copy_only=False)
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32)
+        return pc.list_flatten(questions), offsets
+
+    def build_index(self, dataset: DatasetDict):
+        """
+        Clusters the questions of all splits and decides which questions to keep.
+
+        :return: Per split, the keep flags and cluster sizes of its flattened questions and the row offsets.
+        """
+        splits = list(dataset.keys())
+        split_questions = {split: self._split_questions(dataset[split]) for split in splits}
+        num_questions = sum(len(questions) for questions, _ in split_questions.values())
+
+        # Compact index: one exact hash and one key per LSH band for every question
+        exact_hashes = np.empty(num_questions, dtype=np.uint64)
+        band_keys = np.empty((num_questions, self.minhasher.bands), dtype=np.uint64)
+        position = 0
+        for split in splits:
+            questions, _ = split_questions[split]
+            for start in range(0, len(questions), self.chunk_size):
+                chunk = [normalize_question(question or "") for question in questions.slice(start, self.chunk_size).to_pylist()]
+                end = position + len(chunk)
+                exact_hashes[position:end] = [exact_hash(question) for question in chunk]
+                # Questions shorter than one n-gram are only matched exactly
+                signatures = self.minhasher.signatures([ngram_hashes(question, self.n_gram) for question in chunk])
+                keys = self.minhasher.band_keys(signatures)
+                short = np.array([len(question.replace(" ", "")) < self.n_gram for question in chunk], dtype=bool)
+                keys[short] = exact_hashes[position:end][short, None]
+                band_keys[position:end] = keys
+                position = end
+
+        labels = connected_components([exact_hashes] + [band_keys[:, band] for band in range(band_keys.shape[1])], num_questions)
+        del band_keys
+
+        # Rank of every question among the questions of its cluster, in corpus order
+        cluster_sizes = np.bincount(labels, minlength=num_questions)
+        order = np.lexsort((np.arange(num_questions), labels))
+        sorted_labels = labels[order]
+        starts = np.flatnonzero(np.concatenate([[True], sorted_labels[1:] != sorted_labels[:-1]]))
+        ranks = np.empty(num_questions, dtype=np.int64)
+        ranks[order] = np.arange(num_questions) - np.repeat(starts, np.diff(np.concatenate([starts, [num_questions]])))
+        keep = ranks < self.max_copies
+
+        self._report_clusters(labels, cluster_sizes, split_questions, splits)
+
+        index = {}
+        position = 0
+        for split in splits:
+            questions, offsets = split_questions[split]
+            end = position + len(questions)
+            index[split] = (keep[position:end], cluster_sizes[labels[position:end]], offsets)
+            position = end
+        return index
+
+    def _report_clusters(self, labels, cluster_sizes, split_questions, splits, top_k=10):
+        roots = np.flatnonzero(cluster_sizes > 1)
+        print(f"Found {len(roots)} clusters of duplicate questions covering {int(cluster_sizes[roots].sum())} questions")
+        # Look the printed questions up in their split instead of concatenating the questions of all splits
+        split_ends = np.cumsum([len(split_questions[split][0]) for split in splits])
+        for root in roots[np.argsort(-cluster_sizes[roots], kind="stable")][:top_k]:
+            split_index = int(np.searchsorted(split_ends, root, side="right"))
+            position = int(root) - (int(split_ends[split_index - 1]) if split_index > 0 else 0)
+            print(f"  {cluster_sizes[root]} x {split_questions[splits[split_index]][0][position].as_py()!r}")
+
+    def apply(self, dataset, num_proc: int = None, batch_size: int = 1000,
+              checkpoint_dir: str = None, checkpoint_shard_size: int = None):
+        """
+        Builds the question index over all splits, then filters every split with it.
+        """
+        is_dict = isinstance(dataset, DatasetDict)
+        splits = dataset if is_dict else DatasetDict({"dataset": dataset})
+        index = self.build_index(splits)
+
+        annotated = DatasetDict()
+        for split in splits:
+            keep, cluster_sizes, offsets = index[split]
+            offsets = pa.array(offsets, type=pa.int32())
+            columns = Dataset(pa.table({
+                "question_keep": pa.ListArray.from_arrays(offsets, pa.array(keep, type=pa.bool_())),
+                "question_cluster_size": pa.ListArray.from_arrays(offsets, pa.array(cluster_sizes, type=pa.int64())),
+            }))
+            annotated[split] = self.join_columns(splits[split], columns)
+
+        remaining, removed = super().apply(annotated, num_proc=num_proc, batch_size=batch_size,
+                                           checkpoint_dir=checkpoint_dir, checkpoint_shard_size=checkpoint_shard_size)
+        remaining = remaining.remove_columns(["question_keep", "question_cluster_size"])
+        removed = removed.remove_columns(["question_keep", "question_cluster_size"])
+        if not is_dict:
+            return remaining["dataset"], removed["dataset"]
+        return remaining, removed
+
+    def filter_example(self, example):
+        """Keep the questions of the example that are among the first max_copies of their cluster."""
+        orig_questions = example['questions']
+        orig_answers = example['answers']
+        questions = [question for question, keep in zip(orig_questions, example['question_keep']) if keep]
+
+        answers = self.filter_answers(orig_questions, orig_answers, questions)
+        example['questions'] = questions
+        example['answers'] = answers
+
+        return example, example['question_cluster_size'], len(questions) == 0
+
+    def __str__(self):
+        return f"CrossDocDedupFilter(max_copies={self.max_copies}, n_gram={self.n_gram})"
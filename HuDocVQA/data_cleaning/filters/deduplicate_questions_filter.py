@@ -1,21 +1,60 @@
 # filters/text_length_filter.py
 from .base_filter import Filter
-from openai import OpenAI
+from common.async_llm import AsyncLLMEngine
+from common.client_pool import ClientPool, Endpoint
 import ast 
+import json
 import time
 
 class DedupQuestionsFilter(Filter):
-    def __init__(self, model: str, api_key: str):
+    input_columns = ["questions", "answers"]
+    output_columns = ["questions", "answers"]
+    # API calls are rate limited per key, so they are not spread over worker processes
+    supports_multiprocessing = False
+    # Rewrites the questions with an LLM and is too expensive to profile, so it keeps its position
+    commutative = False
+    # Smallest answer budget (max_tokens) of a batched request, reserved by pack_batches
+    min_answer_tokens = 256
+
+    def __init__(self, model: str, api_key: str, base_url: str = "https://api.sambanova.ai/v1",
+                 async_mode: bool = False, max_concurrency: int = 8, requests_per_second: float = None,
+                 cache=None, pool=None, max_batch_documents: int = None, context_length: int = 8192):
+        """
+        :param model: The model used for deduplication.
+        :param api_key: The API key.
+        :param base_url: The base URL of the OpenAI-compatible API.
+        :param async_mode: Send the requests of a batch concurrently instead of one blocking call per example.
+        :param max_concurrency: Maximum number of requests in flight in async mode.
+        :param requests_per_second: Request rate limit in async mode, None for no limit.
+        :param cache: Optional LLMCache, prompts already in the cache are not sent to the API again.
+        :param pool: Optional ClientPool spreading the requests over several endpoints and keys, in both modes.
+                     Defaults to a pool of the single endpoint given by base_url and api_key.
+        :param max_batch_documents: Batched mode: pack the question lists of up to this many documents into one
+                                    prompt answered with a JSON object keyed by document ID, see
+                                    deduplicate_lists_batched. None for one request per document.
+        :param context_length: Context length of the model in tokens, bounding the size of a batched prompt
+                               and its answer.
+        """
         super().__init__()
-        self.client = OpenAI(
-            api_key=api_key,
-            base_url="https://api.sambanova.ai/v1",
-        )
+        self.pool = pool if pool is not None else ClientPool([Endpoint(base_url, api_key)])
         self.model = model 
         self.api_key = api_key
+        self.async_mode = async_mode
+        self.cache = cache
+        self.max_batch_documents = max_batch_documents
+        self.context_length = context_length
+        self.engine = AsyncLLMEngine(
+            model=model,
+            api_key=api_key,
+            base_url=base_url,
+            max_concurrency=max_concurrency,
+            requests_per_second=requests_per_second,
+            cache=cache,
+            pool=self.pool,
+        )
 
     def add_to_histogram(self, value):
-        self.hist_list.append(value)
+        self.histogram.add(value)
         
     def extract_list_from_string(self, input_string):
         """
@@ -40,47 +79,215 @@ class DedupQuestionsFilter(Filter):
         except (ValueError, SyntaxError):
             return None  # Return None if there's a syntax issue
 
-    def query_llm(self, prompt, rec=0):
+    def query_llm(self, prompt, max_tokens=1024):
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(self.model, [{"role": "user", "content": prompt}], temperature=0, max_tokens=max_tokens)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        completion = self.request_llm(prompt, max_tokens=max_tokens)
+        if self.cache is not None:
+            self.cache.set(key, completion)
+        return completion
+
+    def query_llm_all(self, prompts, max_tokens_list):
+        """
+        Returns the completions of several prompts, sent concurrently in async mode and one by one otherwise.
+        """
+        if not self.async_mode:
+            return [self.query_llm(prompt, max_tokens) for prompt, max_tokens in zip(prompts, max_tokens_list)]
+        return self.engine.run_all([[{"role": "user", "content": prompt}] for prompt in prompts],
+                                   kwargs_list=[{"max_tokens": max_tokens} for max_tokens in max_tokens_list],
+                                   temperature=0)
+
+    def request_llm(self, prompt, rec=0, max_tokens=1024):
         time.sleep(2)
         if rec == 20:
             raise ValueError("Too many API fails")
+        endpoint = self.pool.acquire()
+        start_time = time.monotonic()
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                max_tokens=1024,
+            response = endpoint.client().chat.completions.create(
+                model=endpoint.model or self.model,
+                max_tokens=max_tokens,
                 temperature=0,
                 messages=[{"role": "user", "content": prompt}]
             )
             if response is None or response.choices is None:
+                self.pool.release(endpoint, error=True)
                 print(f"[WARN] Empty response or missing choices. Retrying ({rec+1}/20)...")
                 time.sleep(10)
-                return self.query_llm(prompt, rec+1)
+                return self.request_llm(prompt, rec+1, max_tokens)
         except Exception as e:
-            print(f"[ERROR] Exception during API call (attempt {rec+1}/20): {e.__class__.__name__}: {e}")
+            self.pool.release(endpoint, error=True)
+            print(f"[ERROR] Exception during API call to {endpoint.name} (attempt {rec+1}/20): {e.__class__.__name__}: {e}")
             time.sleep(10)
-            return self.query_llm(prompt, rec+1)
+            return self.request_llm(prompt, rec+1, max_tokens)
+        self.pool.release(endpoint, time.monotonic() - start_time)
         # Get the completion response
         completion = response.choices[0].message.content
         return completion
 
-    def deduplicate_list(self, questions):
-        if len(questions) <= 1:
-            return questions
-        prompt = f"Here is a list of questions, please deduplicate the list so that any if any pair of questions are the same, similar or paraphrases then remove them, and only return the deduplicated list. Please reply with a list of the deduplicated questions that is python list format, with no other text or code, just the python list. The deduplicated list must be a subset of original list, of less than or equal length. \nOriginal Question List: {str(questions)}\nDeduplicated Question List: "
-        response = self.query_llm(prompt)
+    def dedup_prompt(self, questions):
+        return f"Here is a list of questions, please deduplicate the list so that any if any pair of questions are the same, similar or paraphrases then remove them, and only return the deduplicated list. Please reply with a list of the deduplicated questions that is python list format, with no other text or code, just the python list. The deduplicated list must be a subset of original list, of less than or equal length. \nOriginal Question List: {str(questions)}\nDeduplicated Question List: "
+
+    def parse_dedup_response(self, questions, response):
         dedup_list = self.extract_list_from_string(response)
         if dedup_list is None or len(dedup_list) > len(questions):
             return questions
         return dedup_list
 
+    def deduplicate_list(self, questions):
+        if len(questions) <= 1:
+            return questions
+        response = self.query_llm(self.dedup_prompt(questions))
+        return self.parse_dedup_response(questions, response)
+
+    def deduplicate_lists(self, questions_list):
+        """
+        Deduplicates several question lists with concurrent requests, returned in the input order.
+        """
+        pending = [idx for idx, questions in enumerate(questions_list) if len(questions) > 1]
+        responses = self.engine.run_all(
+            [[{"role": "user", "content": self.dedup_prompt(questions_list[idx])}] for idx in pending],
+            max_tokens=1024,
+            temperature=0,
+        )
+        dedup_lists = list(questions_list)
+        for idx, response in zip(pending, responses):
+            dedup_lists[idx] = self.parse_dedup_response(questions_list[idx], response)
+        return dedup_lists
+
+    def batch_dedup_prompt(self, questions_by_id):
+        return ("Here are the question lists of several documents, keyed by document ID. For every document, please deduplicate its list so that if any pair of questions are the same, similar or paraphrases then only one of them is kept. "
+                "Every deduplicated list must be a subset of the document's original list, of less than or equal length. "
+                "Please reply with a JSON object mapping every document ID to its deduplicated list, with no other text or code, just the JSON object.\n"
+                f"DOCUMENTS: {json.dumps(questions_by_id, ensure_ascii=False)}\n"
+                "Deduplicated JSON: ")
+
+    @staticmethod
+    def estimate_tokens(text):
+        # Conservative for Hungarian text, which tokenizes into more tokens per character than English
+        return len(text) // 3 + 1
+
+    def parse_batch_dedup_response(self, questions_by_id, response):
+        """
+        Returns the deduplicated list of every document of a batch, or None if the response is not a JSON object
+        with a list of strings for every document ID.
+        """
+        start = response.find('{')
+        end = response.rfind('}')
+        if start == -1 or end == -1 or start > end:
+            return None
+        try:
+            parsed = json.loads(response[start:end + 1])
+        except ValueError:
+            return None
+        if not isinstance(parsed, dict):
+            return None
+        dedup_lists = {}
+        for doc_id, questions in questions_by_id.items():
+            dedup_list = parsed.get(doc_id)
+            if not isinstance(dedup_list, list) or not all(isinstance(question, str) for question in dedup_list):
+                return None
+            # Same rule as for a single document: a longer list is not a deduplication of the original one
+            dedup_lists[doc_id] = questions if len(dedup_list) > len(questions) else dedup_list
+        return dedup_lists
+
+    def pack_batches(self, indices, questions_list):
+        """
+        Groups the documents into batches of at most max_batch_documents whose prompt and expected answer (about
+        the size of the question lists, at least min_answer_tokens) fit in the context length.
+
+        :return: The batches and the documents that do not fit in a batch on their own.
+        """
+        header_tokens = self.estimate_tokens(self.batch_dedup_prompt({}))
+
+        def fits(tokens):
+            return header_tokens + tokens + max(tokens, self.min_answer_tokens) <= self.context_length
+
+        batches = []
+        oversized = []
+        batch = []
+        batch_tokens = 0
+        for idx in indices:
+            doc_tokens = self.estimate_tokens(json.dumps({str(idx): questions_list[idx]}, ensure_ascii=False))
+            if not fits(doc_tokens):
+                oversized.append(idx)
+                continue
+            if batch and (len(batch) >= self.max_batch_documents or not fits(batch_tokens + doc_tokens)):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(idx)
+            batch_tokens += doc_tokens
+        if batch:
+            batches.append(batch)
+        return batches, oversized
+
+    def deduplicate_lists_batched(self, questions_list):
+        """
+        Deduplicates several question lists with one request per batch of documents (see pack_batches). The
+        documents of a batch whose answer can not be parsed are split in two batches and sent again, and a
+        document that fails on its own or does not fit in a batch falls back to the single document prompt.
+        Returned in the input order.
+        """
+        dedup_lists = list(questions_list)
+        batches, single = self.pack_batches([idx for idx, questions in enumerate(questions_list) if len(questions) > 1], questions_list)
+        while batches:
+            prompts = []
+            max_tokens_list = []
+            for batch in batches:
+                prompt = self.batch_dedup_prompt({str(idx): questions_list[idx] for idx in batch})
+                prompts.append(prompt)
+                # The rest of the context, at least min_answer_tokens as reserved by pack_batches
+                max_tokens_list.append(self.context_length - self.estimate_tokens(prompt))
+            failed = []
+            for batch, response in zip(batches, self.query_llm_all(prompts, max_tokens_list)):
+                parsed = self.parse_batch_dedup_response({str(idx): questions_list[idx] for idx in batch}, response)
+                if parsed is not None:
+                    for idx in batch:
+                        dedup_lists[idx] = parsed[str(idx)]
+                elif len(batch) == 1:
+                    single += batch
+                else:
+                    failed += [batch[:len(batch) // 2], batch[len(batch) // 2:]]
+            batches = failed
+        if single:
+            prompts = [self.dedup_prompt(questions_list[idx]) for idx in single]
+            # Clamped to the rest of the context, for documents that do not fit in a batch
+            max_tokens_list = [min(1024, self.context_length - self.estimate_tokens(prompt)) for prompt in prompts]
+            too_long = [idx for idx, max_tokens in zip(single, max_tokens_list) if max_tokens < 1]
+            if too_long:
+                print(f"[WARN] The questions of {len(too_long)} documents do not fit in the context length, kept as they are")
+            sent = [(idx, prompt, max_tokens) for idx, prompt, max_tokens in zip(single, prompts, max_tokens_list) if max_tokens >= 1]
+            responses = self.query_llm_all([prompt for _, prompt, _ in sent], [max_tokens for _, _, max_tokens in sent])
+            for (idx, _, _), response in zip(sent, responses):
+                dedup_lists[idx] = self.parse_dedup_response(questions_list[idx], response)
+        return dedup_lists
+
+    def filter_batch(self, examples):
+        if self.max_batch_documents is not None:
+            dedup_lists = self.deduplicate_lists_batched(examples['questions'])
+        elif self.async_mode:
+            dedup_lists = self.deduplicate_lists(examples['questions'])
+        else:
+            return super().filter_batch(examples)
+        return self.map_examples(examples, self.update_example, dedup_lists)
+
     def filter_example(self, example):
         """Filter example based on n-gram overlap between text and questions."""
+        # Deduplicate questions and get the updated list
+        dedup_questions = self.deduplicate_list(example['questions'])
+        return self.update_example(example, dedup_questions)
+
+    def update_example(self, example, dedup_questions):
+        """Keep the questions of the deduplicated list that are in the original list, and their answers."""
         # Store original questions and answers
         orig_questions = example['questions']
         orig_answers = example['answers']
 
-        # Deduplicate questions and get the updated list
-        dedup_questions = self.deduplicate_list(orig_questions)
         final_questions = []
         for question in dedup_questions:
             if question.strip() in orig_questions:
@@ -102,5 +309,7 @@ class DedupQuestionsFilter(Filter):
         return example, value, remove
 
     def __str__(self):
+        if self.max_batch_documents is not None:
+            return f"DedupQuestionsFilter(model={self.model}, max_batch_documents={self.max_batch_documents})"
         return f"DedupQuestionsFilter(model={self.model})"
 
@@ -0,0 +1,137 @@
+# filters/filter_ordering.py
+from datasets import DatasetDict
+from itertools import permutations
+import copy
+import time
+import numpy as np
+
+def sample_rows(dataset, sample_size: int, seed: int = 0):
+    """
+    Returns a seeded random sample of the rows of all splits, as index selections (no rows are copied).
+    """
+    if not isinstance(dataset, DatasetDict):
+        dataset = DatasetDict({"dataset": dataset})
+    splits = list(dataset.keys())
+    offsets = np.cumsum([0] + [len(dataset[split]) for split in splits])
+    rng = np.random.RandomState(seed)
+    indices = np.sort(rng.choice(offsets[-1], size=min(sample_size, offsets[-1]), replace=False))
+    return DatasetDict({
+        split: dataset[split].select(indices[(indices >= offsets[i]) & (indices < offsets[i + 1])] - offsets[i])
+        for i, split in enumerate(splits)
+    })
+
+def profile_filter(filter_i, sample, batch_size: int = 1000):
+    """
+    Applies a filter to a sample and measures its time per 1000 rows and the fraction of rows it removes.
+    The histogram and counts of the filter are restored afterwards.
+
+    :return: The time per 1000 rows in seconds and the rejection rate.
+    """
+    histogram, hist_counts, stats = copy.deepcopy(filter_i.histogram), dict(filter_i.hist_counts), filter_i.stats
+    start_time = time.time()
+    filter_i.apply(sample, batch_size=batch_size)
+    elapsed = time.time() - start_time
+    rows_in = sum(split_stats["rows_in"] for split_stats in filter_i.stats.values())
+    rows_kept = sum(split_stats["rows_kept"] for split_stats in filter_i.stats.values())
+    filter_i.histogram, filter_i.hist_counts, filter_i.stats = histogram, hist_counts, stats
+    time_per_1000_samples = 1000 * elapsed / rows_in if rows_in > 0 else 0.0
+    rejection_rate = 1 - rows_kept / rows_in if rows_in > 0 else 0.0
+    return time_per_1000_samples, rejection_rate
+
+def expected_cost(order, costs, rejection_rates):
+    """
+    Expected time per row of running the filters in the given order, assuming independent rejections:
+    every filter only processes the rows that all previous filters kept.
+    """
+    cost = 0.0
+    remaining = 1.0
+    for idx in order:
+        cost += remaining * costs[idx]
+        remaining *= 1 - rejection_rates[idx]
+    return cost
+
+def _is_valid(order, filters):
+    # Filters that conflict keep their original relative order
+    for position, idx in enumerate(order):
+        for later in order[position + 1:]:
+            if later < idx and filters[idx].conflicts_with(filters[later]):
+                return False
+    return True
+
+def _order_segment(segment, filters, costs, rejection_rates, max_exhaustive: int = 8):
+    """
+    Returns the order of the filter indices of a segment with the lowest expected cost that keeps every pair
+    of conflicting filters in its original order.
+    """
+    if len(segment) <= max_exhaustive:
+        valid_orders = (order for order in permutations(segment) if _is_valid(order, filters))
+        return list(min(valid_orders, key=lambda order: expected_cost(order, costs, rejection_rates)))
+    # Greedy: repeatedly pick the filter with the lowest cost per removed row among those whose
+    # conflicting predecessors are already placed
+    order = []
+    remaining = list(segment)
+    while remaining:
+        available = [idx for idx in remaining
+                     if not any(other < idx and filters[idx].conflicts_with(filters[other]) for other in remaining)]
+        best = min(available, key=lambda idx: costs[idx] / max(rejection_rates[idx], 1e-9))
+        order.append(best)
+        remaining.remove(best)
+    return order
+
+def plan_filter_order(filters, dataset, sample_size: int = 200, seed: int = 0, batch_size: int = 1000):
+    """
+    Reorders the filters to minimize the expected filtering time, from their time per row and rejection rate
+    measured on a seeded random sample of the dataset.
+
+    Filters that are not commutative or need the whole dataset (supports_streaming is False) keep their
+    position and split the chain into segments. Within a segment, filters that conflict (see
+    Filter.conflicts_with) keep their relative order and the others are reordered.
+
+    :param filters: The filters in their original order.
+    :param dataset: The Dataset or DatasetDict to sample the rows from.
+    :param sample_size: Number of rows the filters are profiled on.
+    :param seed: Seed of the sample.
+    :return: The reordered filters, and the plan: one dictionary per filter in the new order with its original
+             position and its profiled time per 1000 samples and rejection rate (None if it was not profiled).
+    """
+    filters = list(filters)
+    costs = [None] * len(filters)
+    rejection_rates = [None] * len(filters)
+    pinned = [not (filter_i.commutative and filter_i.supports_streaming) for filter_i in filters]
+
+    # Split the chain into segments of movable filters
+    segments = []
+    segment = []
+    for idx, filter_i in enumerate(filters):
+        if pinned[idx]:
+            if segment:
+                segments.append(segment)
+            segments.append([idx])
+            segment = []
+        else:
+            segment.append(idx)
+    if segment:
+        segments.append(segment)
+
+    sample = None
+    order = []
+    for segment in segments:
+        if len(segment) == 1:
+            order += segment
+            continue
+        if sample is None:
+            sample = sample_rows(dataset, sample_size, seed)
+            print(f"Profiling filters on {sum(len(split) for split in sample.values())} sampled rows")
+        for idx in segment:
+            costs[idx], rejection_rates[idx] = profile_filter(filters[idx], sample, batch_size)
+        order += _order_segment(segment, filters, costs, rejection_rates)
+
+    plan = [{
+        "filter": str(filters[idx]),
+        "original_position": idx,
+        "time_per_1000_samples": costs[idx],
+        "rejection_rate": rejection_rates[idx],
+    } for idx in order]
+    if order != list(range(len(filters))):
+        print("Reordered filters: " + " -> ".join(str(filters[idx]) for idx in order))
+    return [filters[idx] for idx in order], plan
@@ -0,0 +1,270 @@
+# filters/fused_filter.py
+from .base_filter import Filter
+from datasets import Dataset, DatasetDict
+import json
+import time
+import numpy as np
+import pyarrow as pa
+
+def _to_builtin(value):
+    # NumPy scalars and arrays returned as filter values
+    return value.tolist() if hasattr(value, "tolist") else str(value)
+
+class FusedFilter(Filter):
+    # run_streaming already stops evaluating a row at its first rejection, so filters are streamed unfused
+    supports_streaming = False
+
+    def __init__(self, filters):
+        """
+        Evaluates a chain of filters in a single pass over the dataset. Every batch is passed through the
+        filters in order and only the rows kept by a filter are evaluated by the next one, so later filters
+        never see the rows an earlier filter removed.
+
+        Every filter still records its own histogram, counts (stats) and remaining and removed rows, which
+        stages returns for reporting, so the pipeline reports the fused filters as if they had run one after the
+        other. The remaining and removed rows of every filter hold its own filter values, and the columns a later
+        filter updates as they were after it (snapshotted in the single pass).
+
+        :param filters: The filters to fuse, in evaluation order. They must declare their input and output
+                        columns, so the columns to snapshot are known.
+        """
+        super().__init__()
+        self.filters = list(filters)
+        for filter_i in self.filters:
+            if filter_i.input_columns is None or filter_i.output_columns is None:
+                raise ValueError(f"{filter_i} does not declare its input and output columns and can not be fused")
+        # The question and answer counts after every filter are recorded for its stats
+        self.input_columns = self._union([filter_i.input_columns for filter_i in self.filters] + [["questions", "answers"]])
+        self.output_columns = self._union([filter_i.output_columns for filter_i in self.filters])
+        # The columns updated by the filters after every filter, whose values after it are snapshotted
+        self._snapshot_columns = [self._union([later.output_columns for later in self.filters[i + 1:]])
+                                  for i in range(len(self.filters))]
+        self._dataset_columns = []
+        self.supports_multiprocessing = all(filter_i.supports_multiprocessing for filter_i in self.filters)
+        self._stage_results = []
+        self._stage_times = []
+
+    @staticmethod
+    def _union(column_lists):
+        columns = []
+        for column_list in column_lists:
+            columns += [column for column in column_list if column not in columns]
+        return columns
+
+    def add_to_histogram(self, stage):
+        # Number of rows removed by every filter (or kept by all of them)
+        key = str(self.filters[stage]) if stage >= 0 else "kept"
+        self.hist_counts[key] = self.hist_counts.get(key, 0) + 1
+
+    def filter_example(self, example):
+        """Evaluate the filter chain on a single example."""
+        updated_examples, removed_stages, removed = self.filter_batch({column: [value] for column, value in example.items()})
+        return {column: column_values[0] for column, column_values in updated_examples.items()}, removed_stages[0], removed[0]
+
+    def filter_batch(self, examples):
+        """
+        Passes the batch through the filters in order, each filter seeing only the rows kept by the previous ones.
+
+        Besides the updated columns, the returned batch holds bookkeeping columns for every filter i:
+        'filter_value_{i}' (the JSON encoded filter value, None for rows that did not reach the filter),
+        'num_questions_{i}' and 'num_answers_{i}' (the counts after the filter, -1 if not reached),
+        'filter_time_{i}' (the time spent in the filter, spread evenly over the rows of the batch) and
+        '{column}_after_{i}' (the value after the filter of every column a later filter updates).
+
+        :return: The updated batch, the index of the filter that removed every row (-1 if kept) and the removal flags.
+        """
+        columns = list(examples.keys())
+        num_examples = len(examples[columns[0]]) if columns else 0
+        examples = {column: list(values) for column, values in examples.items()}
+        removed_stage = np.full(num_examples, -1, dtype=np.int64)
+        alive = np.arange(num_examples)
+        for i, filter_i in enumerate(self.filters):
+            values = [None] * num_examples
+            num_questions = np.full(num_examples, -1, dtype=np.int64)
+            num_answers = np.full(num_examples, -1, dtype=np.int64)
+            elapsed = 0.0
+            if len(alive) > 0:
+                if filter_i.input_columns is None:
+                    input_columns = columns
+                    output_columns = columns
+                else:
+                    input_columns = [column for column in filter_i.input_columns if column in examples]
+                    output_columns = [column for column in filter_i.output_columns if column in input_columns]
+                start_time = time.time()
+                updated_examples, hist_values, removed = filter_i.filter_batch(
+                    {column: [examples[column][idx] for idx in alive] for column in input_columns}
+                )
+                elapsed = time.time() - start_time
+                for column in output_columns:
+                    for idx, value in zip(alive, updated_examples[column]):
+                        examples[column][idx] = value
+                for idx, value in zip(alive, hist_values):
+                    values[idx] = json.dumps(value, default=_to_builtin)
+                for idx in alive:
+                    num_questions[idx] = len(examples["questions"][idx] or []) if "questions" in examples else 0
+                    num_answers[idx] = len(examples["answers"][idx] or []) if "answers" in examples else 0
+                removed = np.asarray(removed, dtype=bool)
+                removed_stage[alive[removed]] = i
+                alive = alive[~removed]
+            for column in self._snapshot_columns[i]:
+                if column in examples:
+                    examples[f"{column}_after_{i}"] = [list(value) if isinstance(value, list) else value
+                                                       for value in examples[column]]
+            examples[f"filter_value_{i}"] = values
+            examples[f"num_questions_{i}"] = num_questions.tolist()
+            examples[f"num_answers_{i}"] = num_answers.tolist()
+            examples[f"filter_time_{i}"] = [elapsed / max(num_examples, 1)] * num_examples
+        return examples, removed_stage.tolist(), (removed_stage >= 0).tolist()
+
+    def extra_columns(self):
+        columns = [f"{name}_{i}" for i in range(len(self.filters))
+                   for name in ("filter_value", "num_questions", "num_answers", "filter_time")]
+        # Snapshots of columns missing from the projected dataset are not created, see _map_split
+        return columns + [f"{column}_after_{i}" for i in range(len(self.filters)) for column in self._snapshot_columns[i]
+                          if column in self._dataset_columns]
+
+    def _map_split(self, dataset: Dataset, num_proc: int = None, batch_size: int = 1000,
+                   checkpoint_dir: str = None, checkpoint_shard_size: int = None):
+        self._dataset_columns = [column for column in self.input_columns if column in dataset.column_names]
+        return super()._map_split(dataset, num_proc, batch_size, checkpoint_dir, checkpoint_shard_size)
+
+    def _stage_dataset(self, tagged: Dataset, table, removed_stage, i):
+        """
+        Returns the rows of the split as filter i left them: its decoded filter values in 'filter_value', its
+        decision in 'split' and the snapshots of the columns updated by later filters. Rows that did not reach
+        the filter hold nulls.
+        """
+        reached = (removed_stage == -1) | (removed_stage >= i)
+        columns = {column: table[f"{column}_after_{i}"] for column in self._snapshot_columns[i]
+                   if f"{column}_after_{i}" in table.column_names}
+        values = [json.loads(value) if value is not None else None for value in table[f"filter_value_{i}"].to_pylist()]
+        # The type is inferred from the rows that reached the filter only, as in an unfused run, since the nulls
+        # of the other rows change the inference (e.g. [None, [True, 0.4]] is inferred as a list of booleans)
+        reached_values = [value for value in values if value is not None]
+        value_type = pa.array(reached_values).type if reached_values else pa.null()
+        columns["filter_value"] = pa.array(values, type=value_type)
+        columns["split"] = pa.array(np.where(removed_stage == i, "removed", "remaining").tolist(), mask=~reached)
+        return self.join_columns(tagged, Dataset(pa.table(columns)))
+
+    def apply(self, dataset, num_proc: int = None, batch_size: int = 1000,
+              checkpoint_dir: str = None, checkpoint_shard_size: int = None):
+        """
+        Applies the fused filters in a single pass and returns the rows kept by all of them and the removed rows.
+        The remaining and removed rows of every filter are available from stages afterwards.
+        """
+        for filter_i in self.filters:
+            filter_i.stats = {}
+        self._stage_times = [0.0] * len(self.filters)
+        self._stage_splits = [{} for _ in self.filters]
+        remaining_dataset, removed_dataset = super().apply(dataset, num_proc=num_proc, batch_size=batch_size,
+                                                           checkpoint_dir=checkpoint_dir,
+                                                           checkpoint_shard_size=checkpoint_shard_size)
+        self._stage_results = []
+        for i, filter_i in enumerate(self.filters):
+            if isinstance(dataset, DatasetDict):
+                stage_remaining = DatasetDict({split: groups[0] for split, groups in self._stage_splits[i].items()})
+                stage_removed = DatasetDict({split: groups[1] for split, groups in self._stage_splits[i].items()})
+            else:
+                stage_remaining, stage_removed = self._stage_splits[i]["dataset"]
+            self._stage_results.append((filter_i, stage_remaining, stage_removed))
+        return remaining_dataset, removed_dataset
+
+    def _apply_split(self, dataset: Dataset, num_proc: int = None, batch_size: int = 1000,
+                     checkpoint_dir: str = None, checkpoint_shard_size: int = None,
+                     split_name: str = "dataset") -> (Dataset, Dataset):
+        """
+        Applies the fused filters to a single split, and records the histogram, counts and remaining and
+        removed rows of every filter from the bookkeeping columns.
+        """
+        if len(dataset) == 0:
+            self.stats[split_name] = self.split_stats(dataset, dataset, [])
+            for i, filter_i in enumerate(self.filters):
+                filter_i.stats[split_name] = filter_i.split_stats(dataset, dataset, [])
+                self._stage_splits[i][split_name] = (dataset, dataset)
+            return dataset, dataset
+
+        mapped, output_columns = self._map_split(dataset, num_proc, batch_size, checkpoint_dir, checkpoint_shard_size)
+        table = mapped.with_format("arrow")[:]
+        removed_stage = table["filter_value"].to_numpy()
+        for stage in removed_stage:
+            self.add_to_histogram(int(stage))
+        self.stats[split_name] = self.split_stats(dataset, mapped, output_columns)
+
+        tagged = self.join_columns(dataset, mapped.select_columns(output_columns + ["filter_value", "split"]))
+        questions_before = self.list_lengths(dataset, "questions") if "questions" in dataset.column_names else np.zeros(len(dataset), dtype=np.int64)
+        for i, filter_i in enumerate(self.filters):
+            reached = (removed_stage == -1) | (removed_stage >= i)
+            kept = (removed_stage == -1) | (removed_stage > i)
+            for value in table[f"filter_value_{i}"].filter(reached).to_pylist():
+                filter_i.add_to_histogram(json.loads(value))
+            num_questions = table[f"num_questions_{i}"].to_numpy()
+            num_answers = table[f"num_answers_{i}"].to_numpy()
+            filter_i.stats[split_name] = {
+                "rows_in": int(reached.sum()),
+                "rows_kept": int(kept.sum()),
+                "questions_in": int(questions_before[reached].sum()),
+                "questions_kept": int(num_questions[kept].sum()),
+                "length_mismatches": int(((num_questions != num_answers) & kept).sum()),
+            }
+            self._stage_times[i] += float(table[f"filter_time_{i}"].to_numpy().sum())
+            stage_tagged = self._stage_dataset(tagged, table, removed_stage, i)
+            self._stage_splits[i][split_name] = (stage_tagged.select(np.flatnonzero(kept)),
+                                                stage_tagged.select(np.flatnonzero(removed_stage == i)))
+            questions_before = num_questions
+
+        # Partition the rows kept by all filters and the rows removed by any of them
+        return self.partition(tagged)
+
+    def stages(self, remaining_dataset, removed_dataset, filter_time):
+        """
+        Returns the remaining and removed rows of every fused filter, with filter_time divided between the
+        filters in proportion to the time spent in each of them.
+        """
+        total_time = sum(self._stage_times)
+        stages = []
+        for (filter_i, stage_remaining, stage_removed), stage_time in zip(self._stage_results, self._stage_times):
+            share = stage_time / total_time if total_time > 0 else 1 / len(self.filters)
+            stages.append((filter_i, stage_remaining, stage_removed, filter_time * share))
+        return stages
+
+    def __getstate__(self):
+        # The results of the last apply call are not sent to worker processes
+        state = self.__dict__.copy()
+        state["_stage_results"] = []
+        state["_stage_splits"] = []
+        return state
+
+    def __str__(self):
+        return f"FusedFilter({', '.join(str(filter_i) for filter_i in self.filters)})"
+
+
+def is_fusable(filter_i) -> bool:
+    """
+    Returns whether a filter is cheap enough to be fused: it decides on each batch independently
+    (supports_streaming), can run in several worker processes, may be reordered (commutative) and declares
+    its columns. Filters calling an LLM, e.g. DedupQuestionsFilter, are not, so they keep their own stage and
+    checkpoints and do not force the filters fused with them into a single process.
+    """
+    return (filter_i.supports_streaming and filter_i.supports_multiprocessing and filter_i.commutative
+            and filter_i.input_columns is not None and filter_i.output_columns is not None)
+
+
+def fuse_filters(filters):
+    """
+    Replaces every run of consecutive cheap filters (see is_fusable) with a FusedFilter. Filters that need a
+    pass over the whole dataset, e.g. CrossDocDedupFilter, and the other filters are kept as separate stages.
+    """
+    fused = []
+    run = []
+    for filter_i in list(filters) + [None]:
+        if filter_i is not None and is_fusable(filter_i):
+            run.append(filter_i)
+            continue
+        if len(run) > 1:
+            fused.append(FusedFilter(run))
+        else:
+            fused += run
+        run = []
+        if filter_i is not None:
+            fused.append(filter_i)
+    return fused
@@ -0,0 +1,169 @@
+# filters/histogram.py
+import numpy as np
+
+class StreamingHistogram:
+    def __init__(self, compression: int = 200, exact_size: int = 10000):
+        """
+        Distribution of the filter values of a run, kept in bounded memory.
+
+        Up to exact_size values are kept as they are, so small runs get exact quantiles and histograms. Beyond
+        that, the values are summarized in a merging t-digest: at most about compression centroids (mean and
+        weight), finest at the tails, plus a buffer of at most exact_size values not merged yet. Quantiles and
+        histogram counts are interpolated from the centroids. Histograms of different workers can be merged.
+
+        :param compression: The t-digest compression, bounding the number of centroids. Higher is more accurate.
+        :param exact_size: Number of values kept exactly, and size of the buffer of the t-digest.
+        """
+        self.compression = compression
+        self.exact_size = exact_size
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        # The exact values, or the values not merged into the t-digest yet
+        self.values = []
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.exact = True
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value):
+        """
+        Adds a single value.
+        """
+        self.values.append(value)
+        self.count += 1
+        if len(self.values) > self.exact_size:
+            self._compress()
+
+    def extend(self, values):
+        """
+        Adds a list of values.
+        """
+        self.values.extend(values)
+        self.count += len(values)
+        if len(self.values) > self.exact_size:
+            self._compress()
+
+    def merge(self, other):
+        """
+        Adds the values summarized by another histogram, e.g. the histogram of a worker process.
+        """
+        self.values.extend(other.values)
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if not other.exact:
+            self.means = np.concatenate([self.means, other.means])
+            self.weights = np.concatenate([self.weights, other.weights])
+            self.exact = False
+        if not self.exact or len(self.values) > self.exact_size:
+            self._compress()
+
+    def state(self):
+        """
+        Returns the state of the histogram as a JSON serializable dictionary, see from_state.
+        """
+        return {
+            "compression": self.compression,
+            "exact_size": self.exact_size,
+            "count": self.count,
+            "min": float(self.min),
+            "max": float(self.max),
+            "values": [float(value) for value in self.values],
+            "means": self.means.tolist(),
+            "weights": self.weights.tolist(),
+            "exact": self.exact,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Creates a histogram from the dictionary returned by state.
+        """
+        histogram = cls(compression=state["compression"], exact_size=state["exact_size"])
+        histogram.count = state["count"]
+        histogram.min = state["min"]
+        histogram.max = state["max"]
+        histogram.values = list(state["values"])
+        histogram.means = np.array(state["means"], dtype=np.float64)
+        histogram.weights = np.array(state["weights"], dtype=np.float64)
+        histogram.exact = state["exact"]
+        return histogram
+
+    def _k(self, q):
+        # t-digest scale function k1: centroids are small near the tails and large around the median
+        return self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+
+    def _compress(self):
+        """
+        Merges the buffered values into the centroids of the t-digest.
+        """
+        self.exact = False
+        if len(self.values) == 0 and len(self.means) <= self.compression:
+            return
+        values = np.asarray(self.values, dtype=np.float64)
+        if len(values) > 0:
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+        means = np.concatenate([self.means, values])
+        weights = np.concatenate([self.weights, np.ones(len(values))])
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+
+        merged_means, merged_weights = [means[0]], [weights[0]]
+        weight_before = 0.0
+        k_limit = self._k(0.0) + 1
+        for mean, weight in zip(means[1:], weights[1:]):
+            # Merge into the current centroid while it stays within one unit of the scale function
+            if self._k((weight_before + merged_weights[-1] + weight) / total) <= k_limit:
+                merged_weight = merged_weights[-1] + weight
+                merged_means[-1] += (mean - merged_means[-1]) * weight / merged_weight
+                merged_weights[-1] = merged_weight
+            else:
+                weight_before += merged_weights[-1]
+                k_limit = self._k(weight_before / total) + 1
+                merged_means.append(mean)
+                merged_weights.append(weight)
+        self.means = np.array(merged_means)
+        self.weights = np.array(merged_weights)
+        self.values = []
+
+    def _cumulative(self):
+        """
+        Returns the points (value, number of values below it) the quantiles are interpolated from: the minimum,
+        the center of every centroid and the maximum.
+        """
+        self._compress()
+        centers = np.cumsum(self.weights) - self.weights / 2
+        return (np.concatenate([[self.min], self.means, [self.max]]),
+                np.concatenate([[0.0], centers, [self.count]]))
+
+    def quantile(self, q):
+        """
+        Returns the q-th quantile (0 <= q <= 1) of the values. Exact as long as all values are kept.
+        """
+        if self.count == 0:
+            raise ValueError("Quantile of an empty histogram")
+        if self.exact:
+            return float(np.percentile(np.asarray(self.values), 100 * q))
+        points, ranks = self._cumulative()
+        return float(np.interp(q * self.count, ranks, points))
+
+    def histogram(self, bins: int = 30, value_range=None):
+        """
+        Returns the counts and bin edges of the values in value_range (min, max), like np.histogram.
+        Values outside the range are not counted.
+        """
+        if self.exact:
+            values = np.asarray(self.values)
+            if value_range is not None:
+                values = values[(values >= value_range[0]) & (values <= value_range[1])]
+            return np.histogram(values, bins=bins)
+        points, ranks = self._cumulative()
+        low, high = value_range if value_range is not None else (self.min, self.max)
+        low, high = max(low, self.min), min(high, self.max)
+        edges = np.linspace(low, high, bins + 1) if high > low else np.linspace(low - 0.5, low + 0.5, bins + 1)
+        return np.diff(np.interp(edges, points, ranks)), edges
@@ -0,0 +1,150 @@
+# filters/lang_detectors.py
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import hashlib
+
+class LanguageDetectionError(ValueError):
+    """
+    Raised by the backends for a string whose language can not be detected (e.g. empty or without letters).
+    Errors loading a backend, e.g. a missing package or model file, are not wrapped.
+    """
+
+
+class LanguageDetector(ABC):
+    def __init__(self, max_chars: int = None, cache_size: int = 100000):
+        """
+        Base class of the language detection backends used by LanguageFilter and LanguageFilterOCR.
+
+        Detections are memoized in an LRU cache keyed by a hash of the (truncated) string, so repeated
+        strings such as generated questions are only detected once.
+
+        :param max_chars: Only the first max_chars characters of a string are used for detection, None for all.
+        :param cache_size: Maximum number of memoized detections, 0 to disable memoization.
+        """
+        self.max_chars = max_chars
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    @abstractmethod
+    def _detect(self, text):
+        """
+        Return the language code of the text. Raise LanguageDetectionError if the language can not be detected.
+        """
+        pass
+
+    def detect(self, text):
+        """
+        Return the language code of the text, e.g. 'hu'. Raises LanguageDetectionError if it can not be detected.
+        """
+        if self.max_chars is not None:
+            text = text[:self.max_chars]
+        if self.cache_size == 0:
+            return self._detect(text)
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        language = self._detect(text)
+        self.cache[key] = language
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return language
+
+    def __str__(self):
+        return f"{self.__class__.__name__}(max_chars={self.max_chars})"
+
+
+class LangdetectDetector(LanguageDetector):
+    def __init__(self, seed: int = 0, max_chars: int = None, cache_size: int = 100000):
+        """
+        langdetect backend. langdetect is non-deterministic unless seeded.
+
+        :param seed: Seed of langdetect's DetectorFactory, None to leave it unseeded.
+        """
+        super().__init__(max_chars=max_chars, cache_size=cache_size)
+        self.seed = seed
+
+    def _detect(self, text):
+        from langdetect import DetectorFactory, detect
+        from langdetect.lang_detect_exception import LangDetectException
+        if self.seed is not None:
+            DetectorFactory.seed = self.seed
+        try:
+            return detect(text)
+        except LangDetectException as e:
+            raise LanguageDetectionError(str(e)) from e
+
+
+class LangidDetector(LanguageDetector):
+    def __init__(self, languages=None, max_chars: int = 1000, cache_size: int = 100000):
+        """
+        langid.py backend. Offline (the model ships with the package), deterministic and faster than langdetect.
+
+        :param languages: Optional list of language codes to restrict the predictions to.
+        """
+        super().__init__(max_chars=max_chars, cache_size=cache_size)
+        self.languages = languages
+        self.identifier = None
+
+    def _detect(self, text):
+        if not text.strip():
+            raise LanguageDetectionError("No features in text.")
+        if self.identifier is None:
+            from langid.langid import LanguageIdentifier, model
+            self.identifier = LanguageIdentifier.from_modelstring(model)
+            if self.languages is not None:
+                self.identifier.set_languages(self.languages)
+        return self.identifier.classify(text)[0]
+
+    def __getstate__(self):
+        # The identifier is reloaded in worker processes instead of being pickled
+        state = self.__dict__.copy()
+        state["identifier"] = None
+        return state
+
+
+class FastTextDetector(LanguageDetector):
+    def __init__(self, model_path: str, max_chars: int = 1000, cache_size: int = 100000):
+        """
+        fastText backend, e.g. with the lid.176.ftz language identification model.
+        Requires the fasttext package and a downloaded model file.
+
+        :param model_path: Path to the fastText language identification model.
+        """
+        super().__init__(max_chars=max_chars, cache_size=cache_size)
+        self.model_path = model_path
+        self.model = None
+
+    def _detect(self, text):
+        if not text.strip():
+            raise LanguageDetectionError("No features in text.")
+        if self.model is None:
+            import fasttext
+            self.model = fasttext.load_model(self.model_path)
+        # fastText predicts one line at a time
+        labels, _ = self.model.predict(" ".join(text.split()))
+        return labels[0].replace("__label__", "")
+
+    def __getstate__(self):
+        # The model is reloaded in worker processes instead of being pickled
+        state = self.__dict__.copy()
+        state["model"] = None
+        return state
+
+    def __str__(self):
+        return f"FastTextDetector(model_path={self.model_path}, max_chars={self.max_chars})"
+
+
+def get_detector(name: str, max_chars: int = None, fasttext_model: str = None, seed: int = 0):
+    """
+    Creates a language detector by backend name ('langdetect', 'langid' or 'fasttext').
+    """
+    if name == "langdetect":
+        return LangdetectDetector(seed=seed, max_chars=max_chars)
+    if name == "langid":
+        return LangidDetector(max_chars=max_chars)
+    if name == "fasttext":
+        if fasttext_model is None:
+            raise ValueError("The fasttext language detector requires a model path")
+        return FastTextDetector(fasttext_model, max_chars=max_chars)
+    raise ValueError(f"Unknown language detector: {name}")
@@ -1,14 +1,20 @@
-from langdetect import detect
 from .base_filter import Filter
+from .lang_detectors import LangdetectDetector
 
 class LanguageFilter(Filter):
-    def __init__(self, language: str):
+    input_columns = ["text", "questions", "answers"]
+    output_columns = ["questions", "answers"]
+    per_question_selection = True
+
+    def __init__(self, language: str, detector=None):
         """
         Initialize the LanguageFilter with the expected language code.
         :param language: The language code to filter by (e.g., 'en', 'fr').
+        :param detector: The LanguageDetector backend. Defaults to a seeded, memoized langdetect backend.
         """
         super().__init__()
         self.language = language
+        self.detector = detector if detector is not None else LangdetectDetector()
 
     def add_to_histogram(self, lang):
         if lang not in self.hist_counts:
@@ -25,7 +31,7 @@ class LanguageFilter(Filter):
         """
         # Detect the language of the text field
         try:
-            text_language = detect(example.get("text", ""))
+            text_language = self.detector.detect(example.get("text", ""))
         except:
             text_language = self.language
 
@@ -35,7 +41,7 @@ class LanguageFilter(Filter):
         # Filter questions based on the detected language
         orig_questions = example.get("questions", [])
         orig_answers = example.get("answers", [])
-        filtered_questions = [question for question in orig_questions if detect(question) == self.language]
+        filtered_questions = [question for question in orig_questions if self.detector.detect(question) == self.language]
 
         # Use the helper function to filter answers based on the updated questions
         filtered_answers = self.filter_answers(orig_questions, orig_answers, filtered_questions)
@@ -55,5 +61,7 @@ class LanguageFilter(Filter):
         """
         Return a string representation of the filter.
         """
+        if not isinstance(self.detector, LangdetectDetector):
+            return f"LanguageFilter(language={self.language}, detector={self.detector})"
         return f"LanguageFilter(language={self.language})"
 
@@ -1,14 +1,20 @@
-from langdetect import detect
 from .base_filter import Filter
+from .lang_detectors import LangdetectDetector
 
 class LanguageFilterOCR(Filter):
-    def __init__(self, language: str):
+    input_columns = ["text", "ocr", "questions", "answers"]
+    output_columns = ["questions", "answers"]
+    per_question_selection = True
+
+    def __init__(self, language: str, detector=None):
         """
         Initialize the LanguageFilter with the expected language code.
         :param language: The language code to filter by (e.g., 'en', 'fr').
+        :param detector: The LanguageDetector backend. Defaults to a seeded, memoized langdetect backend.
         """
         super().__init__()
         self.language = language
+        self.detector = detector if detector is not None else LangdetectDetector()
 
     def add_to_histogram(self, langs):
         for lang in langs:
@@ -27,11 +33,11 @@ class LanguageFilterOCR(Filter):
         """
         # Detect languages for the relevant fields
         try:
-            text_language = detect(example.get("text", ""))
+            text_language = self.detector.detect(example.get("text", ""))
         except:
             text_language = "None"
         try:
-            ocr_lang = detect(example.get("ocr"))
+            ocr_lang = self.detector.detect(example.get("ocr"))
         except:
             ocr_lang = "None"
 
@@ -41,7 +47,7 @@ class LanguageFilterOCR(Filter):
         # Filter questions based on detected language
         orig_questions = example.get("questions", [])
         orig_answers = example.get("answers", [])
-        filtered_questions = [question for question in orig_questions if detect(question) == self.language]
+        filtered_questions = [question for question in orig_questions if self.detector.detect(question) == self.language]
 
         # Use the helper function to filter answers based on the updated questions
         filtered_answers = self.filter_answers(orig_questions, orig_answers, filtered_questions)
@@ -60,5 +66,7 @@ class LanguageFilterOCR(Filter):
         """
         Return a string representation of the filter.
         """
+        if not isinstance(self.detector, LangdetectDetector):
+            return f"LanguageFilterOCR(language={self.language}, detector={self.detector})"
         return f"LanguageFilterOCR(language={self.language})"
 
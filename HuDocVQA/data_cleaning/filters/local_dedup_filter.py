@@ -0,0 +1,88 @@
+# filters/local_dedup_filter.py
+from .base_filter import Filter
+from .n_gram_overlap_filter import NGramFilter
+import numpy as np
+
+class LocalDedupQuestionsFilter(Filter):
+    input_columns = ["questions", "answers"]
+    output_columns = ["questions", "answers"]
+
+    def __init__(self, n_gram: int = 3, threshold: float = 0.7, borderline_threshold: float = None, llm_filter=None):
+        """
+        Removes duplicate or paraphrased questions of an example without calling an API, using the
+        Jaccard similarity of the character n-grams of the questions.
+
+        :param n_gram: Size of the character n-grams.
+        :param threshold: A question is a duplicate if its similarity to an earlier kept question is at least this value.
+        :param borderline_threshold: Similarities in [borderline_threshold, threshold) are ambiguous. If set together
+                                     with llm_filter, examples with such pairs are deduplicated again by the LLM.
+        :param llm_filter: Optional DedupQuestionsFilter used for the borderline examples.
+        """
+        super().__init__()
+        self.n_gram = n_gram
+        self.threshold = threshold
+        self.borderline_threshold = borderline_threshold
+        self.llm_filter = llm_filter
+        # The LLM client is rate limited per key, only spread the local computation over worker processes
+        self.supports_multiprocessing = llm_filter is None
+
+    def add_to_histogram(self, similarities):
+        self.histogram.extend(similarities)
+
+    def similarity_matrix(self, questions):
+        """
+        Returns the pairwise Jaccard similarities of the character n-gram sets of the questions.
+        """
+        ngram_sets = [set(NGramFilter.generate_ngrams(question.strip().lower(), self.n_gram)) for question in questions]
+        vocabulary = {ngram: idx for idx, ngram in enumerate(set().union(*ngram_sets))}
+        membership = np.zeros((len(questions), len(vocabulary)), dtype=np.float64)
+        for row, ngrams in enumerate(ngram_sets):
+            membership[row, [vocabulary[ngram] for ngram in ngrams]] = 1
+        intersection = membership @ membership.T
+        sizes = membership.sum(axis=1)
+        union = sizes[:, None] + sizes[None, :] - intersection
+        # Questions too short for a single n-gram are only similar to identical questions
+        identical = np.array([[a.strip().lower() == b.strip().lower() for b in questions] for a in questions])
+        return np.where(union > 0, intersection / np.maximum(union, 1), identical.astype(np.float64))
+
+    def deduplicate_list(self, questions):
+        """
+        Keeps every question that is not a near-duplicate of an earlier kept question.
+
+        :return: The deduplicated questions, the maximum similarity of every question to an earlier question,
+                 and whether a kept pair of questions is borderline.
+        """
+        if len(questions) <= 1:
+            return list(questions), [0.0] * len(questions), False
+        similarities = self.similarity_matrix(questions)
+        kept = []
+        max_similarities = []
+        for idx in range(len(questions)):
+            max_similarities.append(float(similarities[idx, :idx].max()) if idx > 0 else 0.0)
+            if all(similarities[idx, kept_idx] < self.threshold for kept_idx in kept):
+                kept.append(idx)
+        borderline = False
+        if self.borderline_threshold is not None and len(kept) > 1:
+            kept_similarities = similarities[np.ix_(kept, kept)][np.triu_indices(len(kept), k=1)]
+            borderline = bool(np.any(kept_similarities >= self.borderline_threshold))
+        return [questions[idx] for idx in kept], max_similarities, borderline
+
+    def filter_example(self, example):
+        """Filter example by removing near-duplicate questions."""
+        orig_questions = example['questions']
+        orig_answers = example['answers']
+
+        final_questions, similarities, borderline = self.deduplicate_list(orig_questions)
+        if borderline and self.llm_filter is not None:
+            llm_questions = self.llm_filter.deduplicate_list(final_questions)
+            final_questions = [question.strip() for question in llm_questions if question.strip() in final_questions]
+
+        # Use the helper function to filter answers based on the new questions
+        answers = self.filter_answers(orig_questions, orig_answers, final_questions)
+        example['questions'] = final_questions
+        example['answers'] = answers
+
+        return example, similarities, len(final_questions) == 0
+
+    def __str__(self):
+        return f"LocalDedupQuestionsFilter(n_gram={self.n_gram}, threshold={self.threshold})"
@@ -0,0 +1,119 @@
+# filters/minhash.py
+import hashlib
+import numpy as np
+
+# Multiplier of the polynomial rolling hash over code points (arithmetic wraps modulo 2**64)
+ROLLING_HASH_BASE = np.uint64(1000003)
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+
+def normalize_question(question):
+    """Lowercases a question and collapses its whitespace."""
+    return " ".join(question.lower().split())
+
+
+def exact_hash(text):
+    """Returns a stable 64-bit hash of a string."""
+    return np.frombuffer(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), dtype=np.uint64)[0]
+
+
+def ngram_hashes(text, n):
+    """
+    Hashes every character n-gram of a string (spaces removed, as in NGramFilter.generate_ngrams)
+    to a 64-bit integer with a polynomial rolling hash over the code points.
+
+    :param text: The input string.
+    :param n: The n-gram size.
+    :return: A uint64 array with one hash per n-gram (empty if the text is shorter than n).
+    """
+    code_points = np.frombuffer(text.replace(" ", "").encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    num_ngrams = len(code_points) - n + 1
+    if num_ngrams <= 0:
+        return np.empty(0, dtype=np.uint64)
+    hashes = np.zeros(num_ngrams, dtype=np.uint64)
+    for offset in range(n):
+        hashes = hashes * ROLLING_HASH_BASE + code_points[offset:offset + num_ngrams]
+    return hashes
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, bands: int = 16, seed: int = 0):
+        """
+        MinHash signatures of n-gram hash sets, and LSH band keys computed from them.
+
+        :param num_perm: Number of hash permutations (signature length). Must be divisible by bands.
+        :param bands: Number of LSH bands. Sets sharing any band key are candidate near-duplicates.
+        :param seed: Seed of the random permutations.
+        """
+        if num_perm % bands != 0:
+            raise ValueError(f"num_perm ({num_perm}) must be divisible by bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        rng = np.random.RandomState(seed)
+        # a * x + b with a, b, x < 2**32 never overflows 64 bits
+        self.a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def signatures(self, hash_sets):
+        """
+        Computes the MinHash signature of every set of hashes.
+
+        :param hash_sets: List of uint64 arrays. Empty arrays get a signature that matches no other set.
+        :return: A (len(hash_sets), num_perm) uint32 array.
+        """
+        lengths = np.array([len(hashes) for hashes in hash_sets], dtype=np.int64)
+        signatures = np.full((len(hash_sets), self.num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+        non_empty = np.flatnonzero(lengths > 0)
+        if len(non_empty) == 0:
+            return signatures
+        values = np.concatenate([hash_sets[idx] for idx in non_empty]) & np.uint64(0xFFFFFFFF)
+        permuted = ((values[:, None] * self.a[None, :] + self.b[None, :]) % MERSENNE_PRIME) & np.uint64(0xFFFFFFFF)
+        starts = np.concatenate([[0], np.cumsum(lengths[non_empty])[:-1]])
+        signatures[non_empty] = np.minimum.reduceat(permuted, starts, axis=0).astype(np.uint32)
+        return signatures
+
+    def band_keys(self, signatures):
+        """
+        Combines the rows of every band of the signatures into one 64-bit key per band.
+
+        :return: A (num_signatures, bands) uint64 array.
+        """
+        rows = self.num_perm // self.bands
+        banded = signatures.reshape(len(signatures), self.bands, rows).astype(np.uint64)
+        keys = np.zeros((len(signatures), self.bands), dtype=np.uint64)
+        for row in range(rows):
+            keys = keys * ROLLING_HASH_BASE + banded[:, :, row]
+        # Salt the keys with the band index, so equal keys of different bands do not match
+        return keys ^ np.arange(self.bands, dtype=np.uint64)[None, :] * np.uint64(0x9E3779B97F4A7C15)
+
+
+def connected_components(keys_list, num_items):
+    """
+    Groups items that share a key in any of the key arrays (union-find by label propagation).
+
+    :param keys_list: List of arrays of length num_items. Items with equal values in one array are connected.
+    :param num_items: The number of items.
+    :return: An int64 array with the smallest item index of every item's component.
+    """
+    labels = np.arange(num_items, dtype=np.int64)
+    if num_items == 0:
+        return labels
+    orders = [np.argsort(keys, kind="stable") for keys in keys_list]
+    group_starts = []
+    for keys, order in zip(keys_list, orders):
+        sorted_keys = keys[order]
+        group_starts.append(np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]])))
+    changed = True
+    while changed:
+        changed = False
+        for order, starts in zip(orders, group_starts):
+            sorted_labels = labels[order]
+            group_min = np.minimum.reduceat(sorted_labels, starts)
+            group_sizes = np.diff(np.concatenate([starts, [num_items]]))
+            new_labels = np.repeat(group_min, group_sizes)
+            if np.any(new_labels < sorted_labels):
+                changed = True
+                labels[order] = np.minimum(sorted_labels, new_labels)
+        # Pointer jumping: follow labels to their root
+        labels = labels[labels]
+    return labels
@@ -1,46 +1,79 @@
 # filters/text_length_filter.py
 from .base_filter import Filter
+from .minhash import ngram_hashes
+import numpy as np
 
 class NGramFilter(Filter):
-    def __init__(self, n_gram: int, threshold: float):
+    input_columns = ["text", "questions", "answers"]
+    output_columns = ["questions", "answers"]
+    per_question_selection = True
+
+    def __init__(self, n_gram: int, threshold: float, source_fields=("text",)):
+        """
+        :param n_gram: Size of the character n-grams.
+        :param threshold: Questions whose n-gram overlap with the source text is at most this value are removed.
+        :param source_fields: Fields the questions are compared to, e.g. ("text", "ocr"). The overlap of a question
+                              is the maximum over the fields, like TextLengthFilterOCR uses the longer of the two.
+        """
         super().__init__()
         self.n_gram = n_gram
         self.threshold = threshold
+        self.source_fields = tuple(source_fields)
+        self.input_columns = list(self.source_fields) + ["questions", "answers"]
 
-    def generate_ngrams(self, text, n):
+    @staticmethod
+    def generate_ngrams(text, n):
         """Helper function to generate character-level n-grams from a given text."""
         # Remove spaces if you want pure character n-grams (optional)
         text = text.replace(" ", "")
         return [text[i:i+n] for i in range(len(text) - n + 1)]
 
     def add_to_histogram(self, overlap_percentages):
-        self.hist_list += overlap_percentages
+        self.histogram.extend(overlap_percentages)
     
 
     def get_filter_value(self, example, question):
         """
         Converts the data point to a value that can be used to deterime if it should be filtered out
         """
-        text = example["text"]
-        if len(text) < self.n_gram or len(question) < self.n_gram:
-            return False  # Do not filter examples where n-grams cannot be generated
-
-        # Calculate overlap of n-grams
-        ngrams_text = self.generate_ngrams(text, self.n_gram)
-        ngrams_question = self.generate_ngrams(question, self.n_gram)
-        
-        # Convert n-grams to sets for efficient computation
-        set_ngrams_text = set(ngrams_text)
-        set_ngrams_question = set(ngrams_question)
-
-        # Compute the intersection of the two sets of n-grams
-        overlap = len(set_ngrams_text & set_ngrams_question)
-        
+        return self.get_filter_values(example, [question])[0]
+
+    def get_filter_values(self, example, questions):
+        """
+        Computes the n-gram overlap percentage of every question with the source text(s) of the example.
+
+        Every source text is shingled once per example. The n-grams are encoded as integer hashes
+        (see minhash.ngram_hashes) and all questions are scored with one sorted-array membership test.
+        Returns 0.0 for questions where n-grams cannot be generated, so the values of a row always have one
+        type and can be stored in a float column. As before, such questions are removed for any threshold >= 0.
+        """
+        values = [0.0] * len(questions)
+        scored = [idx for idx, question in enumerate(questions) if len(question) >= self.n_gram]
+        question_hashes = [np.unique(ngram_hashes(questions[idx], self.n_gram)) for idx in scored]
+        scored = [idx for idx, hashes in zip(scored, question_hashes) if len(hashes) > 0]
+        question_hashes = [hashes for hashes in question_hashes if len(hashes) > 0]
+        if len(scored) == 0:
+            return values
+
+        lengths = np.array([len(hashes) for hashes in question_hashes])
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        all_question_hashes = np.concatenate(question_hashes)
+        best_overlaps = None
+        for field in self.source_fields:
+            text = example.get(field) or ""
+            if len(text) < self.n_gram:
+                continue  # Do not filter examples where n-grams cannot be generated
+            text_hashes = np.unique(ngram_hashes(text, self.n_gram))
+            hits = np.isin(all_question_hashes, text_hashes).astype(np.int64)
+            overlaps = np.add.reduceat(hits, starts)
+            best_overlaps = overlaps if best_overlaps is None else np.maximum(best_overlaps, overlaps)
+        if best_overlaps is None:
+            return values
+
         # Calculate the percentage overlap
-        overlap_percentage = overlap / len(set_ngrams_question)
-        
-        # Return the result based on the threshold
-        return overlap_percentage
+        for idx, overlap, length in zip(scored, best_overlaps, lengths):
+            values[idx] = float(overlap / length)
+        return values
 
     def filter_example(self, example):
         """Filter example based on n-gram overlap between text and questions."""
@@ -50,9 +83,8 @@ class NGramFilter(Filter):
         orig_questions = example['questions']
         orig_answers = example.get('answers', [])
 
-        # Iterate over the original questions to compute overlap and filter questions
-        for question in orig_questions:
-            overlap_percentage = self.get_filter_value(example, question)
+        # Compute the overlap of all questions at once and filter questions
+        for question, overlap_percentage in zip(orig_questions, self.get_filter_values(example, orig_questions)):
             values.append(overlap_percentage)
             if overlap_percentage > self.threshold:
                 questions.append(question)
@@ -67,5 +99,7 @@ class NGramFilter(Filter):
         return example, values, len(questions) == 0
 
     def __str__(self):
+        if self.source_fields != ("text",):
+            return f"NGramFilter(n_gram={self.n_gram}, threshold={self.threshold}, source_fields={list(self.source_fields)})"
         return f"NGramFilter(n_gram={self.n_gram}, threshold={self.threshold})"
 
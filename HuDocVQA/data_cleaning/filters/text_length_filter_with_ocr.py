@@ -2,12 +2,15 @@
 from .base_filter import Filter
 
 class TextLengthFilterOCR(Filter):
+    input_columns = ["text", "ocr"]
+    output_columns = []
+
     def __init__(self, min_length: int):
         super().__init__()
         self.min_length = min_length
 
     def add_to_histogram(self, length):
-        self.hist_list.append(length)
+        self.histogram.add(length)
 
     def filter_example(self, example):
         #filter it out if both the OCR or actual text length is too short
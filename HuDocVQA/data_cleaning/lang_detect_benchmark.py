@@ -0,0 +1,70 @@
+from datasets import load_from_disk
+from filters.lang_detectors import LangdetectDetector, LangidDetector, FastTextDetector, LanguageDetectionError
+import argparse
+import time
+
+
+def detect_all(detector, strings):
+    """
+    Detect the language of every string, using None for strings whose language can not be detected.
+    Errors loading the backend (e.g. langid or fasttext not installed) are raised.
+    """
+    languages = []
+    for string in strings:
+        try:
+            languages.append(detector.detect(string))
+        except LanguageDetectionError:
+            languages.append(None)
+    return languages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the language detection backends against langdetect.")
+
+    parser.add_argument("--dataset_path", type=str, required=True,
+                        help="Path to the input dataset directory (HuggingFace format).")
+    parser.add_argument("--split", type=str, default="train",
+                        help="Split to benchmark on (default: train)")
+    parser.add_argument("--num_samples", type=int, default=1000,
+                        help="Number of examples whose text and questions are detected (default: 1000)")
+    parser.add_argument("--max_chars", type=int, default=1000,
+                        help="Text prefix length used by the truncated backends (default: 1000)")
+    parser.add_argument("--fasttext_model", type=str, default=None,
+                        help="Path to a fastText language identification model, e.g. lid.176.ftz (default: skip fastText)")
+
+    args = parser.parse_args()
+
+    dataset = load_from_disk(args.dataset_path)[args.split]
+    dataset = dataset.select_columns(["text", "questions"]).select(range(min(args.num_samples, len(dataset))))
+    strings = []
+    for example in dataset:
+        strings.append(example["text"])
+        strings.extend(example["questions"])
+
+    detectors = {
+        "langdetect (reference)": LangdetectDetector(cache_size=0),
+        "langdetect + prefix + memo": LangdetectDetector(max_chars=args.max_chars),
+        "langid + prefix + memo": LangidDetector(max_chars=args.max_chars),
+    }
+    if args.fasttext_model is not None:
+        detectors["fasttext + prefix + memo"] = FastTextDetector(args.fasttext_model, max_chars=args.max_chars)
+
+    print(f"Detecting {len(strings)} strings ({len(set(strings))} unique) from {len(dataset)} examples")
+    print(f"{'Backend':<30}{'Strings/s':>12}{'Speedup':>10}{'Agreement':>12}")
+    reference = None
+    reference_time = None
+    for name, detector in detectors.items():
+        # Load the backend's model outside of the timed region
+        detect_all(detector, ["Ez egy bemelegítő mondat."])
+        start_time = time.time()
+        languages = detect_all(detector, strings)
+        elapsed = time.time() - start_time
+        if reference is None:
+            reference = languages
+            reference_time = elapsed
+        agreement = sum(a == b for a, b in zip(languages, reference)) / max(len(strings), 1)
+        print(f"{name:<30}{len(strings) / elapsed:>12.1f}{reference_time / elapsed:>9.1f}x{agreement * 100:>11.2f}%")
+
+
+if __name__ == "__main__":
+    main()
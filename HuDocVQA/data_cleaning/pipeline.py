@@ -1,59 +1,83 @@
-from datasets import load_from_disk, Dataset, concatenate_datasets, DatasetDict
+import sys
+from pathlib import Path
+# Make the modules shared with synthetic_generation (HuDocVQA/common) importable
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from datasets import load_from_disk, Dataset, concatenate_datasets, DatasetDict, Image
 from typing import List
 import os
 import re
 import shutil
 import matplotlib.pyplot as plt
+import numpy as np
 from filters.n_gram_overlap_filter import NGramFilter
 from filters.lang_filter import LanguageFilter
 from filters.base_filter import Filter
 from filters.text_length_filter_with_ocr import TextLengthFilterOCR
 from filters.lang_filter_ocr import LanguageFilterOCR
+from filters.lang_detectors import get_detector
 from filters.deduplicate_questions_filter import DedupQuestionsFilter
+from filters.local_dedup_filter import LocalDedupQuestionsFilter
+from filters.cross_doc_dedup_filter import CrossDocDedupFilter
+from filters.fused_filter import FusedFilter, fuse_filters
+from filters.histogram import StreamingHistogram
+from filters.filter_ordering import plan_filter_order
+from common.llm_cache import LLMCache
+from common.client_pool import ClientPool
+from common.sharded_writer import ShardedArrowWriter
+from common.ocr import image_bytes
 import time
-from googletrans import Translator
+import json
+import hashlib
+from translators import GoogleTranslator, get_translator
+from sampling import ReservoirSampler, sample_indices
+from visualization import render_sample, save_contact_sheet, save_html
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import asyncio
 import argparse
 
 
+def shard_output_dir(output_dir: str, shard_index: int, num_shards: int) -> str:
+    """
+    Returns the directory where a worker of a sharded run writes the outputs of its shard.
+    """
+    return os.path.join(output_dir, "shards", f"shard_{shard_index:05d}_of_{num_shards:05d}")
+
 def check_questions_answers_length_match(dataset: DatasetDict) -> None:
     """
     Check if the length of 'questions' matches the length of 'answers' for each sample in the dataset.
     Prints a warning for any sample where the lengths do not match.
 
+    The check compares the list lengths of the two columns with Arrow compute, so no rows are materialized.
+
     Args:
         dataset (DatasetDict): A Hugging Face DatasetDict containing dataset splits.
     """
     mismatches_found = False
     for split in dataset:
         if split in ['train', 'test', 'val'] and len(dataset[split]) > 0:
-            for idx, sample in enumerate(dataset[split]):
-                try:
-                    # Check if both 'questions' and 'answers' keys exist
-                    if 'questions' in sample and 'answers' in sample:
-                        questions_len = len(sample['questions'])
-                        answers_len = len(sample['answers'])
-                        if questions_len != answers_len:
-                            mismatches_found = True
-                            print(
-                                f"Warning: Mismatch in split '{split}', sample index {idx}: "
-                                f"questions length ({questions_len}) does not match "
-                                f"answers length ({answers_len})"
-                            )
-                    else:
-                        print(
-                            f"Warning: Missing 'questions' or 'answers' in split '{split}', sample index {idx}"
-                        )
-                except Exception as e:
-                    print(
-                        f"Error processing split '{split}', sample index {idx}: {e}"
-                    )
-    
+            if 'questions' not in dataset[split].column_names or 'answers' not in dataset[split].column_names:
+                mismatches_found = True
+                print(f"Warning: Missing 'questions' or 'answers' in split '{split}'")
+                continue
+            questions_lens = Filter.list_lengths(dataset[split], 'questions')
+            answers_lens = Filter.list_lengths(dataset[split], 'answers')
+            for idx in np.flatnonzero(questions_lens != answers_lens):
+                mismatches_found = True
+                print(
+                    f"Warning: Mismatch in split '{split}', sample index {idx}: "
+                    f"questions length ({questions_lens[idx]}) does not match "
+                    f"answers length ({answers_lens[idx]})"
+                )
+
     if not mismatches_found:
         print("All samples have matching questions and answers lengths.")
 
 class DatasetFilteringPipeline:
-    def __init__(self, filters: List[Filter], output_dir: str, save_intermediate: str = "none", subsample_size: int = 10):
+    def __init__(self, filters: List[Filter], output_dir: str, save_intermediate: str = "none", subsample_size: int = 10,
+                 num_proc: int = None, batch_size: int = 1000, checkpoint_dir: str = None, resume: bool = False,
+                 checkpoint_shard_size: int = None, plan: list = None, translator=None, seed: int = 0,
+                 viz_format: str = "png", viz_workers: int = 4, thumbnail_size: int = 512):
         """
         Initialize the pipeline.
 
@@ -62,12 +86,44 @@ class DatasetFilteringPipeline:
             output_dir (str): The directory where the output will be saved.
             save_intermediate (str, optional): How to save intermediate datasets. Options are "all", "subsample", and "none". Defaults to "none".
             subsample_size (int, optional): The number of examples to save when using subsampling. Defaults to 10.
+            num_proc (int, optional): Number of worker processes used by each filter. Defaults to None (single process).
+            batch_size (int, optional): Number of examples each filter processes per batch. Defaults to 1000.
+            checkpoint_dir (str, optional): Directory where the output of every stage is checkpointed, keyed by the
+                filter configuration and the input dataset fingerprint. Defaults to None (no checkpoints).
+            resume (bool, optional): Reuse the checkpoints of completed stages and shards. Defaults to False.
+            checkpoint_shard_size (int, optional): Number of rows per checkpoint shard within a stage, so an
+                interrupted stage resumes from its last completed shard. Defaults to None (one shard per split).
+            plan (list, optional): The filter order chosen by plan_filter_order, reported in the summary table.
+                Defaults to None.
+            translator (Translator, optional): Translates the questions and texts shown in the visualizations
+                (see translators.py). Defaults to GoogleTranslator without a persistent cache.
+            seed (int, optional): Seed of the intermediate subsamples, so runs with the same seed save the same
+                examples. Defaults to 0.
+            viz_format (str, optional): Output of the subsample visualizations: "png" (a contact sheet of one small
+                figure per sample), "html" (a page with the thumbnails and texts) or "both". Defaults to "png".
+            viz_workers (int, optional): Number of processes rendering the visualization samples, 0 to render them
+                in the main process. Defaults to 4.
+            thumbnail_size (int, optional): Maximum side in pixels of the document images in the visualizations.
+                Defaults to 512.
         """
         self.filters = filters
         self.output_dir = output_dir
         self.save_intermediate = save_intermediate
         self.subsample_size = subsample_size
-        self.translator = Translator()
+        self.num_proc = num_proc
+        self.batch_size = batch_size
+        self.checkpoint_dir = checkpoint_dir
+        self.resume = resume
+        self.checkpoint_shard_size = checkpoint_shard_size
+        self.plan = plan
+        self.translator = translator if translator is not None else GoogleTranslator()
+        self.seed = seed
+        if viz_format not in ("png", "html", "both"):
+            raise ValueError(f"Unknown visualization format {viz_format}, use png, html or both")
+        self.viz_format = viz_format
+        self.viz_workers = viz_workers
+        self.thumbnail_size = thumbnail_size
+        self._viz_executor = None
 
     def _create_intermediate_dir(self):
         intermediate_dir = os.path.join(self.output_dir, "intermediate")
@@ -79,12 +135,49 @@ class DatasetFilteringPipeline:
 
     def _get_total_questions(self, dataset):
         return sum(
-            sum(len(row['questions']) for row in dataset[split]) 
-            for split in ['train', 'test', 'val'] 
+            int(Filter.list_lengths(dataset[split], 'questions').sum())
+            for split in ['train', 'test', 'val']
             if split in dataset
         )
+
+    def _sum_stats(self, filter_i, key):
+        """
+        Sums a count recorded by the last apply call of a filter over the train, test and val splits.
+        """
+        return sum(stats[key] for split, stats in filter_i.stats.items() if split in ['train', 'test', 'val'])
     
 
+    def _input_key(self, dataset):
+        """
+        Returns a key identifying the input dataset, from the fingerprints of its splits.
+        """
+        fingerprints = {split: dataset[split]._fingerprint for split in dataset}
+        return hashlib.sha256(json.dumps(fingerprints, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _describe_config(self, obj, depth=0):
+        """
+        Returns the simple attributes of an object (and of the helper objects it holds, e.g. detectors),
+        leaving out state such as histograms, credentials and clients.
+        """
+        config = {}
+        for name, value in vars(obj).items():
+            if name in ("histogram", "hist_counts", "api_key", "client", "cache", "engine", "pool") or name.startswith("_"):
+                continue
+            if isinstance(value, (str, int, float, bool, list, tuple, type(None))):
+                config[name] = value
+            elif depth < 2 and hasattr(value, "__dict__") and not callable(value):
+                config[name] = {"class": type(value).__name__, **self._describe_config(value, depth + 1)}
+        return config
+
+    def _stage_key(self, input_key, filter_i):
+        """
+        Returns a key identifying a stage, from its input key and the configuration of its filter.
+        """
+        config = {"filter": type(filter_i).__name__, "shard_size": self.checkpoint_shard_size,
+                  "config": self._describe_config(filter_i)}
+        config = json.dumps(config, sort_keys=True, default=str)
+        return hashlib.sha256((input_key + config).encode("utf-8")).hexdigest()
+
     def _split_has_data(self, split, dataset):
         return split in dataset and len(dataset[split]) > 0
 
@@ -95,40 +188,65 @@ class DatasetFilteringPipeline:
                 return False
         return True
 
-    def _subsample_dataset(self, dataset, size):
+    def _subsample_dataset(self, dataset, size, seed=None):
         """
-        Subsample the dataset.
+        Subsample the dataset by selecting random indices of every split, without shuffling the whole split.
 
         Args:
             dataset (DatasetDict): A Hugging Face DatasetDict object containing dataset splits (e.g., {"train": train_dataset, "test": test_dataset}).
             size (int): The number of examples to keep.
+            seed (list, optional): Seed of the sample, a list of ints extended with the index of each split.
 
         Returns:
             Dataset: The subsampled dataset as a single Hugging Face Dataset.
         """
         subsampled_splits = {}
-        for split in dataset:
-            # Ensure we don't try to select more samples than exist in the split
-            actual_size = min(size, len(dataset[split]))
+        for split_idx, split in enumerate(dataset):
             if len(dataset[split]) > 0:
-                subsampled_splits[split] = dataset[split].shuffle().select(range(actual_size))
+                split_seed = list(seed) + [split_idx] if seed is not None else None
+                subsampled_splits[split] = dataset[split].select(sample_indices(len(dataset[split]), size, split_seed))
             
         # Concatenate all splits into a single Dataset
         return DatasetDict(subsampled_splits)
 
+    def _get_viz_executor(self):
+        """
+        Returns the process pool rendering the visualization samples, created on first use and shared by all
+        stages, or None to render them in this process.
+        """
+        if self.viz_workers == 0:
+            return None
+        if self._viz_executor is None:
+            self._viz_executor = ProcessPoolExecutor(max_workers=self.viz_workers)
+        return self._viz_executor
+
+    def _close_viz_executor(self):
+        if self._viz_executor is not None:
+            self._viz_executor.shutdown()
+            self._viz_executor = None
+
     async def _visualize_multimodal_dataset(self, dataset, path, max_samples=None):
         """
         Visualize a multimodal dataset by saving images with their corresponding questions and text.
+
+        Every image is downscaled to a thumbnail and drawn in a small figure of its own in the visualization
+        process pool, so the time and memory per sample do not depend on the scan resolution. The figures are
+        pasted into a contact sheet saved at path and/or written with the thumbnails to an HTML page next to it,
+        depending on viz_format.
+
         Args:
             dataset (dict): A dictionary of dataset splits.
             path (str): The path to save the visualization image.
             max_samples (int, optional): Maximum number of samples to visualize. 
                                         If None, uses a default limit of 20 samples.
         """
-        # Collect samples
+        # Collect samples, leaving the images encoded
         samples = []
         for split in dataset.keys():
-            for data_pt in dataset[split]:
+            split_dataset = dataset[split]
+            if isinstance(split_dataset.features.get('image'), Image):
+                split_dataset = split_dataset.cast_column('image', Image(decode=False))
+            for data_pt in split_dataset:
                 if len(samples) < (max_samples or 20):
                     samples.append(data_pt)
                 else:
@@ -154,63 +272,67 @@ class DatasetFilteringPipeline:
         samples = samples[:max_display_samples]
         num_samples = len(samples)
         
-        # Create a figure with controlled height
-        plt.figure(figsize=(10, min(10 * num_samples, 100)))
-        
-        # Create a vertical layout
+        # Translate all questions and texts concurrently before drawing
+        questions = [sample['questions'][0][:100] if sample.get('questions') else '' for sample in samples]
+        texts = [(sample.get('text') or '')[:100] for sample in samples]
+        translations = await self.translator.translate_all(questions + texts)
+        questions_english, texts_english = translations[:num_samples], translations[num_samples:]
+
+        renders = []
         for i, sample in enumerate(samples):
-            try:
-                plt.subplot(num_samples, 1, i + 1)
-                
-                # Check if the sample has the expected keys
-                if all(key in sample for key in ['image', 'questions', 'text']):
-                    plt.imshow(sample['image'])
-                    
-                    # Truncate text for display
-                    question = sample['questions'][0][:100]
-                    text = sample['text'][:100]
-                    translated_question = await self.translator.translate(question)
-                    question_english = translated_question.text
-
-                    translated_text = await self.translator.translate(text)
-                    text_english = translated_text.text
-                    value = sample['filter_value']
-                    if isinstance(value, float):
-                        value = round(value, 4)
-                    title = (
-                        f"--------------------------------------------------------------------------\n"
-                        f"Sample {i+1}\n"
-                        f"Filter value: {value}\n"
-                        f"Question (Original):\n{question}{'...' if len(question) > 100 else ''}\n\n"
-                        f"Question (English):\n{question_english}{'...' if len(question_english) > 100 else ''}\n\n"
-                        f"Text (Original):\n{text}{'...' if len(text) > 200 else ''}\n\n"
-                        f"Text (English):\n{text_english}{'...' if len(text_english) > 200 else ''}\n\n"
-                    )
-                    title = title.replace('$', "[DOLLAR]")
-                    plt.title(
-                        title,
-                        fontsize=14, 
-                        wrap=True
-                    )
-                else:
-                    plt.text(0.5, 0.5, 'Invalid sample', ha='center', va='center')
-                
-                plt.axis('off')
-            except Exception as e:
-                print(f"Error processing sample {i}: {e}")
-        
-        # Adjust layout and save
-        plt.tight_layout()
-        
-        try:
-            plt.savefig(path, bbox_inches='tight', dpi=300)
-        except ValueError as ve:
-            # Fallback: reduce DPI if image is still too large
-            print(f"Warning: Reduced DPI due to large image size. Original error: {ve}")
-            plt.savefig(path, bbox_inches='tight', dpi=100)
-        
-        plt.close()  # Close the figure to free up memory
-        print(f"Dataset visualization saved to {path}")
+            # Check if the sample has the expected keys
+            if all(key in sample for key in ['image', 'questions', 'text']) and sample['image'] is not None:
+                data = image_bytes(sample['image'])
+                # Truncate text for display
+                question = questions[i]
+                text = texts[i]
+                question_english = questions_english[i]
+                text_english = texts_english[i]
+                # Streaming subsamples have no filter value
+                value = sample.get('filter_value')
+                if isinstance(value, float):
+                    value = round(value, 4)
+                title = (
+                    f"Sample {i+1}\n"
+                    f"Filter value: {value}\n"
+                    f"Question (Original):\n{question}{'...' if len(question) > 100 else ''}\n\n"
+                    f"Question (English):\n{question_english}{'...' if len(question_english) > 100 else ''}\n\n"
+                    f"Text (Original):\n{text}{'...' if len(text) > 200 else ''}\n\n"
+                    f"Text (English):\n{text_english}{'...' if len(text_english) > 200 else ''}"
+                )
+            else:
+                data, title = None, f"Sample {i+1}"
+            renders.append((data, title))
+
+        render_figure = self.viz_format in ("png", "both")
+        jobs = [partial(render_sample, data, title.replace('$', "[DOLLAR]"), thumbnail_size=self.thumbnail_size,
+                        render_figure=render_figure) for data, title in renders]
+        executor = self._get_viz_executor()
+        if executor is None:
+            results = []
+            for job in jobs:
+                try:
+                    results.append(job())
+                except Exception as e:
+                    results.append(e)
+        else:
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(*[loop.run_in_executor(executor, job) for job in jobs], return_exceptions=True)
+        rendered = []
+        for i, result in enumerate(results):
+            if isinstance(result, Exception):
+                print(f"Error processing sample {i}: {result}")
+            else:
+                rendered.append((result, renders[i][1]))
+
+        if render_figure and len(rendered) > 0:
+            save_contact_sheet([figure for (figure, _), _ in rendered], path)
+            print(f"Dataset visualization saved to {path}")
+        if self.viz_format in ("html", "both"):
+            html_path = os.path.splitext(path)[0] + ".html"
+            save_html([(thumbnail, title) for (_, thumbnail), title in rendered], html_path,
+                      heading=os.path.splitext(os.path.basename(path))[0])
+            print(f"Dataset visualization saved to {html_path}")
 
     def _plot_remaining_samples(self, num_samples, original_length, filter_names):
         filter_names = list(map(self.insert_newline_before_parenthesis, filter_names))
@@ -237,6 +359,7 @@ class DatasetFilteringPipeline:
         ax.axis('off')
         
         # Format filter names to handle line breaks
+        filter_names_raw = filter_names
         filter_names = list(map(self.insert_newline_before_parenthesis, filter_names))
         
         # Prepare table data
@@ -248,6 +371,19 @@ class DatasetFilteringPipeline:
             ["Removed Questions"] + [str(x) for x in questions_removed],
             ["Filter Time per\n1000 Samples (s)"] + filter_times_per_sample
         ]
+        if self.plan is not None:
+            # Position of every stage in the original filter order and its profiled cost and selectivity
+            plan = {step["filter"]: step for step in self.plan}
+            steps = [plan.get(name) for name in filter_names_raw[1:]]
+            table_data += [
+                ["Original Position"] + ["-"] + [str(step["original_position"] + 1) if step else "-" for step in steps],
+                ["Profiled Time per\n1000 Samples (s)"] + ["-"] + [
+                    f"{step['time_per_1000_samples']:.3f}" if step and step["time_per_1000_samples"] is not None else "-" for step in steps
+                ],
+                ["Profiled\nRejection Rate"] + ["-"] + [
+                    f"{step['rejection_rate'] * 100:.1f}%" if step and step["rejection_rate"] is not None else "-" for step in steps
+                ],
+            ]
         
         # Create and style the table
         table = ax.table(
@@ -275,6 +411,77 @@ class DatasetFilteringPipeline:
         print(f"Filtering summary table saved as an image at {output_path}")
 
 
+    def _report_stage(self, i, filter_i, remaining_dataset, removed_dataset, filter_time, intermediate_dir,
+                      original_length, num_samples, filter_names, remaining_samples, removed_samples,
+                      filter_times_per_sample, questions_remaining_list, questions_removed_list):
+        """
+        Records the summary counts of a filter stage from the counts the filter recorded during its pass,
+        plots its histogram and saves its intermediate datasets.
+        """
+        # The counts before a filter are the counts after the previous one
+        num_samples_before = remaining_samples[-1]
+        questions_before = questions_remaining_list[-1]
+        num_samples_after = self._sum_stats(filter_i, "rows_kept")
+        questions_after = self._sum_stats(filter_i, "questions_kept")
+        if self._sum_stats(filter_i, "length_mismatches") > 0:
+            check_questions_answers_length_match(remaining_dataset)
+        else:
+            print("All samples have matching questions and answers lengths.")
+        filter_time_per_1000_samples = 1000 * (filter_time / num_samples_before) if num_samples_before > 0 else 0
+
+        num_samples.append(num_samples_after)
+        filter_names.append(str(filter_i))
+
+        remaining_samples.append(num_samples_after)
+        questions_remaining_list.append(questions_after)
+        removed_samples.append(num_samples_before - num_samples_after)
+        questions_removed_list.append(questions_before - questions_after)
+        filter_times_per_sample.append(f"{filter_time_per_1000_samples:.3f}")
+
+        histogram_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_histogram.png")
+        filter_i.plot_histogram(histogram_path)
+
+        print(f"Applied filter {filter_i}. Remaining samples: {num_samples_after} ({num_samples_after / original_length * 100:.2f}%)")
+        print(f"Filter time per 1000 samples: {filter_time_per_1000_samples:.3f} s")
+
+        if self.save_intermediate == "all":
+            remaining_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_remaining")
+            removed_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_removed")
+            remaining_dataset.save_to_disk(remaining_path)
+            removed_dataset.save_to_disk(removed_path)
+        elif self.save_intermediate == "subsample":
+            subsampled_remaining_dataset = self._subsample_dataset(remaining_dataset, self.subsample_size, seed=[self.seed, i, 0])
+            subsampled_removed_dataset = self._subsample_dataset(removed_dataset, self.subsample_size, seed=[self.seed, i, 1])
+            self._save_subsamples(i, filter_i, intermediate_dir, subsampled_remaining_dataset, subsampled_removed_dataset)
+
+    def _save_subsamples(self, i, filter_i, intermediate_dir, subsampled_remaining_dataset, subsampled_removed_dataset):
+        """
+        Saves and visualizes the subsamples of the examples kept and removed by a filter stage.
+        """
+        remaining_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_remaining_subsample")
+        removed_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_removed_subsample")
+
+        # Save subsampled datasets
+        subsampled_remaining_dataset.save_to_disk(remaining_path)
+        subsampled_removed_dataset.save_to_disk(removed_path)
+
+        # Visualize subsampled datasets
+        remaining_viz_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_remaining_subsample_viz.png")
+        removed_viz_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_removed_subsample_viz.png")
+
+        asyncio.run(self._visualize_subsamples([(subsampled_remaining_dataset, remaining_viz_path),
+                                                (subsampled_removed_dataset, removed_viz_path)]))
+
+    async def _visualize_subsamples(self, datasets_and_paths):
+        """
+        Visualizes several subsampled datasets concurrently: the samples of all of them are translated at the same
+        time and their figures are rendered in the visualization process pool (see _visualize_multimodal_dataset).
+        """
+        await asyncio.gather(*[
+            self._visualize_multimodal_dataset(dataset, path, max_samples=self.subsample_size)
+            for dataset, path in datasets_and_paths
+        ])
+
     def run(self, dataset: Dataset) -> None:
         intermediate_dir = self._create_intermediate_dir()
 
@@ -282,72 +489,295 @@ class DatasetFilteringPipeline:
         num_samples = [original_length]
         filter_names = ["Input\nDataset"]
         remaining_samples = [original_length]
-        questions_remaining_list = [self._get_total_questions(dataset)]
+        total_questions = self._get_total_questions(dataset)
+        questions_remaining_list = [total_questions]
         questions_removed_list = [0]
         removed_samples = [0]
         filter_times_per_sample = [0]
         remaining_dataset = dataset
-        
+        stage_key = self._input_key(dataset) if self.checkpoint_dir is not None else None
+        stage_index = 0
+        # The filter and time of every reported stage, recorded for sharded runs
+        self._stages = []
+
         for i, filter_i in enumerate(self.filters):
-            if remaining_dataset is not None:
-                num_samples_before = self._get_total_length(remaining_dataset)
-                questions_before = self._get_total_questions(remaining_dataset)
-            else:
-                num_samples_before = original_length
-                questions_before = self._get_total_questions(dataset)
+            stage_dir = None
+            stage_state = None
+            if self.checkpoint_dir is not None:
+                stage_key = self._stage_key(stage_key, filter_i)
+                stage_dir = os.path.join(self.checkpoint_dir, f"stage_{i}_{stage_key[:16]}")
+                state_path = os.path.join(stage_dir, "state.json")
+                if self.resume and os.path.exists(state_path):
+                    with open(state_path) as f:
+                        stage_state = json.load(f)
+                    print(f"Resuming {filter_i} from completed checkpoint {stage_dir}")
+                elif os.path.exists(stage_dir) and not self.resume:
+                    shutil.rmtree(stage_dir)
 
             start_time = time.time()
-            remaining_dataset, removed_dataset = filter_i.apply(remaining_dataset)
-            check_questions_answers_length_match(remaining_dataset)
+            remaining_dataset, removed_dataset = filter_i.apply(
+                remaining_dataset,
+                num_proc=self.num_proc,
+                batch_size=self.batch_size,
+                checkpoint_dir=stage_dir,
+                checkpoint_shard_size=self.checkpoint_shard_size
+            )
             end_time = time.time()
 
-            num_samples_after = self._get_total_length(remaining_dataset)
-            questions_after = self._get_total_questions(remaining_dataset)
             filter_time = end_time - start_time
-            filter_time_per_1000_samples = 1000 * (filter_time / num_samples_before) if num_samples_before > 0 else 0
+            if stage_state is not None:
+                # Report the time of the run that computed the stage, not of loading its checkpoint
+                filter_time = stage_state["filter_time"]
+            elif stage_dir is not None:
+                os.makedirs(stage_dir, exist_ok=True)
+                with open(os.path.join(stage_dir, "state.json"), "w") as f:
+                    json.dump({"filter": str(filter_i), "filter_time": filter_time}, f)
+
+            # A fused filter reports each of its filters as a separate stage
+            for stage_filter, stage_remaining, stage_removed, stage_time in filter_i.stages(remaining_dataset, removed_dataset, filter_time):
+                self._report_stage(stage_index, stage_filter, stage_remaining, stage_removed, stage_time, intermediate_dir,
+                                   original_length, num_samples, filter_names, remaining_samples, removed_samples,
+                                   filter_times_per_sample, questions_remaining_list, questions_removed_list)
+                stage_index += 1
+                self._stages.append((stage_filter, stage_time))
+
+        self._close_viz_executor()
+        self._plot_remaining_samples(num_samples, original_length, filter_names)
+        self._create_summary_table(filter_names, remaining_samples, removed_samples, filter_times_per_sample, questions_remaining_list, questions_removed_list)
+
+        final_path = os.path.join(self.output_dir, 'final_dataset')
+        remaining_dataset.save_to_disk(final_path)
+    def _iter_batches(self, dataset):
+        """
+        Yields the rows of a split in batches of self.batch_size, without decoding images.
+        """
+        if isinstance(dataset, Dataset):
+            dataset = dataset.to_iterable_dataset()
+        yield from dataset.decode(False).iter(batch_size=self.batch_size)
+
+    def run_streaming(self, dataset, shard_size: int = 10000) -> None:
+        """
+        Runs all filters lazily over a stream of row batches instead of materializing a dataset after every filter.
+
+        Every batch is passed through the filters in order and only the rows kept by a filter reach the next one.
+        Kept rows are written to output_dir/streaming/kept/<split> and the rows removed by each filter to
+        output_dir/streaming/removed/<filter>_<index>/<split>, as Arrow shards of at most shard_size rows, so
+        memory use is bounded by the batch size. Histograms, the summary table and the remaining samples plot are
+        produced as in run. With save_intermediate="subsample", the rows kept and removed by every filter are
+        reservoir sampled as they stream by, then saved and visualized as in run; the removed rows of every filter
+        are written anyway, so "all" saves nothing more.
+
+        Args:
+            dataset (DatasetDict or IterableDatasetDict): The splits to filter. Datasets on disk are read as
+                memory-mapped Arrow tables, e.g. from load_from_disk, or load_dataset(..., streaming=True).
+            shard_size (int, optional): Maximum number of rows per output shard. Defaults to 10000.
+        """
+        for filter_i in self.filters:
+            if not filter_i.supports_streaming:
+                raise ValueError(f"{filter_i} needs a pass over the whole dataset and can not be run in streaming mode")
+        intermediate_dir = self._create_intermediate_dir()
+        stream_dir = os.path.join(self.output_dir, "streaming")
+
+        filter_times = [0.0] * len(self.filters)
+        for filter_i in self.filters:
+            filter_i.stats = {}
+        subsample = self.save_intermediate == "subsample"
+        # Reservoirs of the rows kept and removed by every filter, by split
+        kept_samplers = [{} for _ in self.filters]
+        removed_samplers = [{} for _ in self.filters]
+        split_features = {}
+        for split_idx, split in enumerate(dataset):
+            features = dataset[split].features
+            split_features[split] = features
+            if subsample:
+                for i in range(len(self.filters)):
+                    kept_samplers[i][split] = ReservoirSampler(self.subsample_size, seed=[self.seed, i, 0, split_idx])
+                    removed_samplers[i][split] = ReservoirSampler(self.subsample_size, seed=[self.seed, i, 1, split_idx])
+            kept_writer = ShardedArrowWriter(os.path.join(stream_dir, "kept", split), features, shard_size)
+            removed_writers = [
+                ShardedArrowWriter(os.path.join(stream_dir, "removed", f"{str(filter_i)}_{i}", split), features, shard_size)
+                for i, filter_i in enumerate(self.filters)
+            ]
+            for batch in self._iter_batches(dataset[split]):
+                for i, filter_i in enumerate(self.filters):
+                    start_time = time.time()
+                    batch, removed_batch = filter_i.apply_batch(batch, split)
+                    filter_times[i] += time.time() - start_time
+                    removed_writers[i].write_batch(removed_batch)
+                    if subsample:
+                        kept_samplers[i][split].add_batch(batch)
+                        removed_samplers[i][split].add_batch(removed_batch)
+                    if len(next(iter(batch.values()), [])) == 0:
+                        break
+                kept_writer.write_batch(batch)
+            kept_writer.close()
+            for writer in removed_writers:
+                writer.close()
+            print(f"Filtered split {split}: {kept_writer.num_rows} rows kept in {kept_writer.num_shards} shards")
+
+        if subsample:
+            for i, filter_i in enumerate(self.filters):
+                subsampled_remaining_dataset, subsampled_removed_dataset = [
+                    DatasetDict({split: sampler.to_dataset(split_features[split])
+                                 for split, sampler in samplers[i].items() if len(sampler.rows) > 0})
+                    for samplers in (kept_samplers, removed_samplers)
+                ]
+                self._save_subsamples(i, filter_i, intermediate_dir, subsampled_remaining_dataset, subsampled_removed_dataset)
+
+        self._close_viz_executor()
+        self._report_stats(self.filters, filter_times, intermediate_dir)
+
+    def _stage_filters(self):
+        """
+        Returns the filters reported as stages, in order: the filters of a FusedFilter are reported separately.
+        """
+        return [stage_filter for filter_i in self.filters
+                for stage_filter in (filter_i.filters if isinstance(filter_i, FusedFilter) else [filter_i])]
+
+    def run_shard(self, dataset: DatasetDict, shard_index: int, num_shards: int) -> None:
+        """
+        Runs all filters on one shard of every split, as one worker of a sharded run (see merge_shards).
+
+        Every split is cut into num_shards contiguous shards, so the shards are the same in every worker and
+        concatenating them in order gives back the split. The shard is filtered with run, writing its
+        final_dataset, intermediate datasets and plots to output_dir. The counts, histogram and time of every
+        stage are written to output_dir/shard_state.json for the merge.
+
+        Args:
+            dataset (DatasetDict): The full dataset, the same in every worker.
+            shard_index (int): The shard of this worker, from 0 to num_shards - 1.
+            num_shards (int): The number of shards (workers).
+        """
+        for filter_i in self._stage_filters():
+            if not filter_i.supports_streaming:
+                raise ValueError(f"{filter_i} needs a pass over the whole dataset and can not be run on shards")
+        shard = DatasetDict({
+            split: dataset[split].shard(num_shards=num_shards, index=shard_index, contiguous=True)
+            for split in dataset
+        })
+        print(f"Filtering shard {shard_index + 1}/{num_shards}: {self._get_total_length(shard)} samples")
+        self.run(shard)
+
+        state = {
+            "shard_index": shard_index,
+            "num_shards": num_shards,
+            "stages": [
+                {
+                    "filter": str(stage_filter),
+                    "filter_time": stage_time,
+                    "stats": stage_filter.stats,
+                    "histogram": stage_filter.histogram.state(),
+                    "hist_counts": stage_filter.hist_counts,
+                }
+                for stage_filter, stage_time in self._stages
+            ],
+        }
+        # Written last, so a shard with a state file is complete
+        with open(os.path.join(self.output_dir, "shard_state.json"), "w") as f:
+            json.dump(state, f)
+
+    def merge_shards(self, num_shards: int) -> None:
+        """
+        Merges the outputs of the num_shards workers of a sharded run, written to the shard directories of
+        output_dir (see shard_output_dir), into the outputs of a single run: final_dataset, the histograms, the
+        remaining samples plot and the summary table.
+
+        The counts, histograms and final datasets are the same as those of a single run over the whole dataset.
+        The filter times are summed over the workers. The intermediate datasets stay in the shard directories.
+
+        Args:
+            num_shards (int): The number of shards of the run.
+        """
+        shard_dirs = [shard_output_dir(self.output_dir, shard_index, num_shards) for shard_index in range(num_shards)]
+        missing = [shard_dir for shard_dir in shard_dirs if not os.path.exists(os.path.join(shard_dir, "shard_state.json"))]
+        if missing:
+            raise FileNotFoundError(f"{len(missing)} of {num_shards} shards are not finished: {', '.join(missing)}")
+        states = []
+        for shard_dir in shard_dirs:
+            with open(os.path.join(shard_dir, "shard_state.json")) as f:
+                states.append(json.load(f))
+
+        stage_filters = self._stage_filters()
+        filter_names = [str(filter_i) for filter_i in stage_filters]
+        for shard_dir, state in zip(shard_dirs, states):
+            shard_filter_names = [stage["filter"] for stage in state["stages"]]
+            if shard_filter_names != filter_names:
+                raise ValueError(f"The filters of {shard_dir} ({', '.join(shard_filter_names)}) differ from the "
+                                 f"filters of the merge ({', '.join(filter_names)})")
+
+        filter_times = []
+        for i, filter_i in enumerate(stage_filters):
+            stages = [state["stages"][i] for state in states]
+            filter_i.stats = {}
+            for stage in stages:
+                for split, split_stats in stage["stats"].items():
+                    merged_stats = filter_i.stats.setdefault(split, dict.fromkeys(split_stats, 0))
+                    for key, value in split_stats.items():
+                        merged_stats[key] += value
+            filter_i.histogram = StreamingHistogram.from_state(stages[0]["histogram"])
+            filter_i.hist_counts = dict(stages[0]["hist_counts"])
+            for stage in stages[1:]:
+                filter_i.histogram.merge(StreamingHistogram.from_state(stage["histogram"]))
+                for key, count in stage["hist_counts"].items():
+                    filter_i.hist_counts[key] = filter_i.hist_counts.get(key, 0) + count
+            filter_times.append(sum(stage["filter_time"] for stage in stages))
+
+        intermediate_dir = self._create_intermediate_dir()
+        self._report_stats(stage_filters, filter_times, intermediate_dir)
+
+        # Contiguous shards concatenated in order give the rows in the order of a single run
+        final_datasets = [load_from_disk(os.path.join(shard_dir, "final_dataset")) for shard_dir in shard_dirs]
+        final_dataset = DatasetDict({
+            split: concatenate_datasets([shard_final[split] for shard_final in final_datasets])
+            for split in final_datasets[0]
+        })
+        final_path = os.path.join(self.output_dir, 'final_dataset')
+        final_dataset.save_to_disk(final_path)
+        print(f"Merged {num_shards} shards into {final_path}")
+
+    def _report_stats(self, filters, filter_times, intermediate_dir):
+        """
+        Reports every filter from the counts and histogram it recorded, and creates the remaining samples plot
+        and the summary table, without the filtered datasets (streaming and merged sharded runs).
+
+        Args:
+            filters (List[Filter]): The filters, in the order they were applied.
+            filter_times (List[float]): The time spent in every filter, in seconds.
+            intermediate_dir (str): The directory the histograms are saved to.
+        """
+        original_length = self._sum_stats(filters[0], "rows_in") if filters else 0
+        num_samples = [original_length]
+        filter_names = ["Input\nDataset"]
+        remaining_samples = [original_length]
+        questions_remaining_list = [self._sum_stats(filters[0], "questions_in") if filters else 0]
+        questions_removed_list = [0]
+        removed_samples = [0]
+        filter_times_per_sample = [0]
+        for i, filter_i in enumerate(filters):
+            num_samples_before = self._sum_stats(filter_i, "rows_in")
+            num_samples_after = self._sum_stats(filter_i, "rows_kept")
+            questions_after = self._sum_stats(filter_i, "questions_kept")
+            filter_time_per_1000_samples = 1000 * (filter_times[i] / num_samples_before) if num_samples_before > 0 else 0
+            mismatches = self._sum_stats(filter_i, "length_mismatches")
+            if mismatches > 0:
+                print(f"Warning: {mismatches} samples kept by {filter_i} have mismatching questions and answers lengths")
 
             num_samples.append(num_samples_after)
             filter_names.append(str(filter_i))
-            
             remaining_samples.append(num_samples_after)
             questions_remaining_list.append(questions_after)
             removed_samples.append(num_samples_before - num_samples_after)
-            questions_removed_list.append(questions_before - questions_after)
+            questions_removed_list.append(self._sum_stats(filter_i, "questions_in") - questions_after)
             filter_times_per_sample.append(f"{filter_time_per_1000_samples:.3f}")
 
             histogram_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_histogram.png")
             filter_i.plot_histogram(histogram_path)
-
-            print(f"Applied filter {filter_i}. Remaining samples: {num_samples_after} ({num_samples_after / original_length * 100:.2f}%)")
+            print(f"Applied filter {filter_i}. Remaining samples: {num_samples_after} ({num_samples_after / max(original_length, 1) * 100:.2f}%)")
             print(f"Filter time per 1000 samples: {filter_time_per_1000_samples:.3f} s")
 
-            if self.save_intermediate == "all":
-                remaining_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_remaining")
-                removed_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_removed")
-                remaining_dataset.save_to_disk(remaining_path)
-                removed_dataset.save_to_disk(removed_path)
-            elif self.save_intermediate == "subsample":
-                subsampled_remaining_dataset = self._subsample_dataset(remaining_dataset, self.subsample_size)
-                subsampled_removed_dataset = self._subsample_dataset(removed_dataset, self.subsample_size)
-                remaining_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_remaining_subsample")
-                removed_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_removed_subsample")
-                
-                # Save subsampled datasets
-                subsampled_remaining_dataset.save_to_disk(remaining_path)
-                subsampled_removed_dataset.save_to_disk(removed_path)
-                
-                # Visualize subsampled datasets
-                remaining_viz_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_remaining_subsample_viz.png")
-                removed_viz_path = os.path.join(intermediate_dir, f"{str(filter_i)}_{i}_removed_subsample_viz.png")
-                
-                asyncio.run(self._visualize_multimodal_dataset(subsampled_remaining_dataset, remaining_viz_path, max_samples=self.subsample_size))
-                asyncio.run(self._visualize_multimodal_dataset(subsampled_removed_dataset, removed_viz_path, max_samples=self.subsample_size))
-
         self._plot_remaining_samples(num_samples, original_length, filter_names)
         self._create_summary_table(filter_names, remaining_samples, removed_samples, filter_times_per_sample, questions_remaining_list, questions_removed_list)
 
-        final_path = os.path.join(self.output_dir, 'final_dataset')
-        remaining_dataset.save_to_disk(final_path)
 def main():
     parser = argparse.ArgumentParser(description="Run multimodal dataset filtering pipeline.")
 
@@ -355,36 +785,202 @@ def main():
                         help="Path to the input dataset directory (HuggingFace format).")
     parser.add_argument("--output_dir", type=str, required=True,
                         help="Directory where filtered dataset and outputs will be saved.")
-    parser.add_argument("--sn_api_key", type=str, required=True,
-                        help="SambaNova Cloud API key.")
+    parser.add_argument("--sn_api_key", type=str, default=None,
+                        help="SambaNova Cloud API key. Required unless --dedup_engine=local without --local_dedup_borderline.")
     parser.add_argument("--sn_model", type=str, default="Meta-Llama-3.1-8B-Instruct",
                         help="SambaNova cloud model name (default: Meta-Llama-3.1-8B-Instruct)")
+    parser.add_argument("--sn_base_url", type=str, default="https://api.sambanova.ai/v1",
+                        help="Base URL of the OpenAI-compatible API (default: https://api.sambanova.ai/v1)")
+    parser.add_argument("--client_config", type=str, default=None,
+                        help="JSON file listing several OpenAI-compatible endpoints and keys to spread the deduplication "
+                             "requests over, instead of --sn_base_url and --sn_api_key")
+    parser.add_argument("--dedup_async", action="store_true",
+                        help="Send the deduplication requests of a batch concurrently")
+    parser.add_argument("--dedup_max_concurrency", type=int, default=8,
+                        help="Maximum number of deduplication requests in flight with --dedup_async (default: 8)")
+    parser.add_argument("--dedup_requests_per_second", type=float, default=None,
+                        help="Deduplication request rate limit with --dedup_async (default: no limit)")
+    parser.add_argument("--dedup_batch_documents", type=int, default=None,
+                        help="Deduplicate the question lists of up to this many documents per request, answered as JSON "
+                             "keyed by document ID (default: one request per document)")
+    parser.add_argument("--dedup_context_length", type=int, default=8192,
+                        help="Context length of --sn_model in tokens, bounding the batches of --dedup_batch_documents (default: 8192)")
+    parser.add_argument("--ngram_source_fields", nargs="+", choices=["text", "ocr"], default=["text"],
+                        help="Fields the n-gram filter compares questions to, e.g. 'text ocr' (default: text)")
+    parser.add_argument("--lang_detector", choices=["langdetect", "langid", "fasttext"], default="langdetect",
+                        help="Language detection backend of the language filter (default: langdetect)")
+    parser.add_argument("--lang_max_chars", type=int, default=None,
+                        help="Only detect the language of the first N characters of each text (default: full text)")
+    parser.add_argument("--fasttext_model", type=str, default=None,
+                        help="Path to the fastText language identification model for --lang_detector=fasttext")
+    parser.add_argument("--reorder_filters", action="store_true",
+                        help="Profile the filters on a random sample and reorder the commutative ones to minimize the expected filtering time")
+    parser.add_argument("--profile_sample_size", type=int, default=200,
+                        help="Number of sampled rows the filters are profiled on with --reorder_filters (default: 200)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the profiling sample and of the intermediate subsamples (default: 0)")
+    parser.add_argument("--fuse_filters", action="store_true",
+                        help="Evaluate consecutive per-example filters in a single pass, skipping the later filters for rows an earlier one removed")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Run all filters lazily over batches of rows and write the kept and removed rows to sharded output as they are produced")
+    parser.add_argument("--stream_shard_size", type=int, default=10000,
+                        help="Maximum number of rows per output shard in streaming mode (default: 10000)")
+    parser.add_argument("--num_shards", type=int, default=None,
+                        help="Number of shards of a sharded run, each filtered by a separate worker with --shard_index")
+    parser.add_argument("--shard_index", type=int, default=None,
+                        help="Shard filtered by this worker, from 0 to --num_shards - 1. Outputs are written to "
+                             "output_dir/shards/shard_<index>_of_<num_shards>")
+    parser.add_argument("--merge_shards", action="store_true",
+                        help="Merge the outputs of the --num_shards finished workers into the outputs of a single run")
+    parser.add_argument("--checkpoint", action="store_true",
+                        help="Checkpoint the output of every stage in output_dir/checkpoints")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume an interrupted run from its checkpoints instead of clearing output_dir (implies --checkpoint)")
+    parser.add_argument("--checkpoint_shard_size", type=int, default=5000,
+                        help="Number of rows per checkpoint shard within a stage (default: 5000)")
+    parser.add_argument("--dedup_engine", choices=["llm", "local"], default="llm",
+                        help="Deduplicate questions with the LLM or locally with character n-gram similarity (default: llm)")
+    parser.add_argument("--local_dedup_threshold", type=float, default=0.7,
+                        help="Similarity above which questions are duplicates with --dedup_engine=local (default: 0.7)")
+    parser.add_argument("--local_dedup_borderline", type=float, default=None,
+                        help="With --dedup_engine=local, examples with question pairs between this similarity and "
+                             "--local_dedup_threshold are deduplicated again by the LLM (default: never call the LLM)")
+    parser.add_argument("--cross_doc_max_copies", type=int, default=None,
+                        help="Keep at most this many copies of every (near-)duplicate question across all documents "
+                             "and splits (default: no cross-document deduplication)")
+    parser.add_argument("--llm_cache_path", type=str, default=None,
+                        help="SQLite file caching the deduplication responses across runs (default: no cache)")
+    parser.add_argument("--llm_cache_max_size_mb", type=float, default=None,
+                        help="Maximum size of the cached responses, least recently used ones are evicted (default: no limit)")
+    parser.add_argument("--llm_cache_replay", action="store_true",
+                        help="Only replay responses from --llm_cache_path and fail on requests that are not cached")
+    parser.add_argument("--translator", choices=["google", "argos", "none"], default="google",
+                        help="Translation backend of the subsample visualizations: google (googletrans, needs network), "
+                             "argos (offline, needs argostranslate) or none (default: google)")
+    parser.add_argument("--translation_cache_path", type=str, default=None,
+                        help="SQLite file caching the translations of the visualizations across runs (default: no cache)")
+    parser.add_argument("--translation_concurrency", type=int, default=8,
+                        help="Maximum number of translations in flight (default: 8)")
+    parser.add_argument("--viz_format", choices=["png", "html", "both"], default="png",
+                        help="Output of the subsample visualizations: a PNG contact sheet, an HTML page or both (default: png)")
+    parser.add_argument("--viz_workers", type=int, default=4,
+                        help="Number of processes rendering the visualization samples, 0 to render in the main process (default: 4)")
+    parser.add_argument("--thumbnail_size", type=int, default=512,
+                        help="Maximum side in pixels of the document images in the visualizations (default: 512)")
     parser.add_argument("--save_intermediate", choices=["none", "subsample", "all"], default="subsample",
                         help="Whether to save intermediate datasets (default: subsample)")
     parser.add_argument("--subsample_size", type=int, default=10,
                         help="Number of examples to subsample if save_intermediate=subsample (default: 10)")
+    parser.add_argument("--num_proc", type=int, default=None,
+                        help="Number of worker processes per filter (default: single process)")
+    parser.add_argument("--batch_size", type=int, default=1000,
+                        help="Number of examples each filter processes per batch (default: 1000)")
 
     args = parser.parse_args()
-
-    dataset = load_from_disk(args.dataset_path)
-
-    if os.path.exists(args.output_dir):
-        shutil.rmtree(args.output_dir)
+    uses_llm = args.dedup_engine == "llm" or args.local_dedup_borderline is not None
+    if uses_llm and args.sn_api_key is None and args.client_config is None:
+        parser.error("--sn_api_key or --client_config is required to deduplicate questions with the LLM")
+    if args.streaming and args.cross_doc_max_copies is not None:
+        parser.error("--cross_doc_max_copies needs a pass over the whole dataset and can not be used with --streaming")
+
+    sharded = args.shard_index is not None or args.merge_shards
+    if sharded:
+        if args.num_shards is None:
+            parser.error("--num_shards is required with --shard_index and --merge_shards")
+        if args.shard_index is not None and args.merge_shards:
+            parser.error("--shard_index and --merge_shards can not be used together")
+        if args.shard_index is not None and not 0 <= args.shard_index < args.num_shards:
+            parser.error("--shard_index must be between 0 and --num_shards - 1")
+        if args.streaming or args.reorder_filters or args.cross_doc_max_copies is not None:
+            # Every worker must run the same filters in the same order on independent shards
+            parser.error("--streaming, --reorder_filters and --cross_doc_max_copies can not be used in sharded runs")
+    elif args.num_shards is not None:
+        parser.error("--num_shards needs --shard_index or --merge_shards")
+
+    # The merge only reads the outputs of the workers
+    dataset = load_from_disk(args.dataset_path) if not args.merge_shards else None
+
+    output_dir = args.output_dir
+    if args.shard_index is not None:
+        output_dir = shard_output_dir(args.output_dir, args.shard_index, args.num_shards)
+    if os.path.exists(output_dir) and not args.resume and not args.merge_shards:
+        shutil.rmtree(output_dir)
+
+    llm_cache = None
+    if args.llm_cache_path is not None:
+        max_size_bytes = int(args.llm_cache_max_size_mb * 1024 ** 2) if args.llm_cache_max_size_mb is not None else None
+        llm_cache = LLMCache(args.llm_cache_path, max_size_bytes=max_size_bytes, read_only=args.llm_cache_replay)
+
+    dedup_filter = None
+    pool = None
+    if uses_llm:
+        pool = ClientPool.from_config(args.client_config) if args.client_config is not None else None
+        dedup_filter = DedupQuestionsFilter(
+            model=args.sn_model,
+            api_key=args.sn_api_key,
+            base_url=args.sn_base_url,
+            async_mode=args.dedup_async,
+            max_concurrency=args.dedup_max_concurrency,
+            requests_per_second=args.dedup_requests_per_second,
+            cache=llm_cache,
+            pool=pool,
+            max_batch_documents=args.dedup_batch_documents,
+            context_length=args.dedup_context_length
+        )
+    if args.dedup_engine == "local":
+        dedup_filter = LocalDedupQuestionsFilter(
+            threshold=args.local_dedup_threshold,
+            borderline_threshold=args.local_dedup_borderline,
+            llm_filter=dedup_filter
+        )
 
     filters = [
         TextLengthFilterOCR(min_length=60),
-        NGramFilter(n_gram=4, threshold=0.12),
-        LanguageFilter(language="hu"),
-        DedupQuestionsFilter(model=args.sn_model, api_key=args.sn_api_key)
+        NGramFilter(n_gram=4, threshold=0.12, source_fields=args.ngram_source_fields),
+        LanguageFilter(language="hu", detector=get_detector(args.lang_detector, args.lang_max_chars, args.fasttext_model)),
+        dedup_filter
     ]
+    if args.cross_doc_max_copies is not None:
+        # Drop corpus-wide duplicates before they reach the per-document deduplication
+        filters.insert(-1, CrossDocDedupFilter(max_copies=args.cross_doc_max_copies))
+    plan = None
+    if args.reorder_filters:
+        filters, plan = plan_filter_order(filters, dataset, sample_size=args.profile_sample_size, seed=args.seed,
+                                          batch_size=args.batch_size)
+    if args.fuse_filters and not args.streaming:
+        # Streaming mode already stops evaluating a row at the first filter that removes it
+        filters = fuse_filters(filters)
+
+    translation_cache = LLMCache(args.translation_cache_path) if args.translation_cache_path is not None else None
+    translator = get_translator(args.translator, cache=translation_cache, max_concurrency=args.translation_concurrency)
 
     pipeline = DatasetFilteringPipeline(
         filters=filters,
-        output_dir=args.output_dir,
+        output_dir=output_dir,
         save_intermediate=args.save_intermediate,
-        subsample_size=args.subsample_size
+        subsample_size=args.subsample_size,
+        num_proc=args.num_proc,
+        batch_size=args.batch_size,
+        checkpoint_dir=os.path.join(output_dir, "checkpoints") if args.checkpoint or args.resume else None,
+        resume=args.resume,
+        checkpoint_shard_size=args.checkpoint_shard_size,
+        plan=plan,
+        translator=translator,
+        seed=args.seed,
+        viz_format=args.viz_format,
+        viz_workers=args.viz_workers,
+        thumbnail_size=args.thumbnail_size
     )
-    pipeline.run(dataset)
+    if args.merge_shards:
+        pipeline.merge_shards(args.num_shards)
+    elif args.shard_index is not None:
+        pipeline.run_shard(dataset, args.shard_index, args.num_shards)
+    elif args.streaming:
+        pipeline.run_streaming(dataset, shard_size=args.stream_shard_size)
+    else:
+        pipeline.run(dataset)
+    if pool is not None:
+        print(f"Deduplication requests per endpoint:\n{pool.report()}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
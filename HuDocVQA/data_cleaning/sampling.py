@@ -0,0 +1,52 @@
+# sampling.py
+from datasets import Dataset
+import numpy as np
+
+def sample_indices(num_rows: int, size: int, seed=None):
+    """
+    Returns min(size, num_rows) distinct random row indices in increasing order. Only the sampled indices are
+    drawn, so the cost does not grow with num_rows (unlike shuffling the whole dataset).
+
+    :param seed: Seed of the sample, an int or a list of ints (e.g. [seed, stage, split]).
+    """
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(num_rows, size=min(size, num_rows), replace=False))
+
+class ReservoirSampler:
+    def __init__(self, size: int, seed=None):
+        """
+        Keeps a uniform random sample of at most size rows of a stream of row batches (reservoir sampling,
+        Algorithm R), holding only the sampled rows in memory.
+
+        :param size: The number of rows to keep.
+        :param seed: Seed of the sample, an int or a list of ints.
+        """
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.rows = []
+        self.num_seen = 0
+
+    def add_batch(self, batch: dict):
+        """
+        Offers the rows of a batch, given as a dictionary mapping column names to lists of values.
+        """
+        num_rows = len(next(iter(batch.values()), []))
+        if num_rows == 0:
+            return
+        positions = self.num_seen + np.arange(num_rows)
+        # Row t of the stream replaces a random slot with probability size / (t + 1)
+        slots = np.where(positions < self.size, positions, self.rng.integers(0, positions + 1))
+        for row in np.flatnonzero(slots < self.size):
+            example = {column: values[row] for column, values in batch.items()}
+            if slots[row] < len(self.rows):
+                self.rows[slots[row]] = example
+            else:
+                self.rows.append(example)
+        self.num_seen += num_rows
+
+    def to_dataset(self, features):
+        """
+        Returns the sampled rows as a Dataset with the given features.
+        """
+        return Dataset.from_dict({column: [row.get(column) for row in self.rows] for column in features},
+                                 features=features)
@@ -0,0 +1,39 @@
+# tests/test_join_columns.py
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datasets import Dataset, concatenate_datasets
+from filters.base_filter import Filter
+from filters.n_gram_overlap_filter import NGramFilter
+
+
+def make_dataset():
+    return Dataset.from_dict({
+        "text": ["Ez egy hosszú magyar szöveg a dokumentumról."] * 2,
+        "questions": [["Mi a szöveg?"], ["Mit tartalmaz a dokumentum?"]],
+        "answers": [["egy szöveg"], ["a dokumentumot"]],
+    })
+
+
+def test_join_columns_concatenated_dataset():
+    dataset = concatenate_datasets([make_dataset(), make_dataset()])
+    joined = Filter.join_columns(dataset, Dataset.from_dict({"questions": [["a"], ["b"], ["c"], ["d"]], "n": [0, 1, 2, 3]}))
+    assert joined["questions"] == [["a"], ["b"], ["c"], ["d"]]
+    assert joined["n"] == [0, 1, 2, 3]
+    assert joined["text"] == dataset["text"]
+
+
+def test_join_columns_index_selection_of_added_column():
+    dataset = make_dataset().add_column("extra", [10, 20]).select([1, 0])
+    joined = Filter.join_columns(dataset, Dataset.from_dict({"n": [1, 0]}))
+    assert joined["n"] == [1, 0]
+    assert joined["extra"] == [20, 10]
+
+
+def test_filter_apply_concatenated_dataset():
+    dataset = concatenate_datasets([make_dataset(), make_dataset()])
+    remaining, removed = NGramFilter(4, 0.12).apply(dataset)
+    assert (len(remaining), len(removed)) == (4, 0)
+    assert remaining["questions"] == dataset["questions"]
@@ -0,0 +1,130 @@
+# translators.py
+from abc import ABC, abstractmethod
+import asyncio
+import hashlib
+import inspect
+import json
+
+class Translator(ABC):
+    def __init__(self, src: str = "auto", dest: str = "en", cache=None, max_concurrency: int = 8):
+        """
+        Base class of the translation backends used to annotate the visualizations of the pipeline.
+
+        Translations are memoized in memory and, with a cache, persisted across runs keyed by the backend, the
+        languages and the source string, so every string is translated once.
+
+        :param src: Source language code, "auto" to detect it (if the backend supports it).
+        :param dest: Target language code.
+        :param cache: Optional LLMCache (a persistent string cache) storing the translations.
+        :param max_concurrency: Maximum number of translations in flight in translate_all.
+        """
+        self.src = src
+        self.dest = dest
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.memo = {}
+
+    @abstractmethod
+    async def _translate(self, text):
+        """
+        Return the translation of the text. Raise an exception if it can not be translated.
+        """
+        pass
+
+    def _key(self, text):
+        request = {"translator": type(self).__name__, "src": self.src, "dest": self.dest, "text": text}
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    async def translate(self, text, semaphore=None):
+        """
+        Return the translation of the text, or the text itself if it can not be translated.
+        """
+        key = self._key(text)
+        if key in self.memo:
+            return self.memo[key]
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            self.memo[key] = cached
+            return cached
+        try:
+            if semaphore is None:
+                translation = await self._translate(text)
+            else:
+                async with semaphore:
+                    translation = await self._translate(text)
+        except Exception as e:
+            print(f"Warning: could not translate {text[:30]!r}: {e.__class__.__name__}: {e}")
+            return text
+        self.memo[key] = translation
+        if self.cache is not None:
+            self.cache.set(key, translation)
+        return translation
+
+    async def translate_all(self, texts):
+        """
+        Translate the texts concurrently, at most max_concurrency at a time, and return them in the input order.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        unique_texts = list(dict.fromkeys(texts))
+        translations = await asyncio.gather(*[self.translate(text, semaphore) for text in unique_texts])
+        translated = dict(zip(unique_texts, translations))
+        return [translated[text] for text in texts]
+
+    def __str__(self):
+        return f"{self.__class__.__name__}(src={self.src}, dest={self.dest})"
+
+
+class GoogleTranslator(Translator):
+    def __init__(self, src: str = "auto", dest: str = "en", cache=None, max_concurrency: int = 8):
+        """
+        googletrans backend (Google Translate web API). Needs network access and may be rate limited.
+        """
+        super().__init__(src=src, dest=dest, cache=cache, max_concurrency=max_concurrency)
+        self.translator = None
+
+    async def _translate(self, text):
+        if self.translator is None:
+            from googletrans import Translator as GoogleTranslateClient
+            self.translator = GoogleTranslateClient()
+        # googletrans 4 is asynchronous, 3.x (the pinned version) blocks, so it runs in a thread to keep the
+        # other translations going
+        if inspect.iscoroutinefunction(self.translator.translate):
+            result = await self.translator.translate(text, src=self.src, dest=self.dest)
+        else:
+            result = await asyncio.to_thread(self.translator.translate, text, src=self.src, dest=self.dest)
+        return result.text
+
+
+class ArgosTranslator(Translator):
+    def __init__(self, src: str = "hu", dest: str = "en", cache=None, max_concurrency: int = 2):
+        """
+        Argos Translate backend. Runs offline, requires the argostranslate package and the installed
+        src -> dest language package, e.g. `argospm install translate-hu_en`.
+        """
+        super().__init__(src=src, dest=dest, cache=cache, max_concurrency=max_concurrency)
+
+    async def _translate(self, text):
+        import argostranslate.translate
+        # CPU bound, so run in a thread to keep the other translations going
+        return await asyncio.to_thread(argostranslate.translate.translate, text, self.src, self.dest)
+
+
+class IdentityTranslator(Translator):
+    """
+    Leaves the text untranslated, for offline runs without a translation model.
+    """
+    async def _translate(self, text):
+        return text
+
+
+def get_translator(name: str, cache=None, max_concurrency: int = 8):
+    """
+    Creates a translator by backend name ('google', 'argos' or 'none').
+    """
+    if name == "google":
+        return GoogleTranslator(cache=cache, max_concurrency=max_concurrency)
+    if name == "argos":
+        return ArgosTranslator(cache=cache, max_concurrency=max_concurrency)
+    if name == "none":
+        return IdentityTranslator(cache=cache, max_concurrency=max_concurrency)
+    raise ValueError(f"Unknown translator: {name}")
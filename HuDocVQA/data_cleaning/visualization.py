@@ -0,0 +1,89 @@
+# visualization.py
+import base64
+import html
+import io
+from PIL import Image
+from matplotlib.figure import Figure
+
+def make_thumbnail(data: bytes, size: int):
+    """
+    Decodes an encoded image into an RGB thumbnail whose longer side is at most size pixels.
+    JPEG scans are decoded directly at a reduced scale, so the full resolution image is never held in memory.
+    """
+    image = Image.open(io.BytesIO(data))
+    image.draft("RGB", (size, size))
+    image = image.convert("RGB")
+    image.thumbnail((size, size))
+    return image
+
+def render_sample(data: bytes, title: str, thumbnail_size: int = 512, render_figure: bool = True, dpi: int = 100):
+    """
+    Renders one visualization sample. Top-level so it can be sent to worker processes.
+
+    :param data: The encoded document image, or None for an invalid sample.
+    :param title: The text shown above the image.
+    :param thumbnail_size: Maximum side of the thumbnail in pixels.
+    :param render_figure: Whether to draw the figure (thumbnail and title) for the contact sheet.
+    :param dpi: Resolution of the figure.
+    :return: The PNG bytes of the figure (or None) and the JPEG bytes of the thumbnail (or None).
+    """
+    thumbnail = make_thumbnail(data, thumbnail_size) if data is not None else None
+    figure_png = None
+    if render_figure:
+        # A standalone Figure, not pyplot, so nothing is kept in a global figure registry
+        figure = Figure(figsize=(thumbnail_size / dpi, thumbnail_size / dpi))
+        ax = figure.add_subplot()
+        if thumbnail is not None:
+            ax.imshow(thumbnail)
+            ax.set_title(title, fontsize=8, loc="left", wrap=True)
+        else:
+            ax.text(0.5, 0.5, "Invalid sample", ha="center", va="center")
+        ax.axis("off")
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format="png", bbox_inches="tight", dpi=dpi)
+        figure_png = buffer.getvalue()
+    thumbnail_jpeg = None
+    if thumbnail is not None:
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, format="JPEG", quality=85)
+        thumbnail_jpeg = buffer.getvalue()
+    return figure_png, thumbnail_jpeg
+
+def save_contact_sheet(figures, path: str, columns: int = 2, padding: int = 10):
+    """
+    Pastes the rendered sample figures (PNG bytes) into a grid and saves it as one image.
+    """
+    tiles = [Image.open(io.BytesIO(figure)).convert("RGB") for figure in figures]
+    columns = max(1, min(columns, len(tiles)))
+    rows = [tiles[start:start + columns] for start in range(0, len(tiles), columns)]
+    column_width = max(tile.width for tile in tiles)
+    row_heights = [max(tile.height for tile in row) for row in rows]
+    sheet = Image.new("RGB", (columns * column_width + (columns + 1) * padding,
+                              sum(row_heights) + (len(rows) + 1) * padding), "white")
+    top = padding
+    for row, row_height in zip(rows, row_heights):
+        for column, tile in enumerate(row):
+            sheet.paste(tile, (padding + column * (column_width + padding), top))
+        top += row_height + padding
+    sheet.save(path)
+
+def save_html(samples, path: str, heading: str = ""):
+    """
+    Saves the samples as a self-contained HTML page with embedded thumbnails.
+
+    :param samples: (thumbnail JPEG bytes or None, caption) pairs.
+    """
+    parts = [f"<!DOCTYPE html>\n<html>\n<head><meta charset=\"utf-8\"><title>{html.escape(heading)}</title>",
+             "<style>body{font-family:sans-serif} .sample{display:inline-block;vertical-align:top;width:520px;margin:8px}"
+             " pre{white-space:pre-wrap;font-size:12px}</style></head>\n<body>",
+             f"<h2>{html.escape(heading)}</h2>"]
+    for thumbnail, caption in samples:
+        parts.append("<div class=\"sample\">")
+        if thumbnail is not None:
+            parts.append(f"<img src=\"data:image/jpeg;base64,{base64.b64encode(thumbnail).decode('ascii')}\">")
+        else:
+            parts.append("<p>Invalid sample</p>")
+        parts.append(f"<pre>{html.escape(caption)}</pre></div>")
+    parts.append("</body>\n</html>\n")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(parts))
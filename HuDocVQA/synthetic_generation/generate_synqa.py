@@ -1,17 +1,25 @@
 import os
 import re
 import sys
+import json
 import math
+import shutil
+import asyncio
 import argparse
 import numpy as np
 import jsonlines
-import pytesseract
 import logging
-from openai import OpenAI
 from pathlib import Path
-from datasets import load_from_disk, Dataset, DatasetDict
+from datasets import load_from_disk, concatenate_datasets, Dataset, DatasetDict, Image, Sequence, Value
 from tqdm import tqdm
-from tenacity import RetryError, retry, stop_after_attempt, wait_random_exponential, before_sleep_log
+
+# Make the modules shared with data_cleaning (HuDocVQA/common) importable
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.llm_cache import LLMCache
+from common.async_llm import AsyncLLMEngine
+from common.client_pool import ClientPool
+from common.ocr import OCRCache, image_bytes, ocr_image, ocr_key
+from common.sharded_writer import ShardedArrowWriter
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -45,6 +53,7 @@ TQA_TRIPLES = [
 HUNGARIAN_FEWSHOT_TEMPLATE = f'Szöveg: <text>\nKérdés: <question>\nVálasz: <answer>'
 
 N_QA_PER_DOCUMENT = 4
+BASE_URL = 'https://api.sambanova.ai/v1/'
 
 def generate_fewshot_example(text, question, answer):
     fewshot_example = HUNGARIAN_FEWSHOT_TEMPLATE.replace('<text>', text)
@@ -52,31 +61,27 @@ def generate_fewshot_example(text, question, answer):
     fewshot_example = fewshot_example.replace('<answer>', answer)
     return fewshot_example
 
-def generate_text_field_response(datapoint, client, state, use_ocr=False):
+# Built once: the few-shot examples are several KB of text each and are the leading part of every prompt
+FEWSHOT_EXAMPLES = [generate_fewshot_example(fs_text, fs_question, fs_answer) for fs_text, fs_question, fs_answer in TQA_TRIPLES]
+# Prefix of all prompts with --shared-prefix, byte-identical across requests for servers with prefix caching
+SHARED_FEWSHOT_PREFIX = '\n\n'.join(FEWSHOT_EXAMPLES)
+
+def generate_text_field_messages(datapoint, fs_idx, use_ocr=False):
+    """
+    :param fs_idx: Index of the few-shot example in TQA_TRIPLES, or None for all examples (SHARED_FEWSHOT_PREFIX).
+    """
     if use_ocr:
         text = datapoint["ocr"]
     else:
         text = datapoint["text"]
-    fs_idx = state.choice(range(len(TQA_TRIPLES)))
-    fs_text, fs_question, fs_answer = TQA_TRIPLES[fs_idx]
-    fewshot_example = generate_fewshot_example(fs_text, fs_question, fs_answer)
+    fewshot_example = SHARED_FEWSHOT_PREFIX if fs_idx is None else FEWSHOT_EXAMPLES[fs_idx]
     input_message = f'{fewshot_example}\n\nSzöveg: {text}\nKérdés: '
-    messages = [
+    return [
         {'role': 'system', 'content': HUNGARIAN_SYSTEM_PROMPT},
         {'role': 'user', 'content': input_message}
     ]
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=messages,
-        temperature=0.7
-    )
-    if hasattr(response, 'error') and 'unexpected_error' in response.error['message']:
-        raise ValueError(f'Hit unexpected error during generation: {response.error}')
-    return response.choices[0].message.content
-
-def generate_text_field_qa(datapoint, client, state, use_ocr=False):
-    retry_wrapped_function = retry(stop=stop_after_attempt(5), wait=wait_random_exponential(min=4, max=20), reraise=True)(generate_text_field_response)
-    response_text = retry_wrapped_function(datapoint, client, state, use_ocr=use_ocr)
+
+def parse_text_field_qa(response_text):
     try:
         question = re.search(r'Kérdés: (.+)\n', response_text).groups()[0]
     except:
@@ -87,43 +92,261 @@ def generate_text_field_qa(datapoint, client, state, use_ocr=False):
         raise ValueError(f'Failed extracting answer ("Válasz: ") from response: {response_text}')
     return question, answer
 
+def draw_fewshot_indices(state, num_documents):
+    """
+    Draws the few-shot example of every attempt of every document up front, in document order, so the prompts
+    only depend on the seed and not on the order in which the concurrent requests complete or are retried.
+    """
+    return [[state.choice(range(len(TQA_TRIPLES))) for _ in range(N_QA_PER_DOCUMENT)] for _ in range(num_documents)]
+
+async def generate_text_field_qa(complete, datapoint, fs_idx, use_ocr=False, sample_id=None):
+    messages = generate_text_field_messages(datapoint, fs_idx, use_ocr=use_ocr)
+    # sample_id keeps the sampled completions of different documents and attempts apart in the cache
+    response_text = await complete(messages, sample_id=sample_id, temperature=0.7)
+    return parse_text_field_qa(response_text)
+
+async def ocr_document(raw_image, ocr_cache=None):
+    """
+    Runs OCR on an encoded image ({"bytes", "path"}) in a thread, reusing the OCR cache of precompute_ocr.py.
+    """
+    data = image_bytes(raw_image)
+    key = ocr_key(data, "hun")
+    cached = ocr_cache.get(key) if ocr_cache is not None else None
+    if cached is not None:
+        return cached
+    text = await asyncio.to_thread(ocr_image, data, "hun")
+    if ocr_cache is not None:
+        ocr_cache.set(key, text)
+    return text
+
+async def generate_document_qas(complete, datapoint, fewshot_indices, doc_id, raw_image=None, ocr_cache=None):
+    """
+    Generates the QA pairs of one document, sending the requests of all its attempts concurrently.
+
+    :param raw_image: The encoded image of the document, OCRed if the datapoint has no 'ocr' field.
+    :return: The datapoint with its questions and answers, or None if no attempt produced a valid QA pair.
+    """
+    if 'ocr' not in datapoint:
+        datapoint['ocr'] = await ocr_document(raw_image, ocr_cache)
+    results = await asyncio.gather(*[
+        generate_text_field_qa(complete, datapoint, fs_idx, use_ocr=(attempt % 2 == 0), sample_id=f'{doc_id}/{attempt}')
+        for attempt, fs_idx in enumerate(fewshot_indices)
+    ], return_exceptions=True)
+    questions = []
+    answers = []
+    for attempt, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.warning(f'Failed QA generation attempt {attempt} on document {doc_id} with exception: {result}')
+            continue
+        questions.append(result[0])
+        answers.append(result[1])
+    if len(questions) == 0:
+        return None
+    datapoint['questions'] = questions
+    datapoint['answers'] = answers
+    return datapoint
+
+def output_features(features):
+    """
+    Returns the features of the generated datapoints: the input features with the OCR text and the QA pairs.
+    """
+    features = features.copy()
+    if 'ocr' not in features:
+        features['ocr'] = Value('string')
+    features['questions'] = Sequence(Value('string'))
+    features['answers'] = Sequence(Value('string'))
+    return features
+
+class GenerationOutput:
+    def __init__(self, output_path, shard_size=500, resume=False, run_config=None):
+        """
+        Writes the generated datapoints to numbered Arrow shards under output_path/shards/<split> as documents
+        complete, so at most shard_size datapoints (images included) are held in memory per split. Once a shard
+        is finalized, its row indices are appended to output_path/shards/manifest.jsonl.
+
+        With resume, the documents listed in the manifest are skipped. Documents of an unfinished shard, and
+        documents that produced no QA pairs, are generated again.
+
+        :param run_config: Settings the shards depend on (input dataset, seed). Resuming with different ones fails.
+        """
+        self.shard_dir = os.path.join(output_path, 'shards')
+        self.manifest_path = os.path.join(self.shard_dir, 'manifest.jsonl')
+        self.shard_size = shard_size
+        self.shards = dict()
+        self.writers = dict()
+        self.buffers = dict()
+        run_config_path = os.path.join(self.shard_dir, 'run.json')
+        if resume and os.path.exists(run_config_path):
+            with open(run_config_path) as f:
+                previous_config = json.load(f)
+            if previous_config != run_config:
+                raise ValueError(f'Can not resume from {self.shard_dir}: it was generated with {previous_config}, not {run_config}')
+            if os.path.exists(self.manifest_path):
+                with jsonlines.open(self.manifest_path) as reader:
+                    for entry in reader:
+                        self.shards.setdefault(entry['split'], []).append((entry['shard'], entry['indices']))
+        else:
+            shutil.rmtree(self.shard_dir, ignore_errors=True)
+            os.makedirs(self.shard_dir)
+            with open(run_config_path, 'w') as f:
+                json.dump(run_config, f)
+
+    def done_indices(self, split):
+        return {idx for _, indices in self.shards.get(split, []) for idx in indices}
+
+    def open_split(self, split, features):
+        # Shards listed in the manifest are numbered 0..n-1, later ones overwrite unfinished shards
+        self.writers[split] = ShardedArrowWriter(os.path.join(self.shard_dir, split), features, shard_size=self.shard_size,
+                                                 start_shard=len(self.shards.get(split, [])))
+        self.buffers[split] = []
+
+    def add(self, split, idx, datapoint):
+        self.buffers[split].append((idx, datapoint))
+        if len(self.buffers[split]) >= self.shard_size:
+            self.flush(split)
+
+    def flush(self, split):
+        """
+        Writes the buffered datapoints of a split to a new shard and records it in the manifest.
+        """
+        buffer = self.buffers[split]
+        if len(buffer) == 0:
+            return
+        writer = self.writers[split]
+        writer.write_batch({column: [datapoint[column] for _, datapoint in buffer] for column in writer.features})
+        shard = os.path.relpath(writer.close_shard(), self.shard_dir)
+        indices = [idx for idx, _ in buffer]
+        with jsonlines.open(self.manifest_path, mode='a', flush=True) as manifest:
+            manifest.write({'split': split, 'shard': shard, 'indices': indices})
+        self.shards.setdefault(split, []).append((shard, indices))
+        self.buffers[split] = []
+
+    def load(self, split, features):
+        """
+        Returns the datapoints written for a split, in document order.
+        """
+        shards = self.shards.get(split, [])
+        if len(shards) == 0:
+            return Dataset.from_dict({column: [] for column in features}, features=features)
+        dataset = concatenate_datasets([Dataset.from_file(os.path.join(self.shard_dir, shard)) for shard, _ in shards])
+        indices = np.concatenate([indices for _, indices in shards])
+        return dataset.select(np.argsort(indices, kind='stable'))
+
+async def generate_split(engine, complete, dataset, fewshot_indices, ds_name, split, max_documents_in_flight, output, ocr_cache=None):
+    """
+    Generates the QA pairs of the documents of a split that are not done yet, with at most
+    max_documents_in_flight documents (decoded images included) in memory at a time. Datapoints are passed to
+    output as they complete.
+    """
+    raw_images = None
+    if 'ocr' not in dataset.column_names:
+        logger.warning(f'Split {split} has no "ocr" column, running OCR inline. Run precompute_ocr.py first to OCR all pages in parallel.')
+        raw_images = dataset.select_columns(['image']).cast_column('image', Image(decode=False))
+    done_indices = output.done_indices(split)
+    output.open_split(split, output_features(dataset.features))
+    pending = set()
+    progress = tqdm(total=len(dataset), initial=len(done_indices), dynamic_ncols=True, desc=f'{ds_name.split("/")[-1]} {split} split')
+    if len(done_indices) > 0:
+        logger.info(f'Resuming split {split}: skipping {len(done_indices)} documents already generated')
+
+    async def run_document(i):
+        raw_image = raw_images[i]['image'] if raw_images is not None else None
+        datapoint = await generate_document_qas(complete, dataset[i], fewshot_indices[i], f'{ds_name}/{split}/{i}',
+                                                raw_image=raw_image, ocr_cache=ocr_cache)
+        if datapoint is None:
+            # if we can't generate valid Q/A pairs, don't even save the image
+            logger.warning(f'No valid QAs found for datapoint {i}, split {split}')
+        else:
+            output.add(split, i, datapoint)
+        throughput = engine.throughput()
+        progress.set_postfix_str(f'{throughput["requests_per_second"]:.2f} req/s, {throughput["tokens_per_second"]:.0f} tok/s')
+        progress.update(1)
+
+    for i in range(len(dataset)):
+        if i in done_indices:
+            continue
+        if len(pending) >= max_documents_in_flight:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        pending.add(asyncio.create_task(run_document(i)))
+    for task in asyncio.as_completed(pending):
+        await task
+    output.flush(split)
+    progress.close()
+
+async def generate_dataset(engine, dataset, ds_name, seed, max_documents_in_flight, output, ocr_cache=None, shared_prefix=False):
+    """
+    :param shared_prefix: Start every prompt with all few-shot examples (SHARED_FEWSHOT_PREFIX) instead of the
+                          one drawn for the attempt, so that all requests share the same leading prefix.
+    """
+    state = np.random.RandomState(seed=seed)
+    ds_dict = dict()
+    async with engine.session() as complete:
+        for split in dataset.keys():
+            # Drawn for every document, done or not, so resumed runs send the same prompts
+            fewshot_indices = draw_fewshot_indices(state, len(dataset[split]))
+            if shared_prefix:
+                fewshot_indices = [[None] * len(indices) for indices in fewshot_indices]
+            await generate_split(engine, complete, dataset[split], fewshot_indices, ds_name, split,
+                                 max_documents_in_flight, output, ocr_cache=ocr_cache)
+            ds_dict[split] = output.load(split, output_features(dataset[split].features))
+    return DatasetDict(ds_dict)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--input-dataset-path', type=str, help='Path to HuggingFace dataset. Should be the result of dataset.save_to_disk(...)')
     parser.add_argument('--output-path', type=str, help='Output directory. Will save images and text separately to disk. Images will be saved as PNGs, text will be saved as jsonl files with paths to the corresponding image.')
-    parser.add_argument('--seed', type=int, default=42, help='Seed for controlling random state. Only affects how many few shot examples are used for prompting the model')
+    parser.add_argument('--seed', type=int, default=SEED, help='Seed for controlling random state. Only affects which few shot examples are used for prompting the model')
+    parser.add_argument('--cache-path', type=str, default=None, help='SQLite file caching the model responses across runs. Reruns reuse the cached completions instead of calling the API again.')
+    parser.add_argument('--cache-max-size-mb', type=float, default=None, help='Maximum size of the cached responses, least recently used ones are evicted. Default: no limit')
+    parser.add_argument('--cache-replay', action='store_true', help='Only replay responses from --cache-path, requests that are not cached fail')
+    parser.add_argument('--ocr-cache-path', type=str, default=None, help='OCR cache of precompute_ocr.py, used for documents without an "ocr" field')
+    parser.add_argument('--shard-size', type=int, default=500, help='Number of generated datapoints per output shard. Completed shards are kept across crashes')
+    parser.add_argument('--resume', action='store_true', help='Resume an interrupted run from the shards under --output-path, skipping the documents already generated')
+    parser.add_argument('--shared-prefix', action='store_true', help='Start every prompt with the same few-shot prefix (all examples), so servers with prefix caching can reuse it across requests')
+    parser.add_argument('--token-log', type=str, default=None, help='JSON lines file recording the prompt, cached prompt and completion tokens of every request')
+    parser.add_argument('--client-config', type=str, default=None, help='JSON file listing several OpenAI-compatible endpoints and keys to spread the requests over, instead of --base-url and OPENAI_API_KEY')
+    parser.add_argument('--base-url', type=str, default=BASE_URL, help='Base URL of the OpenAI-compatible API')
+    parser.add_argument('--max-concurrency', type=int, default=16, help='Maximum number of API requests in flight. Lowered automatically while the API answers 429 (rate limited) and raised back afterwards')
+    parser.add_argument('--requests-per-second', type=float, default=None, help='Maximum sustained request rate. Default: no limit')
+    parser.add_argument('--max-retries', type=int, default=5, help='Number of attempts per API request before giving up on it')
+    parser.add_argument('--max-documents-in-flight', type=int, default=None, help='Maximum number of documents processed at a time. Default: 4 * --max-concurrency')
     args = parser.parse_args()
-    if os.environ.get('OPENAI_API_KEY') is None:
+    pool = ClientPool.from_config(args.client_config) if args.client_config is not None else None
+    if pool is None and os.environ.get('OPENAI_API_KEY') is None:
         raise ValueError(
             "API key not found. Please set the OPENAI_API_KEY environment variable using a valid SambaNova API key. Visit https://cloud.sambanova.ai/ to sign up."
         )
-    client = OpenAI(base_url="https://api.sambanova.ai/v1/")
-    state = np.random.RandomState(seed=SEED)
+    cache = None
+    if args.cache_path is not None:
+        max_size_bytes = int(args.cache_max_size_mb * 1024 ** 2) if args.cache_max_size_mb is not None else None
+        cache = LLMCache(args.cache_path, max_size_bytes=max_size_bytes, read_only=args.cache_replay)
+    ocr_cache = OCRCache(args.ocr_cache_path) if args.ocr_cache_path is not None else None
+    engine = AsyncLLMEngine(MODEL, os.environ.get('OPENAI_API_KEY'), args.base_url, max_concurrency=args.max_concurrency,
+                            requests_per_second=args.requests_per_second, max_retries=args.max_retries,
+                            backoff_base=4.0, backoff_max=20.0, cache=cache, pool=pool)
+    max_documents_in_flight = args.max_documents_in_flight or 4 * args.max_concurrency
     dataset = load_from_disk(args.input_dataset_path)
     ds_name = Path(args.input_dataset_path).stem
-    ds_dict = dict()
-    for split in dataset.keys():
-        datapoint_list = []
-        for i, datapoint in tqdm(enumerate(dataset[split]), total=len(dataset[split]), dynamic_ncols=True, desc=f'{ds_name.split("/")[-1]} {split} split'):
-            if 'ocr' not in datapoint:
-                datapoint['ocr'] = pytesseract.image_to_string(datapoint['image'], lang="hun")
-            questions = []
-            answers = []
-            for attempt in range(N_QA_PER_DOCUMENT):
-                try:
-                    question, answer = generate_text_field_qa(datapoint, client, state, use_ocr=(attempt % 2 == 0))
-                    questions.append(question)
-                    answers.append(answer)
-                except Exception as e:
-                    print(f'Failed QA generation attempt {attempt} on document {i} with exception: {e}', flush=True)
-            if len(questions) == 0:
-                # if we can't generate valid Q/A pairs, don't even save the image
-                print(f'No valid QAs found for datapoint {i}, split {split}', flush=True)
-                continue
-            datapoint['questions'] = questions
-            datapoint['answers'] = answers
-            datapoint_list.append(datapoint)
-        ds_dict[split] = Dataset.from_list(datapoint_list)
-    output_dataset = DatasetDict(ds_dict)
+    run_config = {'input_dataset_path': os.path.abspath(args.input_dataset_path), 'seed': args.seed, 'model': MODEL,
+                  'shared_prefix': args.shared_prefix}
+    output = GenerationOutput(args.output_path, shard_size=args.shard_size, resume=args.resume, run_config=run_config)
+    token_log = None
+    if args.token_log is not None:
+        token_log = jsonlines.open(args.token_log, mode='a' if args.resume else 'w', flush=True)
+        engine.usage_log = lambda sample_id, usage: token_log.write({'sample_id': sample_id, **usage})
+    output_dataset = asyncio.run(generate_dataset(engine, dataset, ds_name, args.seed, max_documents_in_flight, output,
+                                                  ocr_cache=ocr_cache, shared_prefix=args.shared_prefix))
+    if token_log is not None:
+        token_log.close()
+    throughput = engine.throughput()
+    logger.info(f'Sent {engine.stats["requests"]} requests ({engine.stats["cached"]} cached, {engine.stats["rate_limited"]} rate limited): '
+                f'{throughput["requests_per_second"]:.2f} requests/s, {throughput["tokens_per_second"]:.1f} tokens/s '
+                f'({throughput["completion_tokens_per_second"]:.1f} completion tokens/s)')
+    logger.info(f'Prompt tokens: {engine.stats["prompt_tokens"]}, of which served from the prefix cache: {engine.stats["cached_prompt_tokens"]}. '
+                f'Completion tokens: {engine.stats["completion_tokens"]}')
+    if pool is not None:
+        logger.info(f'Requests per endpoint:\n{pool.report()}')
     output_dataset.save_to_disk(args.output_path)
     print(f'Done! Saved output as HF dataset to {args.output_path}')
@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import argparse
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from datasets import load_from_disk, Image, DatasetDict
+from tqdm import tqdm
+
+# Make the modules shared with data_cleaning (HuDocVQA/common) importable
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.ocr import OCRCache, available_cores, image_bytes, init_ocr_worker, ocr_image, ocr_key
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def precompute_split_ocr(dataset, executor, num_workers, lang='hun', cache=None, overwrite=False, desc=None):
+    """
+    Runs OCR on the images of a split in a process pool and returns the 'ocr' column.
+
+    Existing non-empty OCR texts are kept unless overwrite is set. Images are read as encoded bytes, hashed
+    and only sent to the pool on a cache miss; at most 4 * num_workers images are in flight at a time.
+
+    :return: The OCR texts in row order and the number of pages run through Tesseract.
+    """
+    images = dataset.select_columns(['image']).cast_column('image', Image(decode=False))
+    existing = dataset['ocr'] if 'ocr' in dataset.column_names and not overwrite else [None] * len(dataset)
+    ocr_texts = list(existing)
+    pending = deque()
+    num_ocr = 0
+
+    def resolve(idx, key, future):
+        ocr_texts[idx] = future.result()
+        if cache is not None:
+            cache.set(key, ocr_texts[idx])
+
+    for idx, image in enumerate(tqdm(images, total=len(images), dynamic_ncols=True, desc=desc)):
+        if ocr_texts[idx]:
+            continue
+        data = image_bytes(image['image'])
+        key = ocr_key(data, lang)
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            ocr_texts[idx] = cached
+            continue
+        pending.append((idx, key, executor.submit(ocr_image, data, lang)))
+        num_ocr += 1
+        if len(pending) >= 4 * num_workers:
+            resolve(*pending.popleft())
+    while pending:
+        resolve(*pending.popleft())
+    return ocr_texts, num_ocr
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the OCR of the document images of a dataset in parallel, before QA generation.')
+    parser.add_argument('--input-dataset-path', type=str, required=True, help='Path to HuggingFace dataset. Should be the result of dataset.save_to_disk(...)')
+    parser.add_argument('--output-path', type=str, required=True, help='Output directory of the dataset with the "ocr" column')
+    parser.add_argument('--lang', type=str, default='hun', help='Tesseract language')
+    parser.add_argument('--num-workers', type=int, default=None, help='Number of OCR processes. Default: the number of available cores')
+    parser.add_argument('--ocr-cache-path', type=str, default=None, help='SQLite file caching OCR results by image content hash, reused across runs and datasets')
+    parser.add_argument('--overwrite', action='store_true', help='Recompute the OCR of rows that already have a non-empty "ocr" value')
+    args = parser.parse_args()
+    num_workers = args.num_workers or available_cores()
+    cache = OCRCache(args.ocr_cache_path) if args.ocr_cache_path is not None else None
+    dataset = load_from_disk(args.input_dataset_path)
+    if not isinstance(dataset, DatasetDict):
+        dataset = DatasetDict({'train': dataset})
+    ds_name = Path(args.input_dataset_path).stem
+    ds_dict = dict()
+    start_time = time.time()
+    total_pages = 0
+    total_ocr = 0
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_ocr_worker) as executor:
+        for split in dataset.keys():
+            split_start = time.time()
+            ocr_texts, num_ocr = precompute_split_ocr(dataset[split], executor, num_workers, lang=args.lang, cache=cache,
+                                                      overwrite=args.overwrite, desc=f'{ds_name} {split} split')
+            elapsed = time.time() - split_start
+            logger.info(f'{split}: {len(ocr_texts)} pages, {num_ocr} run through OCR in {elapsed:.1f} s '
+                        f'({len(ocr_texts) / max(elapsed, 1e-9):.2f} pages/s, {num_ocr / max(elapsed, 1e-9):.2f} OCR pages/s)')
+            if 'ocr' in dataset[split].column_names:
+                dataset[split] = dataset[split].remove_columns('ocr')
+            ds_dict[split] = dataset[split].add_column('ocr', ocr_texts)
+            total_pages += len(ocr_texts)
+            total_ocr += num_ocr
+    elapsed = time.time() - start_time
+    logger.info(f'Processed {total_pages} pages with {num_workers} workers in {elapsed:.1f} s: {total_pages / max(elapsed, 1e-9):.2f} pages/s, '
+                f'{total_ocr} run through OCR ({total_ocr / max(elapsed, 1e-9):.2f} OCR pages/s)'
+                + (f', {cache.hits} cache hits' if cache is not None else ''))
+    DatasetDict(ds_dict).save_to_disk(args.output_path)
+    print(f'Done! Saved output as HF dataset to {args.output_path}')